@@ -8,33 +8,113 @@ AmazonProductAdvertisingAPI help
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import datetime
+import importlib
 import os
 import re
+import socket
+import time
+from collections import OrderedDict, namedtuple
+from functools import partial
 from Queue import Queue
-from threading import Event
+from threading import Event, Lock
 
 from calibre.constants import config_dir
 from calibre.ebooks.metadata.book.base import Metadata
-from calibre.ebooks.metadata.opf import get_metadata
-from calibre.ebooks.metadata.opf2 import metadata_to_opf
 from calibre.ebooks.metadata.sources.base import Option, Source
-from calibre.gui2.metadata.config import ConfigWidget
 from calibre.utils.logging import Log, ThreadSafeLog
 
+# calibre.ebooks.metadata.opf/opf2 (get_metadata, metadata_to_opf) and calibre.gui2 (ConfigWidget) are imported
+# where they are used: calibre loads every metadata source at startup and in each worker process.
+
 try:
     from typing import List, AnyStr, Any, Dict, FrozenSet, Text
 except:
     pass
 
 try:
-    from calibre_plugins.AmazonProductAdvertisingAPI.amazonsimpleproductapi import AmazonAPI, AmazonProduct, AmazonException
+    from calibre_plugins.AmazonProductAdvertisingAPI.amazonsimpleproductapi import (AmazonAPI, AmazonProduct, AmazonException, CancelledException,
+                                                                                     CircuitOpenException, RESPONSE_PROFILES)
 except ImportError:
     try:
         # noinspection PyUnresolvedReferences
-        from amazonsimpleproductapi import AmazonAPI, AmazonProduct, AmazonException
+        from amazonsimpleproductapi import AmazonAPI, AmazonProduct, AmazonException, CancelledException, CircuitOpenException, RESPONSE_PROFILES
     except:
         raise ImportError("amazonsimpleproductapi is missing")
 
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.apimetrics import ApiMetrics
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from apimetrics import ApiMetrics
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.metadatacache import BulkOPFWriter, ISBNConvert, MetadataCache, identifier_keys, normalize_identifier
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from metadatacache import BulkOPFWriter, ISBNConvert, MetadataCache, identifier_keys, normalize_identifier
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.cacherefresh import CacheRefresher
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from cacherefresh import CacheRefresher
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.circuitbreaker import CircuitBreaker
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from circuitbreaker import CircuitBreaker
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.matchindex import RelevanceQuery, candidate_trigrams
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from matchindex import RelevanceQuery, candidate_trigrams
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.scheduler import BACKGROUND, BATCH, RequestScheduler
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from scheduler import BACKGROUND, BATCH, RequestScheduler
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.searchcache import SearchCache, lookup_key, search_key
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from searchcache import SearchCache, lookup_key, search_key
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.quotaledger import QUOTA, RESERVATION_TTL, QuotaLedger
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from quotaledger import QUOTA, RESERVATION_TTL, QuotaLedger
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.recordformat import BINARY, OPF
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from recordformat import BINARY, OPF
+
+def _plugin_module(name):
+    """
+    Import one of the plugin's modules where it is first used: those only batch runs (cli_main) or optional features need are not
+    loaded with the plugin, which calibre does at startup and in every worker process.
+    :param name: unicode: module name
+    :return: module
+    """
+    try:
+        return importlib.import_module(str(u'calibre_plugins.AmazonProductAdvertisingAPI.' + name))
+    except ImportError:
+        return importlib.import_module(str(name))
+
+#: Immutable view of the plugin prefs, with everything the per-book code needs already derived.
+#: Built on first use and rebuilt by save_settings.
+PrefsSnapshot = namedtuple(str('PrefsSnapshot'), [str(f) for f in (u'domain', u'touched_field', u'tags_to_add', u'cache_active', u'cache_location', u'search_index',
+                                                                     u'search_indexes',
+                                                                     u'disable_title_author_search', u'disable_api_calls', u'metrics_port', u'author_formatter', u'max_age',
+                                                                     u'search_ttl', u'local_match_score', u'quota_limits', u'record_format',
+                                                                     u'archive_responses', u'base_request')])
+
 __license__ = u'GPL v3'
 __copyright__ = u'2011, Kovid Goyal kovid@kovidgoyal.net'
 __docformat__ = u'restructuredtext en'
@@ -55,7 +135,7 @@ class AmazonProductAdvertisingAPI(Source):
 
     @property
     def touched_field(self):
-        return u'amazon' if self.prefs[u'DOMAIN'] == u'US' else u'amazon_' + self.prefs[u'DOMAIN']
+        return self.settings.touched_field
 
     #: Set this to True if your plugin returns HTML formatted comments
     has_html_comments = True
@@ -94,6 +174,9 @@ class AmazonProductAdvertisingAPI(Source):
     options = [Option(u'AWS_ACCESS_KEY_ID', type_=u'string', default=u'', label=u'AWS_ACCESS_KEY_ID', desc=u'AWS key'),
                Option(u'AWS_SECRET_ACCESS_KEY', type_=u'string', default=u'', label=u'AWS_SECRET_ACCESS_KEY', desc=u'AWS secret'),
                Option(u'AWS_ASSOCIATE_TAG', type_=u'string', default=u'', label=u'AWS_ASSOCIATE_TAG', desc=u'Amazon-associate username'),
+               Option(u'API_VERSION', type_=u'choices', default=u'4', label=u'Product Advertising API version:',
+                      desc=u'4: ItemLookup/ItemSearch XML API. 5: GetItems/SearchItems JSON API (no editorial reviews or alternate versions).',
+                      choices={u'4': u'4.0 (XML)', u'5': u'5.0 (JSON)'}),
                Option(u'DOMAIN', type_=u'choices', default=u'US', label=u'Amazon Product API domain to use:',
                       desc=u'Metadata from BottlenoseAmazon will be fetched using this country\'s BottlenoseAmazon website.', choices=AmazonAPI.AMAZON_DOMAINS),
                Option(u'DISABLE_TITLE_AUTHOR_SEARCH', type_=u'bool', default=False, label=u'Disable title/author search:',
@@ -101,9 +184,35 @@ class AmazonProductAdvertisingAPI(Source):
                Option(u'DISABLE_API_CALLS', type_=u'bool', default=False, label=u'Disable api calls:', desc=u'BATCH UPDATE.'),
                Option(u'TAGS_TO_ADD', type_=u'string', default='amazonapi', label=u'TAGS_TO_ADD:', desc=u'A comma separated list of tags to add.'),
                Option(u'METADATA_CACHE_ACTIVE', type_=u'bool', default=True, label=u'Keep downloaded metadata?', desc=u''),
+               Option(u'RECORD_FORMAT', type_=u'choices', default=BINARY, label=u'Kept metadata format:',
+                      desc=u'How new records are written: compact binary records are smaller and faster to read back than OPF documents. '
+                           u'Both are read; cli_main --export-opf writes OPF copies of every record.',
+                      choices={BINARY: u'Binary', OPF: u'OPF'}),
+               Option(u'ARCHIVE_RESPONSES', type_=u'bool', default=False, label=u'Keep raw API responses:',
+                      desc=u'Archive every response, compressed, in the metadata location, so that cli_main --rederive can rebuild the kept '
+                           u'records after a conversion change without asking Amazon again.'),
                Option(u'METADATA_CACHE_LOCATION', type_=u'string', default=os.path.join(config_dir, 'amazonmi'), label=u'Where to store the metadata files.',
                       desc=u'Where to store the metadata files.'),
-               Option(u'SEARCH_INDEX', type_=u'string', default=u'KindleStore', label=u'Search Index (Books or KindleStore).', desc=u'Search index filter.')]
+               Option(u'SEARCH_INDEX', type_=u'string', default=u'KindleStore', label=u'Search Index (Books or KindleStore).',
+                      desc=u'Search index filter. Several comma separated indexes (KindleStore,Books) are searched at once by title/author, '
+                           u'the first one is used for ISBN lookups and binding preference.'),
+               Option(u'METADATA_MAX_AGE_DAYS', type_=u'number', default=90, label=u'Refresh kept metadata after (days):',
+                      desc=u'Older records are still used right away, and refreshed from Amazon in the background. 0 to never refresh.'),
+               Option(u'SEARCH_CACHE_HOURS', type_=u'number', default=24, label=u'Keep title/author search results (hours):',
+                      desc=u'A title/author search made again within this time is answered from kept metadata, without an API call. 0 to disable.'),
+               Option(u'LOCAL_MATCH_SCORE', type_=u'number', default=0.85, label=u'Kept metadata title/author match score (0-1):',
+                      desc=u'Books without identifiers are first matched against kept metadata by title and author; a match scoring at least this much '
+                           u'is used without searching Amazon. 0 to disable.'),
+               Option(u'HEDGE_REQUESTS', type_=u'bool', default=False, label=u'Hedge slow requests:',
+                      desc=u'Send a request a second time when it is slower than 95% of recent ones, and use whichever answer comes first. '
+                           u'Uses at most 10% more requests, and only when the rate limit allows it.'),
+               Option(u'QUOTA_PER_HOUR', type_=u'number', default=0, label=u'Request quota per hour:',
+                      desc=u'Most requests sent in any hour by calibre and batch runs together (they share a ledger in the metadata location). '
+                           u'0 for no limit.'),
+               Option(u'QUOTA_PER_DAY', type_=u'number', default=0, label=u'Request quota per day:',
+                      desc=u'Most requests sent in any 24 hours, like the hourly quota. 0 for no limit.'),
+               Option(u'METRICS_PORT', type_=u'number', default=0, label=u'Metrics port:',
+                      desc=u'Serve request timings and counters in the Prometheus text format on http://127.0.0.1:PORT/metrics. 0 to disable.')]
 
     def config_widget(self):
         from calibre.gui2.metadata.config import ConfigWidget
@@ -125,20 +234,184 @@ class AmazonProductAdvertisingAPI(Source):
         """
         Source.__init__(self, *args, **kwargs)
 
-        self.amazonapi = AmazonAPI(aws_key=self.prefs[u'AWS_ACCESS_KEY_ID'], aws_secret=self.prefs[u'AWS_SECRET_ACCESS_KEY'], aws_associate_tag=self.prefs[u'AWS_ASSOCIATE_TAG'],
-                                   Region=self.prefs[u'DOMAIN'], MaxQPS=0.8, Timeout=20)
-        self.base_request = {u'ResponseGroup': u'AlternateVersions,BrowseNodes,EditorialReview,Images,ItemAttributes', u'Region': self.prefs[
-            u'DOMAIN'], u'MaxQPS'            : 0.2, u'Timeout': 30}
+        self.metrics = ApiMetrics()
+        self._metrics_server = None
+        self._profiler = None
+        self._amazonapi = None
+        self._settings = None
+        self._metadata_cache = None
+        self._search_cache = None
+        self._quota = None
+        self._archive = None
+        #: opens after repeated API failures, see api_calls_disabled
+        self.breaker = CircuitBreaker(metrics=self.metrics)
+        self._snapshot = None
+        self._refresher = None
+        #: products fetched with a light ResponseGroup profile (download_cover), completed by identify instead of fetched again;
+        #: least recently stored first, at most 256, shared by the cover and identify threads
+        self._partial_products = OrderedDict()
+        self._partial_lock = Lock()
         #: List of metadata fields that can potentially be download by this plugin
         #: during the identify phase
-        # identifier:amazon_DOMAIN will be added dynamically according to prefs
-        if self._config_obj is None:
-            from calibre.utils.config import JSONConfig
-            self._config_obj = JSONConfig('plugins/AmazonProductAdvertisingAPI')
-        ff = ['title', 'authors', 'identifier:amazon', 'identifier:isbn', 'rating', 'comments', 'publisher', 'pubdate', 'tags', 'series']
-        ff.extend(('identifier:' + self.touched_field))
         self.touched_fields = frozenset()
 
+    @property
+    def profiler(self):
+        """
+        :return: BatchProfiler: disabled unless cli_main runs with --profile
+        """
+        if self._profiler is None:
+            self._profiler = _plugin_module(u'batchprofile').BatchProfiler()
+        return self._profiler
+
+    @profiler.setter
+    def profiler(self, profiler):
+        self._profiler = profiler
+
+    @property
+    def settings(self):
+        """
+        Use this rather than self.prefs in per-book code: JSONConfig lookups and the derived values are computed once.
+        :return: PrefsSnapshot
+        """
+        settings = self._settings
+        if settings is None:
+            settings = self._settings = self._snapshot_prefs()
+        return settings
+
+    def _snapshot_prefs(self):
+        """
+        :return: PrefsSnapshot: built from the current prefs
+        """
+        prefs = self.prefs
+        domain = prefs.get(u'DOMAIN') or u'US'
+        tags = frozenset(t.strip().lower() for t in (prefs.get(u'TAGS_TO_ADD') or u'').split(u',') if t.strip())
+        search_indexes = tuple(i.strip() for i in (prefs[u'SEARCH_INDEX'] or u'').split(u',') if i.strip()) or (u'KindleStore',)
+        base_request = ((u'ResponseGroup', RESPONSE_PROFILES[u'full']), (u'Region', domain), (u'MaxQPS', 0.2),
+                        (u'Timeout', 30))
+        return PrefsSnapshot(domain=domain, touched_field=u'amazon' if domain == u'US' else u'amazon_' + domain, tags_to_add=tags,
+                             cache_active=bool(prefs.get(u'METADATA_CACHE_ACTIVE', True)), cache_location=prefs[u'METADATA_CACHE_LOCATION'],
+                             record_format=prefs.get(u'RECORD_FORMAT') or BINARY, archive_responses=bool(prefs.get(u'ARCHIVE_RESPONSES')),
+                             search_index=search_indexes[0], search_indexes=search_indexes, disable_title_author_search=bool(prefs.get(u'DISABLE_TITLE_AUTHOR_SEARCH')),
+                             disable_api_calls=bool(prefs.get(u'DISABLE_API_CALLS')), metrics_port=int(prefs.get(u'METRICS_PORT') or 0),
+                             author_formatter=self._author_initials_formatter(), base_request=base_request,
+                             max_age=float(prefs.get(u'METADATA_MAX_AGE_DAYS', 90) or 0) * 86400,
+                             search_ttl=float(prefs.get(u'SEARCH_CACHE_HOURS', 24) or 0) * 3600,
+                             local_match_score=float(prefs.get(u'LOCAL_MATCH_SCORE', 0.85) or 0),
+                             quota_limits=tuple((w, int(prefs.get(k) or 0)) for w, k in ((3600, u'QUOTA_PER_HOUR'), (86400, u'QUOTA_PER_DAY')) if prefs.get(k)))
+
+    @staticmethod
+    def _author_initials_formatter():
+        """
+        Resolve the Quality Check plugin's author initials formatting, if that plugin is installed.
+        :return: callable(author) -> author, or None
+        """
+        try:
+            from calibre.utils.config import JSONConfig
+            from calibre_plugins.quality_check.config import STORE_OPTIONS, KEY_AUTHOR_INITIALS_MODE, AUTHOR_INITIALS_MODES
+            from calibre_plugins.quality_check.helpers import get_formatted_author_initials
+            initials_mode = JSONConfig('plugins/Quality Check')[STORE_OPTIONS].get(KEY_AUTHOR_INITIALS_MODE, AUTHOR_INITIALS_MODES[0])
+        except:
+            return None
+        return partial(get_formatted_author_initials, initials_mode)
+
+    @property
+    def base_request(self):
+        """
+        :return: Dict: parameters shared by every request
+        """
+        return dict(self.settings.base_request)
+
+    def _request(self, abort=None, deadline=None, profile=None, **params):
+        """
+        :param abort: Event or None: identify's abort, stops throttle waits and reads once set
+        :param deadline: float or None: time.time() by which the request must be done
+        :param profile: unicode or None: RESPONSE_PROFILES name, full by default
+        :param params: request parameters
+        :return: Dict: base_request with params, bounded by abort and deadline
+        """
+        request = self.base_request
+        if profile is not None:
+            request[u'ResponseGroup'] = RESPONSE_PROFILES[profile]
+        if abort is not None:
+            request[u'Abort'] = abort
+        if deadline is not None:
+            request[u'Deadline'] = deadline
+        request.update(params)
+        return request
+
+    @property
+    def metadata_cache(self):
+        """
+        :return: MetadataCache: the METADATA_CACHE_LOCATION directory, writing RECORD_FORMAT records
+        """
+        settings = self.settings
+        cache = self._metadata_cache
+        if cache is None or cache.location != settings.cache_location or cache.record_format != settings.record_format:
+            self._metadata_cache = MetadataCache(settings.cache_location, settings.record_format)
+        return self._metadata_cache
+
+    @property
+    def search_cache(self):
+        """
+        :return: SearchCache: title/author search results, kept in METADATA_CACHE_LOCATION
+        """
+        settings = self.settings
+        ttl = settings.search_ttl if settings.cache_active else 0
+        if self._search_cache is None or self._search_cache.location != settings.cache_location or self._search_cache.ttl != ttl:
+            self._search_cache = SearchCache(settings.cache_location, ttl)
+        return self._search_cache
+
+    @property
+    def quota(self):
+        """
+        :return: QuotaLedger or None: the request quota (QUOTA_PER_HOUR, QUOTA_PER_DAY) shared by every process using METADATA_CACHE_LOCATION
+        """
+        settings = self.settings
+        if not settings.quota_limits:
+            return None
+        path = os.path.join(settings.cache_location, QUOTA)
+        if self._quota is None or self._quota.path != path or self._quota.limits != dict(settings.quota_limits):
+            self._quota = QuotaLedger(path, dict(settings.quota_limits))
+        return self._quota
+
+    @property
+    def archive(self):
+        """
+        :return: ResponseArchive: METADATA_CACHE_LOCATION/archive, see ARCHIVE_RESPONSES
+        """
+        responsearchive = _plugin_module(u'responsearchive')
+        path = os.path.join(self.settings.cache_location, responsearchive.ARCHIVE)
+        if self._archive is None or self._archive.location != path:
+            self._archive = responsearchive.ResponseArchive(path)
+        return self._archive
+
+    def _archive_response(self, cache_url, response_text):
+        """
+        Bottlenose CacheWriter: archive a raw response, with the profile of the lookup it answers. Never fails the call it comes from.
+        """
+        try:
+            self.archive.append(response_text, _plugin_module(u'responsearchive').request_profile(cache_url))
+        except Exception:
+            self.log.exception(u'Could not archive the response')
+
+    @property
+    def amazonapi(self):
+        """
+        The API client, built on first use so that loading the plugin (or running it with DISABLE_API_CALLS) never pays for it.
+        :return: AmazonAPI or Paapi5API, by API_VERSION
+        """
+        if self._amazonapi is None:
+            api_class = _plugin_module(u'paapi5').Paapi5API if self.prefs.get(u'API_VERSION') == u'5' else AmazonAPI
+            max_qps = 0.8
+            # identify's lookups are served before background refreshes and batch lookups (Priority)
+            self._amazonapi = api_class(aws_key=self.prefs[u'AWS_ACCESS_KEY_ID'], aws_secret=self.prefs[u'AWS_SECRET_ACCESS_KEY'],
+                                        aws_associate_tag=self.prefs[u'AWS_ASSOCIATE_TAG'], Region=self.settings.domain, MaxQPS=max_qps, Timeout=20,
+                                        Metrics=self.metrics, Hedge=0.95 if self.prefs.get(u'HEDGE_REQUESTS') else None, Quota=self.quota,
+                                        Scheduler=RequestScheduler(max_qps), Breaker=self.breaker,
+                                        CacheWriter=self._archive_response if self.settings.archive_responses else None)
+        return self._amazonapi
+
     def cli_main(self, args):
         # type: (List[AnyStr]) -> None
         """
@@ -150,74 +423,495 @@ class AmazonProductAdvertisingAPI(Source):
         """
         # noinspection PyAttributeOutsideInit
         self.log = Log()
-        if os.path.isfile(os.path.join(self.prefs['METADATA_CACHE_LOCATION'], u'batch.txt')):
-            f = open(os.path.join(self.prefs['METADATA_CACHE_LOCATION'], u'batch.txt'), 'r')
-            content = f.read()
-            f.close()
-            identifiers = re.split(r'[,\s;]', content)
-        elif args:
-            identifiers = re.split(r'[,\s;]', args[1])
-        else:
-            self.log.info(u'batch.txt or comma separated list of identifiers')
+        opts = self._cli_parser().parse_args(args[1:])
+        if opts.reindex:
+            self.log.info(u'reindexed:', self.metadata_cache.reindex(self.log), u'records')
+        if opts.export_snapshot:
+            self.export_snapshot()
+        if opts.export_opf:
+            self.log.info(u'exported:', self.metadata_cache.export_opf(opts.export_opf, self.log), u'OPF records to', opts.export_opf)
+        if opts.rederive:
+            self.rederive(processes=opts.processes)
+        if opts.reindex or opts.export_snapshot or opts.export_opf or opts.rederive:
             return
+        if opts.warm_library or opts.warm_csv:
+            warmup = _plugin_module(u'warmup')
+            books = warmup.read_library_identifiers(opts.warm_library) if opts.warm_library else warmup.read_csv_identifiers(opts.warm_csv)
+            self.warm_cache(books, covers=not opts.no_covers)
+            return
+        if opts.worker:
+            self.run_worker(_plugin_module(u'workqueue').WorkQueue(opts.worker, ttl=opts.lease_ttl))
+            return
+        # noinspection PyAttributeOutsideInit
+        self.profiler = _plugin_module(u'batchprofile').BatchProfiler(enabled=bool(opts.profile))
+        self.profiler.start()
+        parser = self.amazonapi.api.Parser
+        self.amazonapi.api.Parser = self.profiler.wrap(u'parse', parser)
+        try:
+            self._cli_batch(opts)
+        finally:
+            self.amazonapi.api.Parser = parser
+            self.profiler.stop()
+            if opts.profile:
+                for path in self.profiler.write(opts.profile):
+                    self.log.info(u'profile:', path)
+                self.log.info(self.profiler.hot_functions(limit=10))
 
-        identifiers_isbn = identifiers_asins = []
-        if identifiers:
-            identifiers = map(unicode, identifiers)
-            identifiers_isbn = [i for i in identifiers if re.match(r'[0-9X\-]+', i) is not None]
-            identifiers_asins = [i for i in identifiers if 'B' in i]
+        return
 
-        if len(identifiers_isbn) > 0:
-            self.bulk_identify(identifiers, u'ISBN')
-        if len(identifiers_asins) > 0:
-            self.bulk_identify(identifiers, u'ASIN')
+    def _cli_parser(self):
+        """
+        :return: argparse.ArgumentParser: cli_main arguments
+        """
+        import argparse
+        parser = argparse.ArgumentParser(prog=u'calibre-debug -r "%s" --' % self.name)
+        parser.add_argument(u'identifiers', nargs=u'?', help=u'comma separated list of identifiers, used when there is no batch.txt')
+        parser.add_argument(u'--profile', metavar=u'DIR',
+                            help=u'profile the run per stage and write profile.folded (flame graph), profile.<stage>.prof and profile.txt to DIR')
+        parser.add_argument(u'--plan', action=u'store_true',
+                            help=u'report the ItemLookups the identifiers need (calls, estimated run time) without sending them, then exit')
+        parser.add_argument(u'--processes', type=int, default=0, metavar=u'N',
+                            help=u'parse and convert responses in N processes while the main one only downloads (not on Windows)')
+        parser.add_argument(u'--coordinator', metavar=u'DIR',
+                            help=u'queue the planned ItemLookups in DIR, on a filesystem the --worker machines mount, and write their answers to '
+                                 u'METADATA_CACHE_LOCATION until every request is answered')
+        parser.add_argument(u'--worker', metavar=u'DIR', help=u'send the ItemLookups queued in DIR by a --coordinator, with this machine\'s settings, '
+                                                              u'until none is left, then exit')
+        parser.add_argument(u'--lease-ttl', type=float, default=_plugin_module(u'workqueue').LEASE_TTL, metavar=u'SECONDS',
+                            help=u'with --coordinator or --worker: a request leased for longer is given to another worker (default %(default)s)')
+        parser.add_argument(u'--warm-library', metavar=u'PATH',
+                            help=u'prefetch metadata and covers for every book of a calibre library (directory or metadata.db), then exit')
+        parser.add_argument(u'--warm-csv', metavar=u'PATH', help=u'same as --warm-library, reading identifiers from a calibre CSV catalog export')
+        parser.add_argument(u'--no-covers', action=u'store_true', help=u'do not prefetch covers when warming the cache')
+        parser.add_argument(u'--reindex', action=u'store_true',
+                            help=u'add records written by older versions to the identifier index (manifest.jsonl), then exit')
+        parser.add_argument(u'--export-snapshot', action=u'store_true',
+                            help=u'compile METADATA_CACHE_LOCATION into a read-only metadata.snapshot used by identify, then exit')
+        parser.add_argument(u'--export-opf', metavar=u'DIR', help=u'write every kept record to DIR as an OPF document, then exit')
+        parser.add_argument(u'--rederive', action=u'store_true',
+                            help=u'convert the archived full lookups (ARCHIVE_RESPONSES) again and rewrite the kept records they are the newest '
+                                 u'full lookup of (in --processes processes), then exit')
+        return parser
+
+    def _cli_batch(self, opts):
+        """
+        :param opts: argparse.Namespace: parsed cli_main arguments
+        """
+        with self.profiler.stage(u'ingest'):
+            if os.path.isfile(os.path.join(self.settings.cache_location, u'batch.txt')):
+                f = open(os.path.join(self.settings.cache_location, u'batch.txt'), 'r')
+                content = f.read()
+                f.close()
+                identifiers = re.split(r'[,\s;]', content)
+            elif opts.identifiers:
+                identifiers = re.split(r'[,\s;]', opts.identifiers)
+            else:
+                self.log.info(u'batch.txt or comma separated list of identifiers')
+                return
 
-        return
+            plan = self.plan_batch([unicode(i) for i in identifiers])
+        self.log.info(u'plan:', plan.summary())
+        if opts.plan:
+            return
+        if opts.coordinator:
+            self.coordinate(plan, _plugin_module(u'workqueue').WorkQueue(opts.coordinator, ttl=opts.lease_ttl))
+            return
+
+        quota = self.quota
+        if quota is not None:
+            self.log.info(u'quota left:', u', '.join(u'%d in %ds' % (n, w) for w, n in sorted(quota.remaining().items())))
+            # hold the batch's share back from calibre's identify, for about as long as the run should take
+            quota.reservation, reserved = quota.reserve(plan.calls, ttl=max(plan.estimated_seconds * 2, RESERVATION_TTL))
+            self.log.info(u'quota reserved:', reserved, u'of', plan.calls, u'calls')
+        self.start_metrics_server()
+        try:
+            self.bulk_identify(plan, processes=opts.processes)
+        finally:
+            if quota is not None:
+                quota.release(quota.reservation)
+        self.write_metrics()
+
+    def start_metrics_server(self):
+        """
+        Serve self.metrics on METRICS_PORT, once per plugin instance.
+        """
+        port = self.settings.metrics_port
+        if port and self._metrics_server is None:
+            try:
+                self._metrics_server = self.metrics.serve(port)
+                self.log.info(u'metrics: http://127.0.0.1:%d/metrics' % port)
+            except Exception:
+                self.log.exception(u'Could not serve metrics on port', port)
+
+    def write_metrics(self):
+        """
+        Write self.metrics to METADATA_CACHE_LOCATION/metrics.prom
+        """
+        try:
+            self.metrics.write(os.path.join(self.settings.cache_location, u'metrics.prom'))
+        except Exception:
+            self.log.exception(u'Could not write metrics')
 
-    def write_it(self, product, file_name):
+    def write_it(self, product, file_name, writer=None, overwrite=False):
         """
         :param product:
         :param file_name:
+        :param writer: BulkOPFWriter or None to write synchronously
+        :param overwrite: replace an existing record
+        """
+        # type: (AmazonProduct, unicode or str, BulkOPFWriter, bool) -> None
+        if not overwrite and file_name in (writer if writer is not None else self.metadata_cache):
+            return
+        self.log.info(u'create:', self.metadata_cache.path(file_name))
+        with self.profiler.stage(u'convert'):
+            mi, keys = self.product_record(product)
+        with self.profiler.stage(u'write'):
+            if writer is not None:
+                writer.put(file_name, mi, keys)
+            else:
+                self.metadata_cache.ensure_location()
+                self.metadata_cache.write(file_name, mi, keys)
+
+    def product_record(self, product):
+        """
+        :param product: AmazonProduct
+        :return: Tuple[Metadata, List[unicode]]: the record, and the identifiers that should find it besides its own
         """
-        # type: (AmazonProduct, unicode or str) -> None
-        persistentMI = os.path.join(self.prefs['METADATA_CACHE_LOCATION'], file_name)
-        if not os.path.isfile(persistentMI):
-            self.log.info(u'create:', persistentMI)
-            f = open(persistentMI, str('wb'))
-            mi = self.AmazonProduct_to_Metadata(product)
-            f.write(metadata_to_opf(mi, default_lang=u'und'))
-            f.close()
+        mi = self.AmazonProduct_to_Metadata(product)
+        # every identifier the product exposes should find this record
+        keys = [product.isbn, product.eisbn, product.ean] + [av.get(u'asin') for av in product.alternate_versions]
+        return mi, keys
 
-    def bulk_identify(self, identifiers, id_type=u"ASIN"):
+    @staticmethod
+    def bulk_file_name(product, id_type):
         """
-        :param id_type:
-        :param identifiers:list(unicode):list of identifiers
-        :return:list(Metadata)
+        :param product: AmazonProduct
+        :param id_type: unicode: ASIN or ISBN, what the batch was looked up by
+        :return: unicode or None: record file name, None if the product has no usable identifier
         """
-        # type: (List[unicode]) -> List[Metadata]
-        if not os.path.exists(self.prefs['METADATA_CACHE_LOCATION']):
-            os.makedirs(self.prefs['METADATA_CACHE_LOCATION'])
+        if id_type == u'ISBN' and product.isbn:
+            return unicode(product.isbn) + u'.mi'
+        elif product.asin:
+            return unicode(product.asin) + u'.mi'
+        return None
 
-        lists_identifiers = [identifiers[x:x + 10] for x in range(0, len(identifiers), 10)]
-        self.log.info(u'lists_identifiers:', lists_identifiers)
+    def plan_batch(self, identifiers, priorities=None):
+        """
+        The fewest ItemLookups that cover identifiers: see requestplan.
+        :param identifiers: List[unicode]: ASINs, ISBN-10s and ISBN-13s, in any form and order
+        :param priorities: Dict[unicode, float] or None: lower is sooner, by identifier; input order when None
+        :return: RequestPlan
+        """
+        settings = self.settings
+        search_cache = self.search_cache
+
+        def is_cached(id_type, key):
+            return self.metadata_cache.find({u'amazon' if id_type == u'ASIN' else u'isbn': key}) is not None
+
+        def is_missing(id_type, key):
+            return search_cache.get(lookup_key(id_type, key, settings.search_index if id_type == u'ISBN' else None, settings.domain)) == []
+
+        max_qps = self.amazonapi.api.MaxQPS
+        # the throttle sets the pace, unless the responses are slower than it
+        latency = self.metrics.quantile(u'response_seconds', 0.5, region=settings.domain) or 0.0
+        seconds_per_call = max(1.0 / max_qps if max_qps else 0.0, latency)
+        return _plugin_module(u'requestplan').plan_requests(identifiers, is_cached, is_missing, settings.domain, settings.search_index, seconds_per_call, priorities)
+
+    def bulk_identify(self, plan, processes=0):
+        """
+        :param plan: RequestPlan: plan_batch output, its requests are sent in order
+        :param processes: int: parse and convert responses in that many processes (bulkparse), 0 to do it on the fetch thread
+        """
+        # type: (RequestPlan, int) -> None
+        bulkparse = _plugin_module(u'bulkparse')
         request = self.base_request.copy()
+        request[u'Priority'] = BATCH
+
+        pool = None
+        if processes and bulkparse.available():
+            # fork before the writer thread starts
+            pool = bulkparse.ParsePool(self, processes, on_result=None)
+        elif processes:
+            self.log.info(u'no process pool on this platform, parsing on the fetch thread')
+
+        with BulkOPFWriter(self.metadata_cache, self.log) as writer:
+            if pool is not None:
+                pool.on_result = partial(self._write_converted, writer)
+            for planned in plan.requests:
+                request.update({u'ItemId': u','.join(planned.ids), u'IdType': planned.id_type})
+                if planned.search_index:
+                    request[u'SearchIndex'] = planned.search_index
+                else:
+                    request.pop(u'SearchIndex', None)
+                try:
+                    if pool is not None:
+                        with self.profiler.stage(u'request'):
+                            raw = self.amazonapi.item_lookup_raw(**request)
+                        pool.submit(raw, planned.id_type, planned)
+                    else:
+                        with self.profiler.stage(u'request'):
+                            products = self.amazonapi.item_lookup(**request)
+                        self.log.info(u'found', len(products), u'results')
+                        found = set()
+                        for p in products:
+                            found.update(identifier_keys({u'amazon': p.asin}))
+                            file_name = self.bulk_file_name(p, planned.id_type)
+                            if file_name is not None:
+                                self.write_it(p, file_name, writer)
+                            else:
+                                self.log.error(u"JUST LOST A RESULT")
+                        self._record_missing(planned, found)
+                except CircuitOpenException:
+                    # the rest is planned again by the next run
+                    self.log.error(u'API calls suspended, stopping the batch:', self.breaker.report())
+                    break
+                except AmazonException as e:
+                    self.log.error("AmazonException. Code:", e.code, ' Message:', e.msg)
+                    self._record_missing(planned, error_code=e.code)
+                self.write_metrics()
+            if pool is not None:
+                pool.close()
+        self.log.info(u'written:', writer.written, u'failed:', writer.failed)
+
+    def coordinate(self, plan, queue, poll=5.0):
+        """
+        Queue a plan for workers (run_worker on other machines) and write their answers to the metadata cache until every request
+        is answered or given up.
+        :param plan: RequestPlan
+        :param queue: WorkQueue
+        :param poll: float: seconds between two looks at the queue
+        """
+        workqueue = _plugin_module(u'workqueue')
+        PENDING, LEASED, RESULTS, FAILED = workqueue.PENDING, workqueue.LEASED, workqueue.RESULTS, workqueue.FAILED
+        self.log.info(u'queued:', queue.enqueue(plan.requests), u'requests in', queue.directory)
+        self.start_metrics_server()
+        last = None
+        with BulkOPFWriter(self.metadata_cache, self.log) as writer:
+            while True:
+                requeued = queue.requeue_expired()
+                if requeued:
+                    self.log.info(u'requeued', requeued, u'requests whose lease expired')
+                for result in queue.take_results():
+                    self.metrics.inc(u'queue_results_total', worker=result.worker)
+                    self._write_converted(writer, result.request, result.records, result.lost, result.error, result.code)
+                status = queue.status()
+                if status != last:
+                    self.log.info(u'queue:', u', '.join(u'%d %s' % (status[s], s) for s in (PENDING, LEASED, RESULTS, FAILED)))
+                    last = status
+                if not status[PENDING] and not status[LEASED] and not status[RESULTS]:
+                    break
+                time.sleep(poll)
+        self.log.info(u'written:', writer.written, u'failed:', writer.failed, u'given up:', status[FAILED])
+        self.write_metrics()
 
-        for li in lists_identifiers:
-            request.update({u'ItemId': u','.join(li), u'IdType': id_type})
-            if id_type == "ISBN":
-                request.update({u'SearchIndex': self.prefs['SEARCH_INDEX']})
+    def run_worker(self, queue, poll=5.0):
+        """
+        Send the requests a coordinator queued for this region, with this plugin's credentials, MaxQPS, quota and circuit breaker,
+        and hand the converted records back to the queue.
+        :param queue: WorkQueue
+        :param poll: float: seconds between two looks at an empty queue
+        """
+        worker = u'%s-%d' % (socket.gethostname(), os.getpid())
+        regions = (self.settings.domain,)
+        request = self.base_request
+        request[u'Priority'] = BATCH
+        self.start_metrics_server()
+        self.log.info(u'worker', worker, u'on', queue.directory)
+        while True:
+            lease = queue.lease(worker, regions)
+            if lease is None:
+                if queue.finished():
+                    break
+                time.sleep(poll)
+                continue
+            planned = lease.request
+            request.update({u'ItemId': u','.join(planned.ids), u'IdType': planned.id_type})
+            if planned.search_index:
+                request[u'SearchIndex'] = planned.search_index
+            else:
+                request.pop(u'SearchIndex', None)
+            # give up before the lease runs out, rather than answer a request that may have been leased again
+            request[u'Deadline'] = lease.expires - min(30.0, queue.ttl / 10)
             try:
-                products = self.amazonapi.item_lookup(**request)
-                self.log.info(u'found', len(products), u'results')
-                for p in products:
-                    if id_type == u'ISBN' and p.isbn:
-                        self.write_it(p, unicode(p.isbn) + u'.mi')
-                    elif p.asin:
-                        self.write_it(p, unicode(p.asin) + u'.mi')
-                    else:
-                        self.log.error(u"JUST LOST A RESULT")
+                with self.profiler.stage(u'request'):
+                    products = self.amazonapi.item_lookup(**request)
+            except CircuitOpenException:
+                queue.release(lease)
+                self.log.error(u'API calls suspended, stopping the worker:', self.breaker.report())
+                break
+            except CancelledException as e:
+                queue.release(lease)
+                # the lease did not count as an attempt: wait before taking one again, or the worker spins on the queue lock
+                wait = poll
+                if e.code == u'quota' and self.quota is not None:
+                    wait = max(poll, self.quota.wait_time())
+                self.log.info(u'request cancelled (%s), given back to the queue, waiting %.0fs' % (e.code, wait))
+                time.sleep(wait)
+                continue
             except AmazonException as e:
                 self.log.error("AmazonException. Code:", e.code, ' Message:', e.msg)
+                queue.complete(lease, error=u'AmazonException. Code: %s Message: %s' % (e.code, e.msg), code=e.code)
+                continue
+            records = []
+            lost = 0
+            with self.profiler.stage(u'convert'):
+                for p in products:
+                    file_name = self.bulk_file_name(p, planned.id_type)
+                    if file_name is None:
+                        lost += 1
+                        continue
+                    mi, keys = self.product_record(p)
+                    records.append(self.metadata_cache.serialize(file_name, mi, keys))
+            self.log.info(u'found', len(products), u'results for', lease.shard)
+            queue.complete(lease, records, lost)
+            self.write_metrics()
+        self.write_metrics()
+
+    def _record_missing(self, planned, found=(), error_code=None):
+        """
+        Keep the identifiers of a planned request that Amazon does not know, so that later plans leave them out.
+        ASIN requests: the ASINs that are not among the results. ISBN requests, whose results cannot be told apart by ISBN
+        (a Kindle edition has none): only when the whole request failed with a NOT_FOUND_CODES error.
+        :param planned: PlannedRequest
+        :param found: Set[unicode]: identifier_keys of the ASINs returned
+        :param error_code: the AmazonException code if the request failed
+        """
+        if error_code is not None:
+            if unicode(error_code) not in _plugin_module(u'requestplan').NOT_FOUND_CODES:
+                return
+            missing = planned.ids
+        elif planned.id_type == u'ASIN':
+            missing = [i for i in planned.ids if i not in found]
+        else:
+            return
+        for key in missing:
+            self.search_cache.put(lookup_key(planned.id_type, key, planned.search_index, planned.region), [])
+
+    def _write_converted(self, writer, planned, records, lost, error, code):
+        """
+        bulkparse.ParsePool callback: queue the records a pool process converted.
+        :param writer: BulkOPFWriter
+        :param planned: PlannedRequest: the request the response answers
+        :param records: List[Tuple[unicode, bytes, Dict]]: MetadataCache.serialize output
+        :param lost: int: products without a usable identifier
+        :param error: unicode or None
+        :param code: AmazonException code of the error, if it was one
+        """
+        if error:
+            self.log.error(error)
+            self._record_missing(planned, error_code=code)
+        else:
+            self._record_missing(planned, set(k for record in records for k in identifier_keys({u'amazon': record[2][u'ids'].get(self.touched_field)})))
+        for _ in range(lost):
+            self.log.error(u"JUST LOST A RESULT")
+        for record in records:
+            if record[0] not in writer:
+                self.log.info(u'create:', self.metadata_cache.path(record[0]))
+                writer.put_serialized(record)
+
+    def rederive(self, processes=0):
+        """
+        Rewrite the kept records from the newest archived full-profile lookup of their ASIN, with the current conversion. Cover,
+        identity and upgrade lookups, and searches, are archived but lack fields of the record.
+        :param processes: int: convert in that many processes (bulkparse), 0 to do it in this one
+        """
+        bulkparse = _plugin_module(u'bulkparse')
+        archive = self.archive
+        self.log.info(u'archive:', archive.stats())
+        pool = None
+        if processes and bulkparse.available():
+            pool = bulkparse.ParsePool(self, processes, on_result=None)
+        elif processes:
+            self.log.info(u'no process pool on this platform, converting in this process')
+        with BulkOPFWriter(self.metadata_cache, self.log) as writer:
+            if pool is not None:
+                pool.on_result = partial(self._write_rederived, writer)
+            for raw, asins in archive.latest_responses(_plugin_module(u'responsearchive').FULL):
+                if pool is not None:
+                    pool.submit(raw, u'ASIN', asins)
+                else:
+                    self._write_rederived(writer, asins, *bulkparse.convert(self, raw, u'ASIN'))
+            if pool is not None:
+                pool.close()
+        self.log.info(u'rewritten:', writer.written, u'failed:', writer.failed)
+
+    def _write_rederived(self, writer, asins, records, lost, error, code):
+        """
+        bulkparse callback of rederive: queue the records of the products the response is the newest one of, under the name of
+        the record they replace; products that have no record are left out.
+        :param asins: List[unicode]: normalized ASINs the response is the newest archived response of
+        :param records, lost, error, code: bulkparse.convert output
+        """
+        if error:
+            self.log.error(error)
+            return
+        asins = frozenset(asins)
+        for file_name, data, fields in records:
+            asin = fields[u'ids'].get(self.touched_field)
+            if not asin or normalize_identifier(asin) not in asins:
+                continue
+            existing = self.metadata_cache.find({u'amazon': asin})
+            if existing is not None:
+                writer.put_serialized((existing, data, fields))
+
+    def warm_cache(self, books, covers=True):
+        """
+        Prefetch the metadata (and covers) of books that are not cached yet, 10 per ItemLookup, at the client's MaxQPS.
+        :param books: List[Dict[unicode, unicode]]: identifiers of each book
+        :param covers: bool: also download covers, on separate threads
+        """
+        asins, isbns = [], []
+        for ids in books:
+            if self.metadata_cache.find(ids):
+                continue
+            asin = ids.get(self.touched_field) or ids.get(u'amazon') or ids.get(u'mobi-asin')
+            if asin:
+                asins.append(asin)
+            elif ids.get(u'isbn'):
+                isbns.append(ids[u'isbn'])
+        asins, isbns = sorted(set(asins)), sorted(set(isbns))
+        self.log.info(u'warm-up:', len(books), u'books,', len(asins), u'ASINs and', len(isbns), u'ISBNs to fetch')
+        if not asins and not isbns:
+            return
+
+        warmup = _plugin_module(u'warmup')
+        fetcher = None
+        if covers:
+            browser = self.browser
+            fetcher = warmup.CoverFetcher(lambda url: browser.clone_browser().open_novisit(url, timeout=30).read(), self.metadata_cache.write_cover, log=self.log)
+        progress = warmup.Progress(len(asins) + len(isbns), u'warm-up')
+        self.start_metrics_server()
+        try:
+            with BulkOPFWriter(self.metadata_cache, self.log) as writer:
+                for id_type, values in ((u'ASIN', asins), (u'ISBN', isbns)):
+                    for x in range(0, len(values), 10):
+                        chunk = values[x:x + 10]
+                        request = self.base_request
+                        request.update({u'ItemId': u','.join(chunk), u'IdType': id_type, u'Priority': BATCH})
+                        if id_type == u'ISBN':
+                            request[u'SearchIndex'] = self.settings.search_index
+                        try:
+                            products = self.amazonapi.item_lookup(**request)
+                        except CircuitOpenException:
+                            self.log.error(u'API calls suspended, stopping the warm-up:', self.breaker.report())
+                            return
+                        except AmazonException as e:
+                            self.log.error(u'AmazonException. Code:', e.code, u' Message:', e.msg)
+                            products = []
+                        for p in products:
+                            if not p.asin:
+                                continue
+                            file_name = unicode(p.asin) + u'.mi'
+                            self.write_it(p, file_name, writer)
+                            if fetcher is not None and p.large_image_url:
+                                fetcher.put(file_name, p.large_image_url)
+                        progress.update(len(chunk), records=writer.written, covers=fetcher.fetched if fetcher else 0)
+        finally:
+            if fetcher is not None:
+                fetcher.close()
+            progress.finish()
+            self.write_metrics()
+        self.log.info(u'warm-up done: records', writer.written, u'covers', fetcher.fetched if fetcher else 0)
 
     def is_configured(self):
         # type: () -> bool
@@ -237,6 +931,54 @@ class AmazonProductAdvertisingAPI(Source):
         """
 
         Source.save_settings(self, config_widget)
+        # credentials, domain, cache location or record format may have changed (the metadata_cache property follows the last two)
+        self._settings = None
+        if self._snapshot:
+            self._snapshot.close()
+        self._snapshot = None
+        self._amazonapi = None
+
+    def _prefetched_cover(self, identifiers):
+        """
+        :param identifiers: Dict: identifiers
+        :return: bytes or None: the cover saved by --warm-library/--warm-csv for this book
+        """
+        if not identifier_keys(identifiers):
+            return None
+        file_name = self.metadata_cache.find(identifiers)
+        return self.metadata_cache.read_cover(file_name) if file_name else None
+
+    def _lookup_cover_url(self, identifiers, abort, deadline):
+        """
+        Look the cover up with the cover-only ResponseGroup profile. The product is kept for identify to complete.
+        :param identifiers: Dict: identifiers
+        :return: unicode or None: cover URL, also cached for get_cached_cover_url
+        """
+        asin = identifiers.get(self.touched_field) or identifiers.get(u'mobi-asin')
+        isbn = identifiers.get(u'isbn')
+        if asin:
+            request = self._request(abort, deadline, profile=u'cover', ItemId=asin)
+        elif isbn:
+            request = self._request(abort, deadline, profile=u'cover', ItemId=isbn, IdType=u'ISBN', SearchIndex=self.settings.search_index)
+        else:
+            return None
+        try:
+            products = self.amazonapi.item_lookup(**request)
+        except AmazonException as e:
+            self.log.error(u'Cover lookup failed:', e.code, e.msg)
+            return None
+        for p in products:
+            if p.asin and p.large_image_url:
+                self.cache_identifier_to_cover_url(p.asin, p.large_image_url)
+                if not asin:
+                    self.cache_identifier_to_cover_url(isbn, p.large_image_url)
+                with self._partial_lock:
+                    self._partial_products.pop(p.asin, None)
+                    self._partial_products[p.asin] = p
+                    if len(self._partial_products) > 256:
+                        self._partial_products.popitem(last=False)
+                return p.large_image_url
+        return None
 
     def get_cached_cover_url(self, identifiers):  # {{{
         # type: (Dict) -> [Text or None]
@@ -329,63 +1071,297 @@ class AmazonProductAdvertisingAPI(Source):
         response = []  # type: Dict[Text,Text]
         if not identifiers: identifiers = {}
         if not authors: authors = []
+        deadline = time.time() + timeout
 
         # keep identifiers that can be of use
-        if identifiers.get(self.touched_field) or identifiers.get('mobi-asin') or identifiers.get(u'isbn'):
+        if identifier_keys(identifiers):
             try:
-                mi = self.get_cached_mi(identifier=identifiers.get(u'amazon')) or self.get_cached_mi(identifier=identifiers.get(u'isbn'))
+                mi = self.get_cached_mi(identifiers)
                 if mi:
-                    self.log.info('Found cached identifier for:', identifiers.get(self.touched_field) or identifiers.get('mobi-asin') or identifiers.get(u'isbn'))
+                    self.log.info('Found cached identifier for:', identifiers)
                     result_queue.put(mi)
                     return
-                if not self.prefs[u'DISABLE_API_CALLS']:
-                    response = self.identify_with_identifiers(identifiers)
+                if not self.api_calls_disabled():
+                    response = self.identify_with_identifiers(identifiers, abort=abort, deadline=deadline)
                 else:
                     return
+            except CancelledException as e:
+                self.log.info(u'identify cancelled:', e.code)
+                return
             except AmazonException as e:
                 self.log.error("AmazonException.Code:", e.code, ' Message:', e.msg)
             except Exception:
                 self.log.exception()
 
         # try to identify with author/title (either identify with identifiers failed or we never had identifiers to begin with)
-        if len(response) == 0 and title and not self.prefs[u'DISABLE_TITLE_AUTHOR_SEARCH']:
-            response = self.identify_with_title_and_authors(title=title, authors=authors)
+        if len(response) == 0 and title and not self.settings.disable_title_author_search:
+            cached = self.get_cached_search(title, authors)
+            if cached is not None:
+                self.log.info(u'Found cached search for:', title, authors)
+                query = self._relevance_query(title, authors, identifiers)
+                ranked = query.rank([self._cached_candidate(mi) for mi in cached])
+                for relevance, mi in enumerate(ranked):
+                    mi.source_relevance = relevance
+                    result_queue.put(mi)
+                return
+            mi = self.get_local_match(title, authors)
+            if mi is not None:
+                result_queue.put(mi)
+                return
+            if self.api_calls_disabled():
+                return
+            if abort.is_set():
+                return
+            response = self.identify_with_title_and_authors(title=title, authors=authors, abort=abort, deadline=deadline)
 
         # lookup and search both can potentially return a list of AmazonProducts
         try:
-            for r in response:
+            for relevance, r in enumerate(self.rank_products(response, title, authors, identifiers)):
                 if abort.is_set():
                     return
                 # noinspection PyTypeChecker
-                result_queue.put(self.AmazonProduct_to_Metadata(r))
-                return None
+                mi = self.AmazonProduct_to_Metadata(r)
+                mi.source_relevance = relevance
+                result_queue.put(mi)
         except Exception:
             self.log.exception()
 
-    def get_cached_mi(self, identifier):
+    def _cached_candidate(self, mi):
         """
-        :param identifier: unicode: identifier
-        :return:
+        :param mi: Metadata: a kept record
+        :return: RelevanceQuery.rank candidate; the trigrams are the match index's when it holds the record
+        """
+        ids = mi.get_identifiers()
+        grams = None
+        if self.settings.local_match_score and ids.get(self.touched_field):
+            # get_local_match keeps the index loaded
+            grams = self.metadata_cache.match_index().trigrams_of(unicode(ids[self.touched_field]) + u'.mi')
+        return mi, grams or candidate_trigrams(mi.title, mi.authors), identifier_keys(ids), getattr(mi, u'binding', None)
+
+    @staticmethod
+    def _product_trigrams(product):
         """
-        if not identifier: return None
-        persistentMI = os.path.join(self.prefs['METADATA_CACHE_LOCATION'], identifier + '.mi')
-        if os.path.isfile(persistentMI):
-            mi = get_metadata(open(persistentMI))[0]
+        :param product: AmazonProduct
+        :return: candidate_trigrams of its title and authors (its first creator when it has no author)
+        """
+        return candidate_trigrams(product.title or u'', list(product.authors) or [c[0] for c in product.creators[:1]])
+
+    def _relevance_query(self, title, authors, identifiers):
+        """
+        :return: RelevanceQuery: for the book identify was called with
+        """
+        return RelevanceQuery(title, authors, identifier_keys(identifiers or {}), prefer_kindle=self.settings.search_index == u'KindleStore')
+
+    def rank_products(self, products, title, authors, identifiers):
+        """
+        Order lookup/search results by title and author similarity, identifier agreement and binding (Kindle when SEARCH_INDEX is
+        KindleStore, print otherwise).
+        :param products: List[AmazonProduct]: in Amazon's order
+        :param title: AnyStr or None: title identify was called with
+        :param authors: List[AnyStr]: authors identify was called with
+        :param identifiers: Dict: identifiers identify was called with
+        :return: List[AmazonProduct]: best first
+        """
+        if len(products) < 2:
+            return list(products)
+        query = self._relevance_query(title, authors, identifiers)
+        candidates = []
+        for p in products:
+            keys = identifier_keys({u'amazon': p.asin, u'isbn': p.isbn, u'eisbn': p.eisbn, u'ean': p.ean})
+            candidates.append((p, self._product_trigrams(p), keys, p.binding))
+        return query.rank(candidates)
+
+    def get_cached_mi(self, identifiers):
+        """
+        Any of the identifiers (ASIN for any domain, mobi-asin, ISBN-10/13, EAN) finds the record.
+        Stale records are returned too, and queued for a background refresh.
+        :param identifiers: Dict[unicode, unicode]: calibre identifiers
+        :return: Metadata or None
+        """
+        keys = identifier_keys(identifiers)
+        if not keys: return None
+        snapshot = self.metadata_snapshot
+        if snapshot is not None:
+            for key in keys:
+                try:
+                    fetched = snapshot.fetched_at(key)
+                    if fetched is None:
+                        continue
+                    if self._is_stale(fetched):
+                        # the record file may already have been refreshed, the snapshot never is
+                        break
+                    mi = snapshot.get_metadata(key)
+                except Exception:
+                    self.log.exception(u'snapshot lookup failed for', key)
+                    break
+                if mi is not None:
+                    self.metrics.inc(u'cache_total', result=u'hit', cache=u'snapshot')
+                    return mi
+        file_name = self.metadata_cache.find(identifiers)
+        mi = self.metadata_cache.read(file_name) if file_name else None
+        self.metrics.inc(u'cache_total', result=u'miss' if mi is None else u'hit', cache=u'metadata')
+        if mi is not None and self._is_stale(self.metadata_cache.fetched_at(file_name)):
+            self._revalidate(mi, file_name)
+        return mi
+
+    def _search_key(self, title, authors):
+        """
+        :return: unicode: SearchCache key of a title/author search
+        """
+        return search_key(self.get_title_tokens(title), self.get_author_tokens(authors) if authors else (), u','.join(self.settings.search_indexes),
+                          self.settings.domain)
+
+    def get_cached_search(self, title, authors):
+        """
+        Answer a title/author search from an earlier identical one: its ASINs are resolved through the metadata cache.
+        :param title: AnyStr: title
+        :param authors: List[AnyStr]: authors
+        :return: List[Metadata] or None if the search was not made recently or one of its records is missing
+        """
+        asins = self.search_cache.get(self._search_key(title, authors))
+        if asins is None:
+            self.metrics.inc(u'cache_total', result=u'miss', cache=u'search')
+            return None
+        results = []
+        for asin in asins:
+            mi = self.get_cached_mi({self.touched_field: asin})
+            if mi is None:
+                self.metrics.inc(u'cache_total', result=u'miss', cache=u'search')
+                return None
+            results.append(mi)
+        self.metrics.inc(u'cache_total', result=u'hit', cache=u'search')
+        return results
+
+    def get_local_match(self, title, authors):
+        """
+        Fuzzy title/author match against the kept records (metadatacache.MetadataCache.match_index).
+        :param title: AnyStr: title
+        :param authors: List[AnyStr]: authors
+        :return: Metadata or None if no record scores LOCAL_MATCH_SCORE
+        """
+        threshold = self.settings.local_match_score
+        if not threshold:
+            return None
+        try:
+            matches = self.metadata_cache.match_index().query(title, authors, limit=3)
+        except Exception:
+            self.log.exception(u'local match failed for', title)
+            return None
+        for score, file_name in matches:
+            if score < threshold:
+                break
+            mi = self.metadata_cache.read(file_name)
+            if mi is None:
+                continue
+            self.log.info(u'Local match for', title, u':', file_name, u'score %.2f' % score)
+            # calibre ranks lower source_relevance first
+            mi.source_relevance = int(round((1 - score) * 100))
+            self.metrics.inc(u'cache_total', result=u'hit', cache=u'local_match')
+            if self._is_stale(self.metadata_cache.fetched_at(file_name)):
+                self._revalidate(mi, file_name)
             return mi
+        self.metrics.inc(u'cache_total', result=u'miss', cache=u'local_match')
         return None
 
-    def identify_with_title_and_authors(self, title, authors):
-        # type: (Text, List[Text]) -> List[AmazonProduct] or None
+    def _is_stale(self, fetched):
+        """
+        :param fetched: float or None: download time of a record
+        :return: bool: True if the record is older than METADATA_MAX_AGE_DAYS
+        """
+        max_age = self.settings.max_age
+        return bool(max_age) and fetched is not None and time.time() - fetched > max_age
+
+    def api_calls_disabled(self):
+        """
+        :return: bool: DISABLE_API_CALLS is set, or the circuit breaker is open after repeated API failures; either way only the
+                 metadata cache answers
+        """
+        if self.settings.disable_api_calls:
+            return True
+        if self.breaker.is_open():
+            self.log.info(u'API calls suspended, answering from the metadata cache only:', self.breaker.report())
+            return True
+        return False
+
+    def _revalidate(self, mi, file_name):
+        """
+        Queue a stale record for a background refresh.
+        :param mi: Metadata: the stale record
+        :param file_name: unicode: its file
+        """
+        if self.api_calls_disabled():
+            return
+        ids = mi.get_identifiers()
+        asin = ids.get(self.touched_field) or ids.get(u'amazon') or ids.get(u'mobi-asin')
+        if self.refresher.submit(asin, file_name):
+            self.metrics.inc(u'cache_total', result=u'stale', cache=u'metadata')
+
+    @property
+    def refresher(self):
+        """
+        :return: CacheRefresher: refreshes stale records in the background
+        """
+        if self._refresher is None:
+            self._refresher = CacheRefresher(self._refresh_records, log=self.log)
+        return self._refresher
+
+    def _refresh_records(self, batch):
+        """
+        Re-fetch a batch of records and rewrite them in place. Runs on the refresher thread.
+        :param batch: Dict[unicode, unicode]: ASIN -> record file name
+        :return: List[unicode]: the ASINs refreshed, the others are backed off
+        """
+        request = self.base_request
+        request.update({u'ItemId': u','.join(batch), u'IdType': u'ASIN', u'Priority': BACKGROUND})
+        refreshed = []
+        for p in self.amazonapi.item_lookup(**request):
+            file_name = batch.get(p.asin)
+            if file_name:
+                self.write_it(p, file_name, overwrite=True)
+                refreshed.append(p.asin)
+        return refreshed
+
+    @property
+    def metadata_snapshot(self):
+        """
+        :return: MetadataSnapshot or None if export-snapshot was never run for the cache location
+        """
+        if self._snapshot is None:
+            self._snapshot = False
+            metadatasnapshot = _plugin_module(u'metadatasnapshot')
+            path = self.metadata_cache.path(metadatasnapshot.SNAPSHOT)
+            if os.path.isfile(path):
+                try:
+                    self._snapshot = metadatasnapshot.MetadataSnapshot(path)
+                except Exception:
+                    self.log.exception(u'Could not open', path)
+        return self._snapshot or None
+
+    def export_snapshot(self):
+        """
+        Compile METADATA_CACHE_LOCATION into METADATA_CACHE_LOCATION/metadata.snapshot
+        """
+        if self._snapshot:
+            self._snapshot.close()
+        self._snapshot = None
+        metadatasnapshot = _plugin_module(u'metadatasnapshot')
+        records, keys = metadatasnapshot.compile_snapshot(self.metadata_cache, log=self.log)
+        self.log.info(u'snapshot:', self.metadata_cache.path(metadatasnapshot.SNAPSHOT), records, u'records', keys, u'keys')
+
+    def identify_with_title_and_authors(self, title, authors, abort=None, deadline=None):
+        # type: (Text, List[Text], Event, float) -> List[AmazonProduct] or None
         """
         :param title: AnyStr: title
         :param authors: List[AnyStr]: authors
+        :param abort: Event or None: see _request
+        :param deadline: float or None: see _request
         :return: List[AmazonProduct]: matching books (AmazonProducts)
         """
-        if self.prefs[u'DISABLE_TITLE_AUTHOR_SEARCH'] or not title:
+        if self.settings.disable_title_author_search or not title:
             return None
 
-        request = self.base_request.copy()
-        request.update({u'SearchIndex': self.prefs['SEARCH_INDEX']})
+        search_indexes = self.settings.search_indexes
+        request = self._request(abort, deadline, SearchIndex=search_indexes[0])
 
         title_tokens = u' '.join(self.get_title_tokens(title))
         if title_tokens:
@@ -398,36 +1374,85 @@ class AmazonProductAdvertisingAPI(Source):
 
         try:
             self.log.info('amazonapi:', request)
-            return self.amazonapi.item_search(**request)
+            if len(search_indexes) > 1:
+                # every index at once; the first confident match stops the others
+                query = self._relevance_query(title, authors, {})
+
+                def confident(found):
+                    return any(query.confident(self._product_trigrams(p)) for p in found)
 
+                del request[u'SearchIndex']
+                products = self.amazonapi.item_search_indexes(list(search_indexes), Accept=confident, **request)
+            else:
+                products = self.amazonapi.item_search(**request)
+            self._cache_search(title, authors, products)
+            return products
+
+        except CancelledException as e:
+            self.log.info(u'search cancelled:', e.code)
+            return []
         except AmazonException as e:
             self.log.error(u'AmazonException:', e.code, e.msg)
+            if e.code is not None and (unicode(e.code) == u'AWS.ECommerceService.NoExactMatches' or unicode(e.code) in _plugin_module(u'paapi5').NO_RESULTS):
+                self._cache_search(title, authors, [])
             return []
         except Exception:
             self.log.exception()
             return []
 
-    def identify_with_identifiers(self, identifiers):
-        # type: (Dict) -> List[AmazonProduct] or None
+    def _cache_search(self, title, authors, products):
+        """
+        Keep the products of a title/author search as metadata records, and the search as their ASINs.
+        :param products: List[AmazonProduct]: search results
+        """
+        if not self.search_cache.ttl:
+            return
+        try:
+            asins = []
+            for p in products:
+                if p.asin:
+                    self.write_it(p, unicode(p.asin) + u'.mi')
+                    asins.append(unicode(p.asin))
+            self.search_cache.put(self._search_key(title, authors), asins)
+        except Exception:
+            self.log.exception(u'Could not keep search results')
+
+    def identify_with_identifiers(self, identifiers, abort=None, deadline=None):
+        # type: (Dict, Event, float) -> List[AmazonProduct] or None
         """
         :param identifiers: Dict : identifiers
+        :param abort: Event or None: see _request
+        :param deadline: float or None: see _request
         """
         self.log.info('identify_with_identifiers', identifiers)
-        request = self.base_request.copy()
         asin = identifiers.get(self.touched_field) or identifiers.get(u'mobi-asin')
         isbn = identifiers.get(u'isbn')
 
+        def complete(products):
+            # fetch what a lighter profile left out
+            return self.amazonapi.upgrade(products, **self._request(abort, deadline))
+
+        cached_partial = None
         if asin:
-            request.update({u'ItemId': asin})
-        elif isbn:
-            request.update({u'ItemId': isbn, u'IdType': u'ISBN', u'SearchIndex': self.prefs['SEARCH_INDEX']})
+            with self._partial_lock:
+                cached_partial = self._partial_products.pop(asin, None)
+        if cached_partial is not None:
+            self.log.info('Completing:', asin)
+            response = complete([cached_partial])
         else:
-            return []
-        self.log.info('Item Lookup:', request)
-        response = self.amazonapi.item_lookup(**request)
+            if asin:
+                request = self._request(abort, deadline, ItemId=asin)
+            elif isbn:
+                # full profile: the products are kept unless one points to a Kindle edition, and completing a lighter
+                # profile would cost a second call whenever they are
+                request = self._request(abort, deadline, ItemId=isbn, IdType=u'ISBN', SearchIndex=self.settings.search_index)
+            else:
+                return []
+            self.log.info('Item Lookup:', request)
+            response = self.amazonapi.item_lookup(**request)
         response_kindle = [r for r in response if r.binding == u'Kindle Edition']
         if response_kindle:
-            return response_kindle
+            return complete(response_kindle)
 
         avasin = None
         for r in response:
@@ -440,11 +1465,11 @@ class AmazonProductAdvertisingAPI(Source):
 
         if avasin:
             try:
-                response_av_Kindle = self.identify_with_identifiers({u'amazon': avasin})
+                response_av_Kindle = self.identify_with_identifiers({u'amazon': avasin}, abort=abort, deadline=deadline)
                 return [r for r in response_av_Kindle]
             except:
-                return response
-        return response
+                pass
+        return complete(response)
 
     def _clean_title(self, title):
         # type: (Text) -> Text
@@ -488,15 +1513,12 @@ class AmazonProductAdvertisingAPI(Source):
                 creator_name, creator_role = product.creators[0]
                 authors_we_found = [creator_name]
 
-        try:
-            from calibre.utils.config import JSONConfig
-            plugin_prefs = JSONConfig('plugins/Quality Check')
-            from calibre_plugins.quality_check.config import STORE_OPTIONS, KEY_AUTHOR_INITIALS_MODE, AUTHOR_INITIALS_MODES
-            initials_mode = plugin_prefs[STORE_OPTIONS].get(KEY_AUTHOR_INITIALS_MODE, AUTHOR_INITIALS_MODES[0])
-            from quality_check.helpers import get_formatted_author_initials
-            authors_we_found = [get_formatted_author_initials(initials_mode, author) for author in authors_we_found]
-        except:
-            pass
+        author_formatter = self.settings.author_formatter
+        if author_formatter is not None:
+            try:
+                authors_we_found = [author_formatter(author) for author in authors_we_found]
+            except:
+                pass
 
         return authors_we_found
 
@@ -515,7 +1537,7 @@ class AmazonProductAdvertisingAPI(Source):
         isbn = product.ean or product.isbn or product.eisbn
         if isbn:
             try:
-                if _ISBNConvert.isI10(isbn): isbn = _ISBNConvert.convert(isbn)
+                if ISBNConvert.isI10(isbn): isbn = ISBNConvert.convert(isbn)
                 mi.set_identifier(u'isbn', isbn)
             except:
                 self.log.exception()
@@ -526,6 +1548,10 @@ class AmazonProductAdvertisingAPI(Source):
         if product.publisher:
             mi.publisher = product.publisher
 
+        if product.binding:
+            # not a calibre field: kept in binary records for ranking cached searches
+            mi.binding = product.binding
+
         if len(list(product.languages)) > 0:
             mi.languages = list(product.languages)
 
@@ -537,7 +1563,7 @@ class AmazonProductAdvertisingAPI(Source):
         if product.editorial_review:
             mi.comments = product.editorial_review
 
-        tags = set(self.prefs['TAGS_TO_ADD'].split(','))
+        tags = set(self.settings.tags_to_add)
         if len(product.browse_nodes) > 0:
             tags.update([p.name.text.lower() for p in product.browse_nodes if p.name and p.name.text])
 
@@ -572,153 +1598,43 @@ class AmazonProductAdvertisingAPI(Source):
         """
         # noinspection PyAttributeOutsideInit
         self.log = log
+        deadline = time.time() + timeout
+        cdata = self._prefetched_cover(identifiers)
+        if cdata:
+            self.log.info(u'Using prefetched cover')
+            result_queue.put((self, cdata))
+            return
+
         cached_url = self.get_cached_cover_url(identifiers)
+        if cached_url is None and not self.api_calls_disabled():
+            cached_url = self._lookup_cover_url(identifiers, abort, deadline)
         if cached_url is None:
+            remaining = max(0, deadline - time.time())
+            if abort.is_set() or not remaining:
+                return "abort"
             self.log.info(u'No cached cover found, running identify')
             try:
-                self.identify(self.log, result_queue, abort, title, authors, identifiers)
+                # identify's Metadata results do not belong on the cover queue; it only gets what is left of the timeout
+                self.identify(self.log, Queue(), abort, title, authors, identifiers, timeout=remaining)
                 cached_url = self.get_cached_cover_url(identifiers)
                 if cached_url is None:
                     return u'Download cover failed.  Could not identify.'
             except Exception as e:
                 return e.message
 
-        if abort.is_set():
+        remaining = deadline - time.time()
+        if abort.is_set() or remaining <= 0:
             return "abort"
 
         br = self.browser
         self.log.info(u'Downloading cover from:', cached_url)
         try:
-            cdata = br.open_novisit(cached_url, timeout=timeout).read()
+            cdata = br.open_novisit(cached_url, timeout=remaining).read()
             result_queue.put((self, cdata))
         except:
             self.log.error(u'Failed to download cover from:', cached_url)
             return u'Failed to download cover from:%s' % cached_url  # }}}
 
-class _ISBNConvert(object):
-
-    @staticmethod
-    def _isbn_strip(isbn):
-        """Strip whitespace, hyphens, etc. from an ISBN number and return
-    the result."""
-        short = re.sub(r"\W", "", isbn)
-        return re.sub(r"\D", "X", short)
-
-    @staticmethod
-    def convert(isbn):
-        """Convert an ISBN-10 to ISBN-13 or vice-versa."""
-        short = _ISBNConvert._isbn_strip(isbn)
-        if not _ISBNConvert.isValid(short):
-            raise Exception(u"Invalid ISBN")
-        if len(short) == 10:
-            stem = "978" + short[:-1]
-            return stem + _ISBNConvert._check(stem)
-        else:
-            if short[:3] == "978":
-                stem = short[3:-1]
-                return stem + _ISBNConvert._check(stem)
-            else:
-                raise Exception("ISBN not convertible")
-
-    @staticmethod
-    def isValid(isbn):
-        """Check the validity of an ISBN. Works for either ISBN-10 or ISBN-13."""
-        short = _ISBNConvert._isbn_strip(isbn)
-        if len(short) == 10:
-            return _ISBNConvert.isI10(short)
-        elif len(short) == 13:
-            return _ISBNConvert.isI13(short)
-        else:
-            return False
-
-    @staticmethod
-    def _check(stem):
-        """Compute the check digit for the stem of an ISBN. Works with either
-        the first 9 digits of an ISBN-10 or the first 12 digits of an ISBN-13."""
-        short = _ISBNConvert._isbn_strip(stem)
-        if len(short) == 9:
-            return _ISBNConvert.checkI10(short)
-        elif len(short) == 12:
-            return _ISBNConvert._checkI13(short)
-        else:
-            return False
-
-    @staticmethod
-    def checkI10(stem):
-        """Computes the ISBN-10 check digit based on the first 9 digits of a stripped ISBN-10 number."""
-        chars = list(stem)
-        sum_isbn = 0
-        digit = 10
-        for char in chars:
-            sum_isbn += digit * int(char)
-            digit -= 1
-        check = 11 - (sum_isbn % 11)
-        if check == 10:
-            return "X"
-        elif check == 11:
-            return "0"
-        else:
-            return str(check)
-
-    @staticmethod
-    def isI10(isbn):
-        """Checks the validity of an ISBN-10 number."""
-        short = _ISBNConvert._isbn_strip(isbn)
-        if len(short) != 10:
-            return False
-        chars = list(short)
-        sum_isbn = 0
-        digit = 10
-        for char in chars:
-            if char == 'X' or char == 'x':
-                char = "10"
-            sum_isbn += digit * int(char)
-            digit -= 1
-        remainder = sum_isbn % 11
-        if remainder == 0:
-            return True
-        else:
-            return False
-
-    @staticmethod
-    def _checkI13(stem):
-        """Compute the ISBN-13 check digit based on the first 12 digits of a stripped ISBN-13 number. """
-        chars = list(stem)
-        sumisbn = 0
-        count = 0
-        for char in chars:
-            if count % 2 == 0:
-                sumisbn += int(char)
-            else:
-                sumisbn += 3 * int(char)
-            count += 1
-        check = 10 - (sumisbn % 10)
-        if check == 10:
-            return "0"
-        else:
-            return str(check)
-
-    @staticmethod
-    def isI13(isbn):
-        """Checks the validity of an ISBN-13 number."""
-        short = _ISBNConvert._isbn_strip(isbn)
-        if len(short) != 13:
-            return False
-        chars = list(short)
-        sum_isbn = 0
-        count = 0
-        for char in chars:
-            if count % 2 == 0:
-                sum_isbn += int(char)
-            else:
-                sum_isbn += 3 * int(char)
-            count += 1
-        remainder = sum_isbn % 10
-        if remainder == 0:
-            return True
-        else:
-            return False
-
 if __name__ == u'__main__':  # tests {{{
     # To run these test use: calibre-debug
     # src/calibre/ebooks/metadata/sources/amazon.py
@@ -22,15 +22,37 @@ AmazonSimpleProductAPI
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import os
+import threading
+import time
 
-# noinspection PyUnresolvedReferences
-from lxml import etree, objectify
-from lxml.etree import Element
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from queue import Queue, Empty
+
+# lxml is imported where it is first needed (AmazonAPI.__init__, _LXMLWrapper.to_string) so that
+# importing this module, which the calibre plugin does at startup, stays cheap.
 
 try:
     from .bottlenose import *
 except:
-    execfile(str('bottlenose.py'))
+    try:
+        # noinspection PyUnresolvedReferences
+        from bottlenose import *
+    except ImportError:
+        execfile(str('bottlenose.py'))
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.circuitbreaker import FATAL_CODES
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from circuitbreaker import FATAL_CODES
+
+#: ResponseGroups to ask for, by purpose. A product fetched with a smaller profile can be completed with
+#: AmazonAPI.upgrade, which only asks for the groups it lacks.
+RESPONSE_PROFILES = {u'cover': u'Images', u'identity': u'AlternateVersions,ItemAttributes',
+                     u'full': u'AlternateVersions,BrowseNodes,EditorialReview,Images,ItemAttributes'}
 
 # try:
 #     # noinspection PyUnresolvedReferences
@@ -107,6 +129,45 @@ class BrowseNodeLookupException(AmazonException):
     def __init__(self, code=None, msg=None):
         super(BrowseNodeLookupException, self).__init__(code, msg)
 
+class CancelledException(AmazonException):
+    """The request was aborted, ran out of time or found no request quota left (code is 'abort', 'deadline' or 'quota').
+    """
+
+    def __init__(self, code=None, msg=None):
+        super(CancelledException, self).__init__(code, msg)
+
+class CircuitOpenException(AmazonException):
+    """The circuit breaker refused the call: the API failed repeatedly (code is 'circuit_open').
+    """
+
+    def __init__(self, code=None, msg=None):
+        super(CircuitOpenException, self).__init__(code, msg)
+
+class _HedgeAbort(object):
+    """
+    Abort for one of several concurrent calls (copies of a hedged call, searches of item_search_indexes): set when its answer
+    is no longer needed, or when the caller's Abort is.
+    """
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.event = threading.Event()
+
+    def set(self):
+        self.event.set()
+
+    def is_set(self):
+        return self.event.is_set() or (self.parent is not None and self.parent.is_set())
+
+    def wait(self, timeout):
+        end = time.time() + timeout
+        while not self.is_set():
+            remaining = end - time.time()
+            if remaining <= 0:
+                break
+            self.event.wait(min(remaining, 0.05))
+        return self.is_set()
+
 class AmazonAPI(object):
     """
     Used to call Amazon API
@@ -117,8 +178,8 @@ class AmazonAPI(object):
 
     # noinspection PyTypeChecker
     def __init__(self, aws_key=os.environ.get(u'AWS_ACCESS_KEY_ID'), aws_secret=os.environ.get(u'AWS_SECRET_ACCESS_KEY'), aws_associate_tag=os.environ.get(u'AWS_ASSOCIATE_TAG'),
-                 MaxQPS=None, Timeout=None, CacheReader=None, CacheWriter=None, **kwargs):
-        # type: (unicode, unicode, unicode, float, int, object, object, dict) -> AmazonAPI
+                 MaxQPS=None, Timeout=None, CacheReader=None, CacheWriter=None, Metrics=None, Hedge=None, HedgeBudget=0.1, Breaker=None, **kwargs):
+        # type: (unicode, unicode, unicode, float, int, object, object, ApiMetrics, dict) -> AmazonAPI
         """Initialize an BottlenoseAmazon API Proxy.
 
         kwargs values are passed directly to Bottlenose. Check the Bottlenose
@@ -158,21 +219,130 @@ class AmazonAPI(object):
             takes two arguments, the same URL passed to
             CacheReader, and the (unparsed) API response.
             Defaults to None.
+        :param Metrics:
+            Optional apimetrics.ApiMetrics receiving per-request timings
+            (including the objectify parse), cache hits and error codes.
+            Defaults to None.
+        :param Hedge:
+            Optional latency quantile (0.95 for instance). A request that has
+            not answered after that quantile of the region's response times
+            is sent a second time, and the first answer wins. The duplicate
+            only goes out if the MaxQPS rate limiter has a free slot and
+            HedgeBudget allows it. The latencies come from Metrics, which is
+            created if not given.
+            Defaults to None (no hedging).
+        :param HedgeBudget:
+            Most duplicates sent, as a fraction of the requests.
+            Defaults to 0.1.
+        :param Quota:
+            Optional quotaledger.QuotaLedger (passed to Bottlenose in kwargs):
+            every request sent takes a unit from it.
+            Defaults to None.
+        :param Scheduler:
+            Optional scheduler.RequestScheduler (passed to Bottlenose in
+            kwargs) handing out the MaxQPS slots by request Priority.
+            Defaults to None.
+        :param Breaker:
+            Optional circuitbreaker.CircuitBreaker. Every request goes through
+            it; while it is open, requests raise CircuitOpenException at once.
+            Defaults to None.
         """
-        kwargs.update({u'MaxQPS': MaxQPS, u'Timeout': Timeout, u'CacheReader': CacheReader, u'CacheWriter': CacheWriter})
+        from lxml import objectify
+        if Hedge and Metrics is None:
+            try:
+                from calibre_plugins.AmazonProductAdvertisingAPI.apimetrics import ApiMetrics
+            except ImportError:
+                # noinspection PyUnresolvedReferences
+                from apimetrics import ApiMetrics
+            Metrics = ApiMetrics()
+        self.breaker = Breaker
+        self.hedge = Hedge
+        self.hedge_budget = HedgeBudget
+        self._hedge_lock = threading.Lock()
+        self._hedge_calls = 0
+        self._hedges = 0
+        kwargs.update({u'MaxQPS': MaxQPS, u'Timeout': Timeout, u'CacheReader': CacheReader, u'CacheWriter': CacheWriter, u'Metrics': Metrics,
+                       u'Parser': objectify.fromstring})
+        self.metrics = Metrics
         self.api = BottlenoseAmazon(AWSAccessKeyId=aws_key, AWSSecretAccessKey=aws_secret, AssociateTag=aws_associate_tag, **kwargs)
 
-    def item_lookup(self, ItemId, IdType=u'ASIN', ResponseGroup=u'Large', **kwargs):
-        # type: (unicode, unicode, unicode, dict) -> list(AmazonProduct)
+    def item_lookup(self, ItemId, IdType=u'ASIN', ResponseGroup=u'Large', Profile=None, **kwargs):
+        # type: (unicode, unicode, unicode, unicode, dict) -> list(AmazonProduct)
         """Lookup an BottlenoseAmazon Product.
         :param ItemId: A single ItemId
         :param IdType: One of ASIN, SKU, EAN, UPC or ISBN
         :param ResponseGroup: Response group
+        :param Profile: a RESPONSE_PROFILES name, replaces ResponseGroup
         :return:List[AmazonProduct]:List of Amazon Products
         """
+        if Profile:
+            ResponseGroup = RESPONSE_PROFILES[Profile]
         kwargs.update({u'ItemId': unicode(ItemId), u'IdType': unicode(IdType), u'ResponseGroup': unicode(ResponseGroup), u'Operation': u'ItemLookup'})
         return self._search(**kwargs)
 
+    def item_lookup_raw(self, ItemId, IdType=u'ASIN', ResponseGroup=u'Large', **kwargs):
+        # type: (unicode, unicode, unicode, dict) -> bytes
+        """Same request as item_lookup, without parsing: the fetch loop of a bulk run only does network I/O
+        and hands the bytes to parse_products, possibly in another process.
+
+        :return: bytes: the response XML
+        """
+        kwargs.update({u'ItemId': unicode(ItemId), u'IdType': unicode(IdType), u'ResponseGroup': unicode(ResponseGroup), u'Operation': u'ItemLookup',
+                       u'Parse': False})
+        try:
+            return self._send(**kwargs)
+        except RequestCancelled as e:
+            raise CancelledException(e.reason, u'ItemLookup cancelled')
+
+    def upgrade(self, products, Profile=u'full', **kwargs):
+        # type: (list[AmazonProduct], unicode, dict) -> list[AmazonProduct]
+        """Complete products fetched with a smaller profile: only the ResponseGroups they lack are requested
+        (10 ASINs per ItemLookup) and grafted onto them.
+
+        :param products: List[AmazonProduct]
+        :param Profile: a RESPONSE_PROFILES name
+        :param kwargs: other request parameters (Timeout, Deadline, Abort...)
+        :return: List[AmazonProduct]: the same products
+        """
+        kwargs.pop(u'ResponseGroup', None)
+        kwargs.pop(u'IdType', None)
+        kwargs.pop(u'SearchIndex', None)
+        todo = [p for p in products if p.asin and p.missing_groups(Profile)]
+        for x in range(0, len(todo), 10):
+            chunk = todo[x:x + 10]
+            missing = sorted(set().union(*[p.missing_groups(Profile) for p in chunk]))
+            fetched = dict((f.asin, f) for f in self.item_lookup(u','.join(p.asin for p in chunk), ResponseGroup=u','.join(missing), **kwargs))
+            for p in chunk:
+                if p.asin in fetched:
+                    p.merge(fetched[p.asin])
+        return products
+
+    @staticmethod
+    def parse_products(raw, metrics=None, request=None):
+        # type: (bytes, ApiMetrics, dict) -> list[AmazonProduct]
+        """
+        :param raw: bytes: response XML, or its objectify root
+        :param metrics: ApiMetrics or None: receives the API error, if any
+        :param request: Dict or None: the request, for the error event and the products' response_groups
+        :return: List[AmazonProduct]
+        :raise SearchException: when the response is an error
+        """
+        if isinstance(raw, bytes):
+            from lxml import objectify
+            root = objectify.fromstring(raw)
+        else:
+            root = raw
+        if root.Items.Request.IsValid == u'False' or not hasattr(root.Items, u'Item'):
+            code = root.Items.Request.Errors.Error.Code
+            msg = root.Items.Request.Errors.Error.Message
+            if metrics:
+                metrics.inc(u'api_errors_total', code=code.text, operation=(request or {}).get(u'Operation'))
+                metrics.emit(u'api_error', code=code.text, msg=msg.text, request=request)
+            raise SearchException(code, msg)
+        groups = (request or {}).get(u'ResponseGroup')
+        # noinspection PyUnresolvedReferences
+        return [AmazonProduct(item, groups.split(u',') if groups else None) for item in root.Items.Item]
+
     def item_search(self, ResponseGroup=u'Large', **kwargs):
         # type: (unicode, dict) -> list[AmazonProduct]
         """Seach
@@ -184,20 +354,194 @@ class AmazonAPI(object):
         kwargs.update({u'Operation': u'ItemSearch', u'ResponseGroup': unicode(ResponseGroup)})
         return self._search(**kwargs)
 
+    def item_search_indexes(self, SearchIndexes, Accept=None, **kwargs):
+        # type: (list[unicode], callable, dict) -> list[AmazonProduct]
+        """The same item_search in several SearchIndexes at once. The searches share the MaxQPS rate limit, so they go
+        out one slot after the other.
+
+        :param SearchIndexes: List[unicode]: KindleStore, Books...
+        :param Accept: callable(List[AmazonProduct]) -> bool or None: called with each search's results as they arrive;
+            True stops the searches still running
+        :param kwargs: item_search parameters, Abort and Deadline included
+        :return: List[AmazonProduct]: the results of the searches that completed, in SearchIndexes order, without the
+            products already listed (same ASIN, or an alternate version of one)
+        :raise AmazonException: the first search's error, when no search found anything
+        """
+        results = Queue()
+        aborts = [_HedgeAbort(kwargs.get(u'Abort')) for _ in SearchIndexes]
+
+        def run(i):
+            try:
+                results.put((i, self.item_search(**dict(kwargs, SearchIndex=SearchIndexes[i], Abort=aborts[i]))))
+            except Exception as e:
+                results.put((i, e))
+
+        for i in range(len(SearchIndexes)):
+            thread = threading.Thread(target=run, args=(i,), name=str('AmazonAPISearch'))
+            thread.daemon = True
+            thread.start()
+        answers = {}
+        try:
+            while len(answers) < len(SearchIndexes):
+                i, answer = results.get()
+                answers[i] = answer
+                if Accept is not None and not isinstance(answer, Exception) and Accept(answer):
+                    break
+        finally:
+            for abort in aborts:
+                abort.set()
+        products = []
+        seen = set()
+        for i in sorted(answers):
+            if isinstance(answers[i], Exception):
+                continue
+            for p in answers[i]:
+                links = set([p.asin] + [av.get(u'asin') for av in p.alternate_versions]) - set([None])
+                if links.isdisjoint(seen):
+                    products.append(p)
+                seen.update(links)
+        if not products:
+            errors = [answers[i] for i in sorted(answers) if isinstance(answers[i], Exception)]
+            # a search that did not finish (cancelled, timed out...) says nothing about its index: raise that first
+            errors.sort(key=lambda e: isinstance(e, AmazonException) and not isinstance(e, CancelledException))
+            if errors:
+                raise errors[0]
+        return products
+
     def _search(self, **kwargs):
-        response = self.api.call_api(**kwargs)
-        root = objectify.fromstring(response)
-        if root.Items.Request.IsValid == u'False':
-            code = root.Items.Request.Errors.Error.Code
-            msg = root.Items.Request.Errors.Error.Message
-            raise SearchException(code, msg)
-        elif not hasattr(root.Items, u'Item'):
-            code = root.Items.Request.Errors.Error.Code
-            msg = root.Items.Request.Errors.Error.Message
-            raise SearchException(code, msg)
-        else:
-            # noinspection PyUnresolvedReferences
-            return [AmazonProduct(item) for item in root.Items.Item]
+        """
+        kwargs may also hold Timeout, Deadline (a time.time() value) and Abort (a threading.Event), see
+        BottlenoseAmazon.call_api; a call they end raises CancelledException.
+        """
+        try:
+            root = self._send(**kwargs)
+        except RequestCancelled as e:
+            raise CancelledException(e.reason, u'%s cancelled' % kwargs.get(u'Operation'))
+        try:
+            return self.parse_products(root, self.metrics, kwargs)
+        except SearchException as e:
+            if self.breaker is not None and e.code is not None and unicode(e.code) in FATAL_CODES:
+                self.breaker.record_failure(e.code)
+            raise
+
+    def _send(self, **kwargs):
+        """
+        call_api, hedged when Hedge is set, through the circuit breaker when there is one.
+        :raise CircuitOpenException: the breaker is open
+        """
+        breaker = self.breaker
+        if breaker is None:
+            return self._hedged_call(**kwargs) if self.hedge else self.api.call_api(**kwargs)
+        if not breaker.allow():
+            raise CircuitOpenException(u'circuit_open', u'API calls suspended after repeated failures (last error: %s)' % breaker.last_error)
+        try:
+            response = self._hedged_call(**kwargs) if self.hedge else self.api.call_api(**kwargs)
+        except RequestCancelled:
+            breaker.release()
+            raise
+        except Exception as e:
+            code = getattr(e, 'code', None)
+            if isinstance(code, int) and code < 500 and code not in (401, 403, 429):
+                # the API answered, the request was wrong
+                breaker.record_success()
+            else:
+                breaker.record_failure(code or type(e).__name__)
+            raise
+        breaker.record_success()
+        return response
+
+    #: Samples needed before hedging starts, and the shortest delay before a duplicate is sent (seconds)
+    HEDGE_MIN_SAMPLES = 20
+    HEDGE_MIN_DELAY = 0.05
+
+    def _hedge_delay(self):
+        """
+        :return: float or None: how long to wait for an answer before sending a duplicate, None while there are too few samples
+        """
+        region = self.api.Region
+        if self.metrics.count(u'response_seconds', region=region) < self.HEDGE_MIN_SAMPLES:
+            return None
+        return max(self.metrics.quantile(u'response_seconds', self.hedge, region=region), self.HEDGE_MIN_DELAY)
+
+    def _take_hedge_slot(self):
+        """
+        Take a rate limiter slot for a duplicate, if one is free now and the budget allows it.
+        :return: bool
+        """
+        with self._hedge_lock:
+            if self._hedges >= self.hedge_budget * self._hedge_calls:
+                return False
+            if self.api.Scheduler is not None:
+                if not self.api.Scheduler.try_acquire():
+                    return False
+                self._hedges += 1
+                return True
+            if not self.api.try_throttle_slot():
+                return False
+            self._hedges += 1
+            return True
+
+    def _hedged_call(self, **kwargs):
+        """
+        call_api, with a duplicate request sent when the first one is slower than the Hedge quantile.
+        """
+        with self._hedge_lock:
+            self._hedge_calls += 1
+        results = Queue()
+        aborts = []
+
+        def start(**extra):
+            copy = len(aborts)
+            abort = _HedgeAbort(kwargs.get(u'Abort'))
+            aborts.append(abort)
+            call = dict(kwargs, Abort=abort, **extra)
+
+            def run():
+                try:
+                    results.put((copy, True, self.api.call_api(**call)))
+                except Exception as e:
+                    results.put((copy, False, e))
+
+            thread = threading.Thread(target=run, name=str('AmazonAPIHedge'))
+            thread.daemon = True
+            thread.start()
+
+        region = self.api.Region
+        sent = threading.Event()
+        start(Sent=sent)
+        try:
+            # the delay runs from when the request went out, not from before its throttle wait
+            while not sent.is_set() and results.empty():
+                sent.wait(0.05)
+            delay = self._hedge_delay()
+            if delay is not None:
+                if kwargs.get(u'Deadline') is not None:
+                    delay = min(delay, max(kwargs[u'Deadline'] - time.time(), 0))
+                try:
+                    copy, ok, value = results.get(timeout=delay)
+                    if ok:
+                        return value
+                    raise value
+                except Empty:
+                    pass
+                if self._take_hedge_slot():
+                    self.metrics.inc(u'hedges_total', result=u'sent', region=region)
+                    start(Throttle=False)
+                else:
+                    self.metrics.inc(u'hedges_total', result=u'skipped', region=region)
+            error = None
+            for _ in aborts:
+                copy, ok, value = results.get()
+                if ok:
+                    if copy:
+                        self.metrics.inc(u'hedges_total', result=u'won', region=region)
+                    return value
+                error = error or value
+            raise error
+        finally:
+            # stop whichever copy is still running
+            for abort in aborts:
+                abort.set()
 
 class _LXMLWrapper(object):
     def __init__(self, parsed_response):
@@ -209,6 +553,7 @@ class _LXMLWrapper(object):
         :return:
             A string representation of the Item xml.
         """
+        from lxml import etree
         return etree.tostring(self.parsed_response, pretty_print=True)
 
     def _safe_get_element(self, path, root=None):
@@ -233,7 +578,7 @@ class _LXMLWrapper(object):
         return getattr(parent, elements[-1], None)
 
     def _safe_get_element_text(self, path, root=None):
-        # type: (Element, [unicode or None]) -> unicode or None
+        # type: (lxml.etree.Element, [unicode or None]) -> unicode or None
         """Safe get element text.
 
         Get element as string or None,
@@ -345,8 +690,41 @@ class AmazonProduct(_LXMLWrapper):
     """
 
     # noinspection PyUnusedLocal
-    def __init__(self, item):
+    def __init__(self, item, response_groups=None):
+        """
+        :param item: the Item element
+        :param response_groups: Iterable[unicode] or None: the ResponseGroups it was fetched with, None if unknown
+        """
         super(AmazonProduct, self).__init__(item)
+        if response_groups is not None:
+            response_groups = set(response_groups)
+            if u'Large' in response_groups:
+                # Large includes every group of the profiles
+                response_groups.update(RESPONSE_PROFILES[u'full'].split(u','))
+            response_groups = frozenset(response_groups)
+        self.response_groups = response_groups
+
+    def missing_groups(self, profile=u'full'):
+        """
+        :param profile: unicode: a RESPONSE_PROFILES name
+        :return: FrozenSet[unicode]: ResponseGroups of the profile this product was not fetched with (none if unknown)
+        """
+        if self.response_groups is None:
+            return frozenset()
+        return frozenset(RESPONSE_PROFILES[profile].split(u',')) - self.response_groups
+
+    def merge(self, other):
+        """Add the elements of another copy of this product that this one lacks, e.g. the rest of a full profile.
+
+        :param other: AmazonProduct: same ASIN, fetched with other ResponseGroups
+        """
+        for child in list(other.parsed_response.iterchildren()):
+            if self.parsed_response.find(child.tag) is None:
+                self.parsed_response.append(child)
+        if self.response_groups is not None and other.response_groups is not None:
+            self.response_groups = self.response_groups | other.response_groups
+        else:
+            self.response_groups = None
 
     def __str__(self):
         """Return redable representation.
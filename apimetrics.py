@@ -0,0 +1,247 @@
+"""
+ApiMetrics
+"""
+# coding=utf-8
+#
+# Per-request timings, counters and histograms for the Amazon API clients.
+#
+# A single ApiMetrics object is shared by AmazonAPI, every _BottlenoseAmazonCall
+# derived from it and the calibre plugin. Each API request is reported once, as
+# a dictionary of stage timings (quota, throttle, connect, ttfb, download, decompress,
+# parse), plus cache hit/miss and error counters. The collected values can be
+# written to a file (Prometheus text or JSON) or served over HTTP so that long
+# batch runs can be scraped while they are running.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os
+import threading
+import time
+
+try:
+    unicode
+except NameError:
+    # noinspection PyShadowingBuiltins
+    unicode = str
+
+#: The stages of a single API request, in the order they happen.
+REQUEST_STAGES = (u'quota', u'throttle', u'connect', u'ttfb', u'download', u'decompress', u'parse')
+
+class ApiMetrics(object):
+    """Thread-safe counters and latency histograms.
+
+    Listeners added with :meth:`add_listener` are called with
+    ``(event_name, fields)`` for every event; they must be quick and must not
+    raise.
+    """
+    #: Histogram bucket upper bounds, in seconds.
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    PREFIX = u'amazonapi_'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._listeners = []
+        self.started = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, unicode(v)) for k, v in labels.items() if v is not None))
+
+    def add_listener(self, listener):
+        """
+        :param listener: callable(event_name, fields)
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """
+        :param listener: a callable previously passed to add_listener
+        """
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def emit(self, event, **fields):
+        """Send an event to every listener.
+
+        :param event: unicode: event name
+        :param fields: event payload
+        """
+        for listener in list(self._listeners):
+            try:
+                listener(event, fields)
+            except Exception:
+                pass
+
+    def inc(self, name, value=1, **labels):
+        """Increment a counter.
+
+        :param name: unicode: counter name
+        :param value: int or float: increment
+        :param labels: Prometheus labels
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """Add a sample to a histogram.
+
+        :param name: unicode: histogram name
+        :param seconds: float: sample value
+        :param labels: Prometheus labels
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # one slot per bucket plus +Inf, then sum
+                histogram = self._histograms[key] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[len(self.BUCKETS)] += 1
+            histogram[-1] += seconds
+
+    def record_request(self, operation, region, timings, cache=None, error=None):
+        """Record one API request.
+
+        :param operation: unicode: ItemLookup, ItemSearch...
+        :param region: unicode: US, CA...
+        :param timings: Dict[unicode, float]: seconds spent in each of REQUEST_STAGES
+        :param cache: unicode or None: u'hit' or u'miss' if a cache was consulted
+        :param error: unicode or None: HTTP status or exception name if the request failed
+        """
+        for stage, seconds in timings.items():
+            self.observe(u'request_stage_seconds', seconds, stage=stage, operation=operation, region=region)
+        self.observe(u'request_seconds', sum(timings.values()), operation=operation, region=region)
+        if not error and cache != u'hit':
+            # network time alone, what AmazonAPI's hedging delay is derived from
+            self.observe(u'response_seconds', sum(timings.get(s, 0.0) for s in (u'connect', u'ttfb', u'download')), region=region)
+        self.inc(u'requests_total', operation=operation, region=region)
+        if cache:
+            self.inc(u'cache_total', result=cache, cache=u'response')
+        if error:
+            self.inc(u'errors_total', code=error, operation=operation, region=region)
+        self.emit(u'request', operation=operation, region=region, timings=timings, cache=cache, error=error)
+
+    def count(self, name, **labels):
+        """
+        :param name: unicode: histogram name
+        :return: int: number of samples
+        """
+        with self._lock:
+            histogram = self._histograms.get(self._key(name, labels))
+            return histogram[len(self.BUCKETS)] if histogram is not None else 0
+
+    def quantile(self, name, q, **labels):
+        """Estimate a quantile from a histogram, by linear interpolation inside the bucket.
+
+        :param name: unicode: histogram name
+        :param q: float: 0 < q < 1
+        :return: float or None if there are no samples
+        """
+        with self._lock:
+            histogram = self._histograms.get(self._key(name, labels))
+            if histogram is None or not histogram[len(self.BUCKETS)]:
+                return None
+            histogram = list(histogram)
+        rank = q * histogram[len(self.BUCKETS)]
+        lower = 0.0
+        previous = 0
+        for i, bound in enumerate(self.BUCKETS):
+            if histogram[i] >= rank:
+                in_bucket = histogram[i] - previous
+                return lower + (bound - lower) * ((rank - previous) / in_bucket if in_bucket else 1.0)
+            lower, previous = bound, histogram[i]
+        return self.BUCKETS[-1]
+
+    def snapshot(self):
+        """
+        :return: Dict: a JSON serializable copy of every counter and histogram
+        """
+        with self._lock:
+            counters = [{u'name': name, u'labels': dict(labels), u'value': value} for (name, labels), value in sorted(self._counters.items())]
+            histograms = [{u'name': name, u'labels': dict(labels), u'buckets': dict(zip([unicode(b) for b in self.BUCKETS] + [u'+Inf'], h[:-1])), u'sum': h[-1]} for
+                          (name, labels), h in sorted(self._histograms.items())]
+        return {u'started': self.started, u'uptime': time.time() - self.started, u'counters': counters, u'histograms': histograms}
+
+    def to_prometheus(self):
+        """
+        :return: unicode: every metric in the Prometheus text exposition format
+        """
+
+        def fmt_labels(labels, extra=None):
+            labels = list(labels) + ([extra] if extra else [])
+            if not labels:
+                return u''
+            return u'{' + u','.join(u'%s="%s"' % (k, v.replace(u'\\', u'\\\\').replace(u'"', u'\\"')) for k, v in labels) + u'}'
+
+        lines = []
+        with self._lock:
+            seen = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in seen:
+                    seen.add(name)
+                    lines.append(u'# TYPE %s%s counter' % (self.PREFIX, name))
+                lines.append(u'%s%s%s %s' % (self.PREFIX, name, fmt_labels(labels), value))
+            for (name, labels), h in sorted(self._histograms.items()):
+                if name not in seen:
+                    seen.add(name)
+                    lines.append(u'# TYPE %s%s histogram' % (self.PREFIX, name))
+                for bound, count in zip([unicode(b) for b in self.BUCKETS] + [u'+Inf'], h[:-1]):
+                    lines.append(u'%s%s_bucket%s %d' % (self.PREFIX, name, fmt_labels(labels, (u'le', bound)), count))
+                lines.append(u'%s%s_sum%s %.6f' % (self.PREFIX, name, fmt_labels(labels), h[-1]))
+                lines.append(u'%s%s_count%s %d' % (self.PREFIX, name, fmt_labels(labels), h[len(self.BUCKETS)]))
+        return u'\n'.join(lines) + u'\n'
+
+    def write(self, path):
+        """Atomically write the metrics to path. JSON if path ends with .json, Prometheus text otherwise.
+
+        :param path: unicode: destination file
+        """
+        if path.endswith(u'.json'):
+            data = json.dumps(self.snapshot(), indent=1, sort_keys=True)
+        else:
+            data = self.to_prometheus()
+        tmp = path + u'.tmp'
+        with open(tmp, str('wb')) as f:
+            f.write(data.encode('utf-8'))
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp, path)
+
+    def serve(self, port, host=u'127.0.0.1'):
+        """Serve the Prometheus text format on http://host:port/metrics from a daemon thread.
+
+        :param port: int: TCP port
+        :param host: unicode: interface to bind
+        :return: HTTPServer: call shutdown() on it to stop serving
+        """
+        try:
+            # noinspection PyCompatibility
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        except ImportError:
+            # noinspection PyUnresolvedReferences,PyCompatibility
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+        metrics = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header(str('Content-Type'), str('text/plain; version=0.0.4'))
+                self.send_header(str('Content-Length'), str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer((str(host), int(port)), _Handler)
+        thread = threading.Thread(target=server.serve_forever, name=str('ApiMetricsServer'))
+        thread.daemon = True
+        thread.start()
+        return server
@@ -0,0 +1,205 @@
+"""
+BatchProfile
+"""
+# coding=utf-8
+#
+# Profiling of cli_main batch runs.
+#
+# A BatchProfiler splits a run into named pipeline stages (ingest, request,
+# parse, convert, write). While it is enabled it
+#
+#  * runs one cProfile.Profile per stage, so the summary shows where each stage
+#    spends its time, and
+#  * samples the stack of the profiled thread every `interval` seconds, prefixed
+#    with the current stage, and writes the samples in the folded-stack format
+#    understood by flamegraph.pl, speedscope and inferno.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import io
+import os
+import sys
+import threading
+import time
+
+#: The stages a batch run is split into.
+STAGES = (u'ingest', u'request', u'parse', u'convert', u'write')
+
+#: Functions from these files are listed in the hot function summary.
+SUMMARY_FILES = (u'amazonsimpleproductapi.py', u'__init__.py')
+
+class _Stage(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._push(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler._pop()
+        return False
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class BatchProfiler(object):
+    """
+    Per-stage cProfile collection and stack sampling for a single thread.
+    When enabled is False every method is a cheap no-op.
+    """
+
+    def __init__(self, enabled=False, interval=0.005):
+        self.enabled = enabled
+        self.interval = interval
+        self.profiles = {}
+        self.stage_seconds = {}
+        self.folded = {}
+        self._stack = []
+        self._entered = []
+        self._thread_id = None
+        self._sampler = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Start sampling the calling thread."""
+        if not self.enabled or self._sampler:
+            return
+        self._thread_id = threading.current_thread().ident
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample_loop, name=str('BatchProfilerSampler'))
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def stop(self):
+        """Stop sampling and close any open stage."""
+        if not self.enabled:
+            return
+        while self._stack:
+            self._pop()
+        if self._sampler:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+
+    def stage(self, name):
+        """
+        :param name: unicode: one of STAGES
+        :return: a context manager that attributes the time spent inside it to name
+        """
+        if not self.enabled or threading.current_thread().ident != self._thread_id:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def wrap(self, name, func):
+        """
+        :param name: unicode: stage name
+        :param func: callable
+        :return: func, running inside stage name
+        """
+        if not self.enabled or func is None:
+            return func
+
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def _push(self, name):
+        now = time.time()
+        if self._stack:
+            self._leave(self._stack[-1], now)
+        self._stack.append(name)
+        self._enter(name, now)
+
+    def _pop(self):
+        now = time.time()
+        self._leave(self._stack.pop(), now)
+        if self._stack:
+            self._enter(self._stack[-1], now)
+
+    def _enter(self, name, now):
+        profile = self.profiles.get(name)
+        if profile is None:
+            import cProfile
+            profile = self.profiles[name] = cProfile.Profile()
+        self._entered.append(now)
+        profile.enable()
+
+    def _leave(self, name, now):
+        self.profiles[name].disable()
+        self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + now - self._entered.pop()
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            stage = self._stack[-1] if self._stack else u'other'
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(u'%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            key = u';'.join([stage] + frames[::-1])
+            self.folded[key] = self.folded.get(key, 0) + 1
+
+    def hot_functions(self, limit=20, files=SUMMARY_FILES):
+        """
+        :param limit: int: number of functions per stage
+        :param files: Tuple[unicode]: only list functions defined in these files
+        :return: unicode: per-stage summary of the functions with the highest cumulative time
+        """
+        import pstats
+        out = [u'%-10s %10s' % (u'stage', u'seconds')]
+        for name in sorted(self.stage_seconds, key=self.stage_seconds.get, reverse=True):
+            out.append(u'%-10s %10.3f' % (name, self.stage_seconds[name]))
+        for name in STAGES + tuple(sorted(set(self.profiles) - set(STAGES))):
+            profile = self.profiles.get(name)
+            if profile is None:
+                continue
+            stats = pstats.Stats(profile)
+            rows = []
+            for (filename, line, func), (cc, nc, tt, ct, callers) in stats.stats.items():
+                if os.path.basename(filename) in files:
+                    rows.append((ct, tt, nc, u'%s:%d(%s)' % (os.path.basename(filename), line, func)))
+            rows.sort(reverse=True)
+            out.append(u'')
+            out.append(u'[%s] %-60s %8s %10s %10s' % (name, u'function', u'calls', u'tottime', u'cumtime'))
+            for ct, tt, nc, label in rows[:limit]:
+                out.append(u'%-68s %8d %10.3f %10.3f' % (label, nc, tt, ct))
+        return u'\n'.join(out) + u'\n'
+
+    def write(self, directory):
+        """Write profile.folded (flame graph input), profile.<stage>.prof (pstats) and profile.txt (summary).
+
+        :param directory: unicode: output directory
+        :return: List[unicode]: the files written
+        """
+        if not self.enabled:
+            return []
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        written = []
+        path = os.path.join(directory, u'profile.folded')
+        with io.open(path, u'w', encoding=u'utf-8') as f:
+            for key, count in sorted(self.folded.items()):
+                f.write(u'%s %d\n' % (key, count))
+        written.append(path)
+        for name, profile in self.profiles.items():
+            path = os.path.join(directory, u'profile.%s.prof' % name)
+            profile.dump_stats(path)
+            written.append(path)
+        path = os.path.join(directory, u'profile.txt')
+        with io.open(path, u'w', encoding=u'utf-8') as f:
+            f.write(self.hot_functions())
+        written.append(path)
+        return written
@@ -0,0 +1,143 @@
+"""
+Startup benchmark
+"""
+# coding=utf-8
+#
+# Measures what loading this plugin costs: import time of the plugin modules and
+# construction time of the plugin object, each in a fresh interpreter, and which
+# heavy modules they drag in.
+#
+#   calibre-debug -e bench_startup.py        (plugin and API modules)
+#   python bench_startup.py                  (API modules only, no calibre needed)
+#
+# Pass --runs N to change the number of fresh interpreters per measurement, and
+# --baseline REV to measure the same cases on git revision REV as well (checked
+# out into a temporary directory), e.g. the tree before a change, and print the
+# difference.
+#
+# "plugin modules" imports the helper modules __init__.py imports at load time,
+# as listed in that tree's __init__.py, so it runs without calibre and follows
+# the imports added to the plugin since the baseline.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import io
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+#: Modules that should not be loaded just because the plugin was imported/constructed.
+HEAVY_MODULES = ('lxml.objectify', 'calibre.ebooks.metadata.opf2', 'calibre.ebooks.metadata.opf', 'calibre.gui2.metadata.config', 'BaseHTTPServer',
+                 'http.server', 'cProfile', 'pstats')
+
+_SNIPPET = """
+import sys, time
+sys.path.insert(0, %(path)r)
+before = set(sys.modules)
+start = time.time()
+%(code)s
+elapsed = time.time() - start
+loaded = sorted(m for m in %(heavy)r if m in sys.modules and m not in before)
+print(repr((elapsed, loaded)))
+"""
+
+#: (label, code, needs calibre); %(init)r is the tree's __init__.py, %(modules)s its plugin_modules
+CASES = [(u'import amazonsimpleproductapi', 'import amazonsimpleproductapi', False), (u'import apimetrics, batchprofile', 'import apimetrics, batchprofile', False),
+         (u'import plugin modules', 'import %(modules)s', False),
+         # not runpy.run_path: Python 2 clears the module's globals once it returns, which breaks the constructor
+         (u'import plugin', 'import imp; imp.load_source("amazonpaapi_plugin", %(init)r)', True),
+         (u'construct plugin', 'import imp; imp.load_source("amazonpaapi_plugin", %(init)r).AmazonProductAdvertisingAPI(None)', True)]
+
+def plugin_modules(tree):
+    """
+    :param tree: unicode: plugin directory
+    :return: List[unicode]: the plugin's own modules its __init__.py imports at load time, in import order
+    """
+    with io.open(os.path.join(tree, '__init__.py'), encoding='utf-8') as f:
+        source = f.read()
+    modules = []
+    for found in re.findall(r'^    from calibre_plugins\.AmazonProductAdvertisingAPI(?:\.(\w+) import| import (\w+))', source, re.M):
+        name = found[0] or found[1]
+        if name not in modules and os.path.isfile(os.path.join(tree, name + '.py')):
+            modules.append(name)
+    return modules
+
+def checkout(revision):
+    """
+    :param revision: unicode: git revision of this repository
+    :return: Tuple[unicode, unicode]: temporary directory, for the caller to remove, and the plugin directory in it
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    prefix = subprocess.check_output(['git', 'rev-parse', '--show-prefix'], cwd=here).decode('utf-8').strip()
+    archive = subprocess.check_output(['git', 'archive', '--format=tar', revision, '--', prefix or '.'], cwd=here)
+    directory = tempfile.mkdtemp(prefix='bench_startup_')
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(directory)
+    return directory, os.path.join(directory, prefix)
+
+def _run(tree, code):
+    snippet = _SNIPPET % {'path': tree, 'code': code, 'heavy': HEAVY_MODULES}
+    # amazonsimpleproductapi falls back to execfile('bottlenose.py') outside of calibre's plugin loader
+    try:
+        output = subprocess.check_output([sys.executable, '-c', snippet], cwd=tree, stderr=subprocess.STDOUT).decode('utf-8')
+    except subprocess.CalledProcessError:
+        # a tree that imports what this interpreter lacks (lxml, before imports were deferred)
+        return None
+    return eval(output.strip().splitlines()[-1])
+
+def measure(tree, code, runs):
+    """
+    :return: Tuple[float, List[str]] or None if the case fails in that tree: best time in seconds, heavy modules loaded
+    """
+    code = code % {'init': os.path.join(tree, '__init__.py'), 'modules': u', '.join(plugin_modules(tree)) or u'sys'}
+    results = [_run(tree, code) for _ in range(runs)]
+    if None in results:
+        return None
+    return min(r[0] for r in results), results[0][1]
+
+def main(runs=5, baseline=None):
+    """
+    :param runs: int: fresh interpreters per case, the best time is reported
+    :param baseline: unicode or None: git revision to measure as well
+    """
+    try:
+        import calibre
+        have_calibre = True
+    except ImportError:
+        have_calibre = False
+    here = os.path.dirname(os.path.abspath(__file__))
+    directory, base_tree = checkout(baseline) if baseline else (None, None)
+    try:
+        if base_tree is None:
+            print(u'%-34s %10s  %s' % (u'case', u'best ms', u'heavy modules loaded'))
+        else:
+            print(u'%-34s %10s %10s %10s  %s' % (u'case', u'best ms', baseline[:10], u'delta', u'heavy modules loaded'))
+        for label, code, needs_calibre in CASES:
+            if needs_calibre and not have_calibre:
+                print(u'%-34s %10s' % (label, u'skipped (run with calibre-debug -e)'))
+                continue
+            current = measure(here, code, runs)
+            if current is None:
+                print(u'%-34s %10s' % (label, u'failed'))
+                continue
+            best, heavy = current
+            if base_tree is None:
+                print(u'%-34s %10.1f  %s' % (label, best * 1000, u', '.join(heavy) or u'-'))
+                continue
+            base = measure(base_tree, code, runs)
+            if base is None:
+                print(u'%-34s %10.1f %10s %10s  %s' % (label, best * 1000, u'failed', u'', u', '.join(heavy) or u'-'))
+            else:
+                print(u'%-34s %10.1f %10.1f %+10.1f  %s (%s: %s)' % (label, best * 1000, base[0] * 1000, (best - base[0]) * 1000,
+                                                                     u', '.join(heavy) or u'-', baseline[:10], u', '.join(base[1]) or u'-'))
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    main(int(sys.argv[sys.argv.index('--runs') + 1]) if '--runs' in sys.argv else 5,
+         sys.argv[sys.argv.index('--baseline') + 1] if '--baseline' in sys.argv else None)
@@ -12,6 +12,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License."""
+import copy
 import gzip
 import sys
 import urllib
@@ -24,18 +25,22 @@ except ImportError:
     import urllib.request as urllib2
 import hmac
 import os
+import threading
 import time
 import logging
 
+try:
+    import httplib
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    import http.client as httplib
+
 from hashlib import sha256
 
 try:
-    from cStringIO import StringIO
+    from cStringIO import StringIO as BytesIO
 except ImportError:
-    try:
-        from StringIO import StringIO
-    except ImportError:
-        from io import StringIO
+    from io import BytesIO
 
 try:
     from urllib import quote as urllib_quote
@@ -54,6 +59,72 @@ except ImportError:
 
 log = logging.getLogger(__name__)
 
+# time spent in connect() (DNS, TCP and TLS) by the last request made on this thread
+_connect_timing = threading.local()
+
+# MaxQPS slots are taken under this lock, so that concurrent calls sharing _last_query_time queue up instead of all going at once
+_throttle_lock = threading.Lock()
+
+# response bodies are read this much at a time, checking the deadline and abort in between
+_READ_CHUNK = 64 * 1024
+
+class RequestCancelled(Exception):
+    """The call was aborted, its deadline passed before it could complete, or
+    the request quota had nothing left for it.
+
+    reason is 'abort', 'deadline' or 'quota'.
+    """
+
+    def __init__(self, reason, operation=None):
+        Exception.__init__(self, '%s: %s' % (operation, reason))
+        self.reason = reason
+        self.code = reason
+
+class _TimedHTTPSConnection(httplib.HTTPSConnection):
+    def connect(self):
+        start = time.time()
+        httplib.HTTPSConnection.connect(self)
+        _connect_timing.seconds = getattr(_connect_timing, 'seconds', 0.0) + time.time() - start
+
+class _TimedHTTPSHandler(urllib2.HTTPSHandler):
+    def https_open(self, req):
+        # the SSL settings of the handler it stands in for
+        kwargs = {'context': getattr(self, '_context', None)}
+        if hasattr(self, '_check_hostname'):
+            kwargs['check_hostname'] = self._check_hostname
+        return self.do_open(_TimedHTTPSConnection, req, **kwargs)
+
+# (opener installed with urllib2.install_opener, timed copy of it)
+_timed_openers = [None, None]
+_timed_openers_lock = threading.Lock()
+
+def _timed_opener():
+    """The opener urlopen() would use (calibre's, with the user's proxies, once it is installed), with connect() timed.
+
+    Its plain HTTPSHandler is replaced by a _TimedHTTPSHandler with the same SSL settings; a custom HTTPS handler is kept, untimed.
+    The other handlers are copied, so that their parent stays the installed opener.
+    """
+    installed = getattr(urllib2, '_opener', None)
+    with _timed_openers_lock:
+        if _timed_openers[1] is not None and _timed_openers[0] is installed:
+            return _timed_openers[1]
+        if installed is None:
+            opener = urllib2.build_opener(_TimedHTTPSHandler)
+        else:
+            opener = urllib2.OpenerDirector()
+            opener.addheaders = list(installed.addheaders)
+            for handler in installed.handlers:
+                # (Python 2 handlers are old-style classes)
+                if handler.__class__ is urllib2.HTTPSHandler:
+                    timed = _TimedHTTPSHandler()
+                    timed.__dict__.update(handler.__dict__)
+                    handler = timed
+                else:
+                    handler = copy.copy(handler)
+                opener.add_handler(handler)
+        _timed_openers[:] = [installed, opener]
+        return opener
+
 class _BottlenoseAmazonCall(object):
     SERVICE_DOMAINS = {'CA'                                     : ('webservices.amazon.ca', 'xml-ca.amznxslt.com'), 'CN': ('webservices.amazon.cn', 'xml-cn.amznxslt.com'), 'DE': (
         'webservices.amazon.de', 'xml-de.amznxslt.com'), 'ES'   : ('webservices.amazon.es', 'xml-es.amznxslt.com'), 'FR': ('webservices.amazon.fr', 'xml-fr.amznxslt.com'), 'IN': (
@@ -62,7 +133,7 @@ class _BottlenoseAmazonCall(object):
     'webservices.amazon.com', 'xml-us.amznxslt.com'), 'BR'      : ('webservices.amazon.com.br', 'xml-br.amznxslt.com'), 'MX': ('webservices.amazon.com.mx', 'xml-mx.amznxslt.com')}
 
     def __init__(self, AWSAccessKeyId, AWSSecretAccessKey, AssociateTag, Operation=None, Version="2013-08-01", Region='US', Timeout=15, MaxQPS=0.8, Parser=None, CacheReader=None,
-                 CacheWriter=None, ErrorHandler=None, _last_query_time=None):
+                 CacheWriter=None, ErrorHandler=None, Metrics=None, Quota=None, Scheduler=None, _last_query_time=None):
 
         self.AWSAccessKeyId = AWSAccessKeyId
         self.AWSSecretAccessKey = AWSSecretAccessKey
@@ -70,6 +141,9 @@ class _BottlenoseAmazonCall(object):
         self.CacheReader = CacheReader
         self.CacheWriter = CacheWriter
         self.ErrorHandler = ErrorHandler
+        self.Metrics = Metrics
+        self.Quota = Quota
+        self.Scheduler = Scheduler
         self.MaxQPS = MaxQPS
         self.Operation = Operation
         self.Parser = Parser
@@ -86,7 +160,8 @@ class _BottlenoseAmazonCall(object):
         except:
             return _BottlenoseAmazonCall(self.AWSAccessKeyId, self.AWSSecretAccessKey, self.AssociateTag, Operation=k, Version=self.Version, Region=self.Region,
                                          Timeout=self.Timeout, MaxQPS=self.MaxQPS, Parser=self.Parser, CacheReader=self.CacheReader, CacheWriter=self.CacheWriter,
-                                         ErrorHandler=self.ErrorHandler, _last_query_time=self._last_query_time)
+                                         ErrorHandler=self.ErrorHandler, Metrics=self.Metrics, Quota=self.Quota,
+                                         Scheduler=self.Scheduler, _last_query_time=self._last_query_time)
 
     def _maybe_parse(self, response_text):
         if self.Parser:
@@ -144,57 +219,193 @@ class _BottlenoseAmazonCall(object):
 
         return "https://" + service_domain + "/onca/xml?" + self._quote_query(query)
 
-    def _call_api(self, api_url):
+    def _call_api(self, api_url, timeout=None):
         """urlopen(), plus error handling and possible retries.
 
         err_env is a dict of additional info passed to the error handler
         """
-        api_request = urllib2.Request(api_url, headers={"Accept-Encoding": "gzip"})
-        log.debug("Amazon URL: %s" % api_url)
-        return urllib2.urlopen(api_request, timeout=self.Timeout)
+        if isinstance(api_url, urllib2.Request):
+            # prepared by a subclass (POST backends)
+            api_request = api_url
+        else:
+            api_request = urllib2.Request(api_url, headers={"Accept-Encoding": "gzip"})
+        log.debug("Amazon URL: %s" % api_request.get_full_url())
+        if self.Metrics:
+            return _timed_opener().open(api_request, timeout=timeout or self.Timeout)
+        return urllib2.urlopen(api_request, timeout=timeout or self.Timeout)
+
+    def _cacheable(self, response):
+        """Whether a response _call_api returned may go to the CacheWriter; backends that return error responses say no to them."""
+        return True
+
+    def try_throttle_slot(self):
+        """Take the next MaxQPS slot if it is free now, without waiting (hedged duplicates); returns whether it was taken."""
+        with _throttle_lock:
+            now = time.time()
+            last_query_time = self._last_query_time[0]
+            # last_query_time is in the future when other calls are already waiting for their slot
+            if self.MaxQPS and last_query_time and now - last_query_time < 1 / self.MaxQPS:
+                return False
+            self._last_query_time[0] = now
+            return True
+
+    @staticmethod
+    def _remaining(deadline, abort, operation):
+        """Seconds left before the deadline; raises RequestCancelled when none are or abort is set."""
+        if abort is not None and abort.is_set():
+            raise RequestCancelled('abort', operation)
+        if deadline is None:
+            return None
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise RequestCancelled('deadline', operation)
+        return remaining
+
+    def _read(self, response, deadline, abort, operation):
+        if deadline is None and abort is None:
+            return response.read()
+        chunks = []
+        while True:
+            self._remaining(deadline, abort, operation)
+            chunk = response.read(_READ_CHUNK)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
 
     def call_api(self, **kwargs):
         """
+        Besides the API parameters, kwargs may hold:
+            Timeout: socket timeout for this call, instead of the object's
+            Deadline: time.time() by which the call must be done; the throttle
+                      wait, connect and read only get what is left of it
+            Abort: a threading.Event; once set, the call stops waiting and
+                   reading
+            Throttle: False when the caller already took a MaxQPS slot for
+                      this call (hedged duplicates); such a call does not wait
+                      for Quota either
+            Sent: a threading.Event, set when the request goes out, after
+                  the throttle wait
+            Parse: False to get the raw response instead of the Parser's
+                   output
+            Priority: the Scheduler class of the call: interactive (the
+                      default), background or batch
+        Deadline and Abort raise RequestCancelled when they end the call, and
+        so does a Quota that has nothing left before the deadline.
 
         :param kwargs:
         :return:
         """
+        timeout = kwargs.pop('Timeout', None) or self.Timeout
+        deadline = kwargs.pop('Deadline', None)
+        abort = kwargs.pop('Abort', None)
+        throttle = kwargs.pop('Throttle', True)
+        sent = kwargs.pop('Sent', None)
+        parse = kwargs.pop('Parse', True)
+        priority = kwargs.pop('Priority', None) or 'interactive'
         cache_url = self.cache_url(**kwargs)
+        operation = kwargs.get('Operation', self.Operation)
+        timings = {}
+        cache = None
 
         if self.CacheReader:
             cached_response_text = self.CacheReader(cache_url)
             if cached_response_text is not None:
-                return self._maybe_parse(cached_response_text)
+                if not parse:
+                    return cached_response_text
+                if not self.Metrics:
+                    return self._maybe_parse(cached_response_text)
+                start = time.time()
+                parsed = self._maybe_parse(cached_response_text)
+                timings['parse'] = time.time() - start
+                self.Metrics.record_request(operation, self.Region, timings, cache='hit')
+                return parsed
+            cache = 'miss'
 
         api_url = self._api_url(**kwargs)
 
-        # throttle ourselves if need be
-        if self.MaxQPS:
-            last_query_time = self._last_query_time[0]
-            if last_query_time:
-                wait_time = 1 / self.MaxQPS - (time.time() - last_query_time)
+        try:
+            # throttle ourselves if need be
+            if self.Scheduler is not None and throttle:
+                # the scheduler hands out the MaxQPS slots by priority
+                waited = self.Scheduler.acquire(priority, deadline=deadline, abort=abort)
+                if waited is None:
+                    raise RequestCancelled('abort' if abort is not None and abort.is_set() else 'deadline', operation)
+                if waited:
+                    timings['throttle'] = waited
+            elif self.MaxQPS and throttle:
+                with _throttle_lock:
+                    now = time.time()
+                    last_query_time = self._last_query_time[0]
+                    # last_query_time is in the future when other calls are already waiting for their slot
+                    wait_time = 1 / self.MaxQPS - (now - last_query_time) if last_query_time else 0
+                    if wait_time > 0:
+                        remaining = self._remaining(deadline, abort, operation)
+                        if remaining is not None and wait_time >= remaining:
+                            # no point in waiting for a slot we could not use
+                            raise RequestCancelled('deadline', operation)
+                    self._last_query_time[0] = now + max(wait_time, 0)
                 if wait_time > 0:
                     log.debug('Waiting %.3fs to call Amazon API' % wait_time)
-                    time.sleep(wait_time)
-
-            self._last_query_time[0] = time.time()
-
-        # make the actual API call
-        response = self._call_api(api_url)
+                    if abort is not None:
+                        abort.wait(wait_time)
+                    else:
+                        time.sleep(wait_time)
+                    timings['throttle'] = wait_time
+
+            # take a unit of the account's request quota, shared with other processes, once the call has its slot
+            if self.Quota is not None:
+                waited = self.Quota.acquire(deadline=deadline, abort=abort, wait=throttle)
+                if waited is None:
+                    raise RequestCancelled('abort' if abort is not None and abort.is_set() else 'quota', operation)
+                if waited:
+                    timings['quota'] = waited
+
+            # make the actual API call
+            try:
+                remaining = self._remaining(deadline, abort, operation)
+            except RequestCancelled:
+                if self.Quota is not None:
+                    # not sent: the unit goes back
+                    self.Quota.refund()
+                raise
+            if sent is not None:
+                sent.set()
+            _connect_timing.seconds = 0.0
+            start = time.time()
+            response = self._call_api(api_url, timeout if remaining is None else min(timeout or remaining, remaining))
+            timings['connect'] = _connect_timing.seconds
+            timings['ttfb'] = time.time() - start - timings['connect']
+
+            start = time.time()
+            response_text = self._read(response, deadline, abort, operation)
+            timings['download'] = time.time() - start
+        except Exception as e:
+            if self.Metrics:
+                timings.setdefault('connect', getattr(_connect_timing, 'seconds', 0.0))
+                self.Metrics.record_request(operation, self.Region, timings, cache=cache, error=str(getattr(e, 'code', None) or type(e).__name__))
+            raise
 
         # decompress the response if need be
-        if "gzip" in response.info().getheader("Content-Encoding"):
-            gzipped_file = gzip.GzipFile(fileobj=StringIO(response.read()))
-            response_text = gzipped_file.read()
-        else:
-            response_text = response.read()
+        if "gzip" in (response.info().get("Content-Encoding") or ""):
+            start = time.time()
+            response_text = gzip.GzipFile(fileobj=BytesIO(response_text)).read()
+            timings['decompress'] = time.time() - start
 
         # write it back to the cache
-        if self.CacheWriter:
+        if self.CacheWriter and self._cacheable(response):
             self.CacheWriter(cache_url, response_text)
 
         # parse and return it
-        return self._maybe_parse(response_text)
+        if not parse:
+            parsed = response_text
+        else:
+            start = time.time()
+            parsed = self._maybe_parse(response_text)
+            timings['parse'] = time.time() - start
+        if self.Metrics:
+            self.Metrics.record_request(operation, self.Region, timings, cache=cache)
+        log.debug('Amazon API timings: %r' % timings)
+        return parsed
 
 class BottlenoseAmazon(_BottlenoseAmazonCall):
     """
@@ -203,7 +414,7 @@ class BottlenoseAmazon(_BottlenoseAmazonCall):
 
     def __init__(self, AWSAccessKeyId=os.environ.get('AWS_ACCESS_KEY_ID'), AWSSecretAccessKey=os.environ.get('AWS_SECRET_ACCESS_KEY'),
                  AssociateTag=os.environ.get('AWS_ASSOCIATE_TAG'), Operation=None, Version="2013-08-01", Region="US", Timeout=30, MaxQPS=0.8, Parser=None, CacheReader=None,
-                 CacheWriter=None, ErrorHandler=None):
+                 CacheWriter=None, ErrorHandler=None, Metrics=None, Quota=None, Scheduler=None):
         """Create an Amazon API object.
 
         AWSAccessKeyId: Your AWS Access Key, sent with API queries. If not
@@ -244,10 +455,18 @@ class BottlenoseAmazon(_BottlenoseAmazonCall):
                       If this returns true, the call will be retried
                       (you generally want to wait some time before
                       returning, in this case)
+        Metrics: an apimetrics.ApiMetrics. If set, every call reports its
+                 throttle, connect, ttfb, download, decompress and parse
+                 timings, cache hit/miss and error code to it
+        Quota: a quotaledger.QuotaLedger. If set, every request sent takes
+               a unit from it first, waiting for one if need be
+        Scheduler: a scheduler.RequestScheduler. If set, it replaces the
+                   MaxQPS throttle and serves the calls by their Priority
         """
         # Operation is for internal use by AmazonCall.__getattr__()
 
         _BottlenoseAmazonCall.__init__(self, AWSAccessKeyId, AWSSecretAccessKey, AssociateTag, Operation, Version=Version, Region=Region, Timeout=Timeout, MaxQPS=MaxQPS,
-                                       Parser=Parser, CacheReader=CacheReader, CacheWriter=CacheWriter, ErrorHandler=ErrorHandler)
+                                       Parser=Parser, CacheReader=CacheReader, CacheWriter=CacheWriter, ErrorHandler=ErrorHandler, Metrics=Metrics,
+                                       Quota=Quota, Scheduler=Scheduler)
 
-__all__ = ["BottlenoseAmazon"]
+__all__ = ["BottlenoseAmazon", "RequestCancelled"]
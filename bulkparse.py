@@ -0,0 +1,148 @@
+"""
+ParsePool
+"""
+# coding=utf-8
+#
+# Process pool for bulk_identify.
+#
+# The fetch loop only downloads ItemLookup responses (AmazonAPI.item_lookup_raw)
+# and submits the bytes here. Pool processes parse them with lxml, build the
+# AmazonProducts, convert them with the plugin's AmazonProduct_to_Metadata and
+# serialize the records; the results come back to a callback in the parent
+# process, which queues them on the BulkOPFWriter. At most queue_size responses
+# are in flight, submit() blocks beyond that.
+#
+# The conversion also caches the products' cover URLs, which in a pool process
+# would only fill that process's copy of the cache: they are sent back with the
+# results and cached again in the parent.
+#
+# The pool processes get the configured plugin object by fork, so the pool is
+# only available where os.fork is (not on Windows).
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import threading
+from functools import partial
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.amazonsimpleproductapi import AmazonAPI, AmazonException
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from amazonsimpleproductapi import AmazonAPI, AmazonException
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.paapi5 import Paapi5API
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from paapi5 import Paapi5API
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.responsearchive import JSON, response_format
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from responsearchive import JSON, response_format
+
+try:
+    unicode
+except NameError:
+    # noinspection PyShadowingBuiltins
+    unicode = str
+
+# the plugin, in pool processes
+_plugin = None
+
+def available():
+    """
+    :return: bool: True if ParsePool can be used on this platform
+    """
+    return hasattr(os, 'fork')
+
+def _init_worker(plugin):
+    global _plugin
+    _plugin = plugin
+
+def convert_response(raw, id_type):
+    """Parse and convert one ItemLookup response. Runs in a pool process.
+
+    :param raw: bytes: response XML, or JSON with the 5.0 API
+    :param id_type: unicode: ASIN or ISBN, decides the record file names
+    :return: Tuple[List[Tuple[unicode, unicode]], Tuple]: the (ASIN, cover URL) pairs of the products, and the convert output
+    """
+    covers = []
+    return covers, convert(_plugin, raw, id_type, covers)
+
+def convert(plugin, raw, id_type, covers=None):
+    """Parse and convert one response, of either API version (archived responses may be of the other one).
+
+    :param plugin: the calibre plugin
+    :param raw: bytes: response XML, or JSON with the 5.0 API
+    :param id_type: unicode: ASIN or ISBN, decides the record file names
+    :param covers: List or None: gets the (ASIN, cover URL) pair of every product that has a cover
+    :return: Tuple[List[Tuple[unicode, bytes, Dict]], int, unicode or None, unicode or None]: serialized records, products
+             without a usable identifier, error message, AmazonException code
+    """
+    try:
+        records = []
+        lost = 0
+        parse = Paapi5API.parse_products if response_format(raw) == JSON else AmazonAPI.parse_products
+        for product in parse(raw):
+            if covers is not None and product.asin and product.large_image_url:
+                covers.append((product.asin, product.large_image_url))
+            file_name = plugin.bulk_file_name(product, id_type)
+            if file_name is None:
+                lost += 1
+                continue
+            mi, keys = plugin.product_record(product)
+            records.append(plugin.metadata_cache.serialize(file_name, mi, keys))
+        return records, lost, None, None
+    except AmazonException as e:
+        code = unicode(e.code) if e.code is not None else None
+        return [], 0, u'AmazonException. Code: %s Message: %s' % (e.code, e.msg), code
+    except Exception as e:
+        # an exception here would never reach the callback and its slot would never be released
+        return [], 0, u'%s: %s' % (type(e).__name__, e), None
+
+class ParsePool(object):
+    """
+    Parses and converts raw responses in other processes.
+    """
+
+    def __init__(self, plugin, processes, on_result, queue_size=None):
+        """
+        :param plugin: the calibre plugin, with its settings loaded
+        :param processes: int: pool size
+        :param on_result: callable(context, records, lost, error, code), called in the parent process for every response; what it
+                          raises is logged
+        :param queue_size: int: responses in flight at most, 4 per process by default
+        """
+        import multiprocessing
+        self.plugin = plugin
+        self.on_result = on_result
+        self._slots = threading.BoundedSemaphore(queue_size or processes * 4)
+        self._pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(plugin,))
+
+    def submit(self, raw, id_type, context=None):
+        """
+        :param raw: bytes: response XML
+        :param id_type: unicode: ASIN or ISBN
+        :param context: passed back to on_result with the response's results
+        """
+        self._slots.acquire()
+        self._pool.apply_async(convert_response, (raw, id_type), callback=partial(self._done, context))
+
+    def _done(self, context, result):
+        self._slots.release()
+        # runs on the pool's result thread: an exception would end it, and close() would then wait forever
+        try:
+            covers, result = result
+            for asin, url in covers:
+                self.plugin.cache_identifier_to_cover_url(asin, url)
+            self.on_result(context, *result)
+        except Exception:
+            self.plugin.log.exception(u'Failed to handle a converted response')
+
+    def close(self):
+        """Wait for every submitted response to be converted and stop the processes."""
+        self._pool.close()
+        self._pool.join()
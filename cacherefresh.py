@@ -0,0 +1,151 @@
+"""
+CacheRefresher
+"""
+# coding=utf-8
+#
+# Stale-while-revalidate for the metadata cache.
+#
+# identify answers from a stale cached record right away and submits the
+# record's ASIN here. A daemon thread groups submissions into ItemLookup sized
+# batches (10 ASINs), waits at least min_interval between batches so that
+# background refreshes only take a small share of the API rate, and hands each
+# batch to a callback that re-fetches the products and rewrites the records in
+# place.
+#
+# An ASIN the callback did not refresh (Amazon no longer has it, or the call
+# failed) is not taken again until its backoff has passed: retry_after seconds,
+# doubled after every further failure up to max_retry_after. Otherwise every
+# identify of a record for a withdrawn product would spend a call on it.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+import time
+
+class CacheRefresher(object):
+    """
+    Batches stale records and refreshes them on a daemon thread.
+    """
+
+    #: Most ASINs kept in backoff before the expired ones are forgotten
+    MAX_BACKOFF_ENTRIES = 10000
+
+    def __init__(self, refresh, batch_size=10, linger=2.0, min_interval=5.0, retry_after=600.0, max_retry_after=86400.0, log=None):
+        """
+        :param refresh: callable(Dict[asin, file_name]) -> Iterable[asin]: re-fetches a batch, rewrites its records and returns the
+                        ASINs it refreshed
+        :param batch_size: int: ASINs per refresh call, ItemLookup takes at most 10
+        :param linger: float: seconds to wait for a batch to fill up
+        :param min_interval: float: minimum seconds between two refresh calls
+        :param retry_after: float: seconds before an ASIN that was not refreshed is taken again
+        :param max_retry_after: float: longest backoff, after repeated failures
+        :param log: calibre Log or None
+        """
+        self.refresh = refresh
+        self.batch_size = batch_size
+        self.linger = linger
+        self.min_interval = min_interval
+        self.retry_after = retry_after
+        self.max_retry_after = max_retry_after
+        self.log = log
+        self.refreshed = 0
+        self._pending = {}
+        self._in_flight = set()
+        self._backoff = {}
+        self._lock = threading.Condition()
+        self._thread = None
+        self._last_batch = 0.0
+        self._closed = False
+
+    def submit(self, asin, file_name):
+        """Queue a record for refresh. Records already queued or being refreshed, or in backoff, are ignored.
+
+        :param asin: unicode: ASIN to look up
+        :param file_name: unicode: the record to rewrite
+        :return: bool: True if the record was queued
+        """
+        if not asin:
+            return False
+        with self._lock:
+            if self._closed or asin in self._pending or asin in self._in_flight:
+                return False
+            if asin in self._backoff and self._backoff[asin][1] > time.time():
+                return False
+            self._pending[asin] = file_name
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=str('CacheRefresher'))
+                self._thread.daemon = True
+                self._thread.start()
+            self._lock.notify()
+        return True
+
+    def pending(self):
+        """
+        :return: int: records waiting for a refresh
+        """
+        with self._lock:
+            return len(self._pending) + len(self._in_flight)
+
+    def close(self, timeout=None):
+        """Stop after the batch in progress, dropping anything still queued.
+
+        :param timeout: float or None: seconds to wait for the thread
+        """
+        with self._lock:
+            self._closed = True
+            self._pending.clear()
+            self._lock.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _next_batch(self):
+        with self._lock:
+            while not self._pending and not self._closed:
+                self._lock.wait()
+            # give the batch a chance to fill up
+            deadline = time.time() + self.linger
+            while len(self._pending) < self.batch_size and not self._closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._lock.wait(remaining)
+            if self._closed:
+                return None
+            batch = dict(list(self._pending.items())[:self.batch_size])
+            for asin in batch:
+                del self._pending[asin]
+            self._in_flight.update(batch)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            wait = self._last_batch + self.min_interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self._last_batch = time.time()
+            refreshed = set()
+            try:
+                refreshed.update(self.refresh(batch) or ())
+                self.refreshed += len(refreshed)
+            except Exception:
+                if self.log is not None:
+                    self.log.exception(u'Background refresh failed for', u','.join(batch))
+            finally:
+                with self._lock:
+                    self._in_flight.difference_update(batch)
+                    self._back_off(set(batch) - refreshed, refreshed)
+
+    def _back_off(self, failed, refreshed):
+        """Call with the lock held."""
+        now = time.time()
+        for asin in refreshed:
+            self._backoff.pop(asin, None)
+        if len(self._backoff) + len(failed) > self.MAX_BACKOFF_ENTRIES:
+            self._backoff = dict((asin, b) for asin, b in self._backoff.items() if b[1] > now)
+        for asin in failed:
+            failures = self._backoff.get(asin, (0, 0))[0] + 1
+            self._backoff[asin] = (failures, now + min(self.retry_after * 2 ** (failures - 1), self.max_retry_after))
@@ -0,0 +1,136 @@
+"""
+CircuitBreaker
+"""
+# coding=utf-8
+#
+# Stops calling the API while it keeps failing.
+#
+# closed:    calls go through; consecutive failures are counted, a success
+#            resets the count.
+# open:      reached after `failures` consecutive failures, or at once on an
+#            error that retrying cannot fix (revoked credentials, bad
+#            signature, unknown partner tag). Calls are refused without
+#            touching the network until `reset_after` seconds have passed.
+# half_open: after that, one trial call at a time is let through; its success
+#            closes the breaker, its failure opens it again, for twice as long
+#            (up to max_reset_after).
+#
+# A failure is a transport error (timeout, connection refused, HTTP 5xx/401/
+# 403) or one of FATAL_CODES; an API answer such as NoExactMatches is a success,
+# since the API did its job. Cancelled calls count as neither.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+import time
+
+try:
+    unicode
+except NameError:
+    # noinspection PyShadowingBuiltins
+    unicode = str
+
+CLOSED = u'closed'
+OPEN = u'open'
+HALF_OPEN = u'half_open'
+#: Error codes (4.0 and 5.0 APIs, and HTTP statuses) that open the breaker at once
+FATAL_CODES = frozenset([u'401', u'403', u'AWS.InvalidAccount', u'AccessDenied', u'IncompleteSignature', u'InvalidAssociate', u'InvalidClientTokenId',
+                         u'InvalidPartnerTag', u'InvalidSignature', u'SignatureDoesNotMatch', u'UnrecognizedClient'])
+
+class CircuitBreaker(object):
+    """
+    Thread-safe closed/open/half_open state machine.
+    """
+
+    def __init__(self, failures=5, reset_after=60.0, max_reset_after=900.0, metrics=None, log=None):
+        """
+        :param failures: int: consecutive failures that open the breaker
+        :param reset_after: float: seconds before the first trial call
+        :param max_reset_after: float: longest wait between trial calls
+        :param metrics: ApiMetrics or None: counts the state changes (circuit_total)
+        :param log: calibre Log or None
+        """
+        self.failures = failures
+        self.reset_after = reset_after
+        self.max_reset_after = max_reset_after
+        self.metrics = metrics
+        self.log = log
+        self.state = CLOSED
+        self.consecutive = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._opened_at = 0.0
+        self._wait = reset_after
+        self._trial = False
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        if self.metrics is not None:
+            self.metrics.inc(u'circuit_total', state=state)
+            self.metrics.emit(u'circuit', state=state, error=self.last_error)
+        if self.log is not None:
+            self.log.info(u'API circuit breaker:', state, u'(last error: %s)' % self.last_error if self.last_error else u'')
+
+    def is_open(self):
+        """
+        :return: bool: calls are being refused now (open, and not yet time for a trial call)
+        """
+        with self._lock:
+            if self.state == OPEN:
+                return time.time() - self._opened_at < self._wait
+            return self.state == HALF_OPEN and self._trial
+
+    def allow(self):
+        """
+        Ask before a call; a True in half_open state makes the caller the trial call, which must then report back.
+        :return: bool
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.time() - self._opened_at < self._wait:
+                    return False
+                self._set_state(HALF_OPEN)
+            if self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive = 0
+            self._trial = False
+            if self.state != CLOSED:
+                self._wait = self.reset_after
+                self._set_state(CLOSED)
+
+    def record_failure(self, code=None):
+        """
+        :param code: error code, HTTP status or exception name
+        """
+        with self._lock:
+            self.consecutive += 1
+            self.last_error = unicode(code) if code is not None else None
+            if self.state == HALF_OPEN:
+                self._wait = min(self._wait * 2, self.max_reset_after)
+            elif self.consecutive < self.failures and self.last_error not in FATAL_CODES:
+                return
+            self._trial = False
+            self._opened_at = time.time()
+            self._set_state(OPEN)
+
+    def release(self):
+        """A call allowed by allow() ended without telling anything about the API (cancelled)."""
+        with self._lock:
+            self._trial = False
+
+    def report(self):
+        """
+        :return: Dict: state, consecutive failures, last error, seconds until the next trial call when open
+        """
+        with self._lock:
+            retry_in = max(0.0, self._opened_at + self._wait - time.time()) if self.state == OPEN else None
+            return {u'state': self.state, u'consecutive_failures': self.consecutive, u'last_error': self.last_error, u'retry_in': retry_in}
@@ -0,0 +1,230 @@
+"""
+LocalMatchIndex
+"""
+# coding=utf-8
+#
+# Fuzzy title/author index over the records of METADATA_CACHE_LOCATION.
+#
+# Titles and authors are lower cased, stripped of accents and punctuation, and
+# split into words; every word longer than one letter (so author initials do not
+# count) is cut into padded character trigrams. The inverted index maps each
+# trigram to the records containing it. A query collects the records sharing the
+# most trigrams with it, then scores those with the Dice coefficient of the title
+# trigrams and, when both sides have authors, of the author trigrams:
+#
+#   score = 0.7 * title + 0.3 * authors   (or the title score alone)
+#
+# Titles are also compared without their subtitle (whatever follows ':', ' - ' or
+# '('), at SUBTITLE_FACTOR of the score, since Amazon titles usually carry one
+# and calibre titles often do not. Word order, initials, small typos and
+# subtitles cost a little score instead of missing the record.
+#
+# RelevanceQuery applies the same score to API results, plus identifier agreement
+# and binding preference, so identify can rank them for calibre. The query side
+# is computed once, and so is each result's (candidate_trigrams, when the result
+# arrives, or the match index's when it is a kept record): scoring a result
+# costs one set intersection per field.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import re
+import threading
+import unicodedata
+from collections import defaultdict
+
+#: How many records sharing the most trigrams with the query are scored
+CANDIDATES = 50
+TITLE_WEIGHT = 0.7
+SUBTITLE_FACTOR = 0.95
+#: Added to the score of a result sharing an identifier with the book
+IDENTIFIER_BONUS = 1.0
+#: Added to the score of a result in the preferred binding
+BINDING_BONUS = 0.1
+KINDLE_BINDING = u'Kindle Edition'
+#: Title/author score from which a search result is taken to be the book (RelevanceQuery.confident)
+CONFIDENT_SCORE = 0.9
+
+_SUBTITLE = re.compile(r'\s*(?::|\s-\s|\().*$', re.UNICODE)
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+def normalize_words(text):
+    """
+    :param text: unicode: title or author
+    :return: List[unicode]: lower case words without accents, initials dropped
+    """
+    text = unicodedata.normalize('NFKD', text or u'')
+    text = u''.join(c for c in text if not unicodedata.combining(c)).lower()
+    return [w for w in _WORD.findall(text) if len(w) > 1]
+
+def trigrams(words):
+    """
+    :param words: Iterable[unicode]: normalize_words output
+    :return: FrozenSet[unicode]: padded character trigrams of every word
+    """
+    grams = set()
+    for word in words:
+        padded = u'$' + word + u'$'
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(grams)
+
+def title_trigrams(title):
+    """
+    :param title: unicode: title
+    :return: Tuple[FrozenSet, FrozenSet]: trigrams of the whole title and of the title without its subtitle
+    """
+    full = trigrams(normalize_words(title))
+    main_title = _SUBTITLE.sub(u'', title or u'')
+    if main_title == (title or u''):
+        # the same set, so that similarity skips the subtitle comparison
+        return full, full
+    main = trigrams(normalize_words(main_title))
+    return full, main or full
+
+def author_trigrams(authors):
+    """
+    :param authors: Iterable[unicode]: author names
+    :return: FrozenSet[unicode]: trigrams of every author's words
+    """
+    return trigrams(w for a in authors or () for w in normalize_words(a))
+
+def candidate_trigrams(title, authors):
+    """
+    :param title: unicode: title
+    :param authors: Iterable[unicode]: author names
+    :return: Tuple[Tuple[FrozenSet, FrozenSet], FrozenSet]: title_trigrams and author_trigrams, what the index keeps and
+             RelevanceQuery scores
+    """
+    return title_trigrams(title), author_trigrams(authors)
+
+def similarity(query_title, query_authors, title, authors):
+    """
+    :param query_title: Tuple[FrozenSet, FrozenSet]: title_trigrams of the book looked for
+    :param query_authors: FrozenSet: author_trigrams of the book looked for
+    :param title: Tuple[FrozenSet, FrozenSet]: title_trigrams of a candidate
+    :param authors: FrozenSet: author_trigrams of a candidate
+    :return: float: between 0 and 1
+    """
+    score = dice(query_title[0], title[0])
+    if query_title[1] is not query_title[0] or title[1] is not title[0]:
+        score = max(score, SUBTITLE_FACTOR * dice(query_title[1], title[1]))
+    if query_authors and authors:
+        score = TITLE_WEIGHT * score + (1 - TITLE_WEIGHT) * dice(query_authors, authors)
+    return score
+
+def dice(a, b):
+    """
+    :return: float: 2 |a & b| / (|a| + |b|), 0 if either is empty
+    """
+    if not a or not b:
+        return 0.0
+    return 2.0 * len(a & b) / (len(a) + len(b))
+
+class LocalMatchIndex(object):
+    """
+    Trigram index of record titles and authors.
+    """
+
+    def __init__(self):
+        self._postings = defaultdict(set)
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._records)
+
+    def add(self, file_name, title, authors):
+        """Index a record, replacing what was indexed for it before.
+
+        :param file_name: unicode: record file name
+        :param title: unicode: record title
+        :param authors: List[unicode]: record authors
+        """
+        grams = candidate_trigrams(title, authors)
+        title_grams = grams[0]
+        if not title_grams[0]:
+            return
+        with self._lock:
+            previous = self._records.get(file_name)
+            if previous is not None:
+                for gram in previous[0][0]:
+                    self._postings[gram].discard(file_name)
+            self._records[file_name] = grams
+            for gram in title_grams[0]:
+                self._postings[gram].add(file_name)
+
+    def trigrams_of(self, file_name):
+        """
+        :param file_name: unicode: record file name
+        :return: candidate_trigrams output for the record, or None if it is not indexed
+        """
+        with self._lock:
+            return self._records.get(file_name)
+
+    def query(self, title, authors=None, limit=5):
+        """
+        :param title: unicode: title to look for
+        :param authors: List[unicode] or None: its authors
+        :param limit: int: most results returned
+        :return: List[Tuple[float, unicode]]: (score between 0 and 1, record file name), best first
+        """
+        title_grams = title_trigrams(title)
+        author_grams = author_trigrams(authors)
+        if not title_grams[0]:
+            return []
+        counts = defaultdict(int)
+        with self._lock:
+            for gram in title_grams[0]:
+                for file_name in self._postings.get(gram, ()):
+                    counts[file_name] += 1
+            candidates = sorted(counts, key=lambda f: (-counts[f], f))[:CANDIDATES]
+            records = [(f, self._records[f]) for f in candidates]
+        results = [(similarity(title_grams, author_grams, record_title, record_authors), f) for f, (record_title, record_authors) in records]
+        results.sort(key=lambda r: (-r[0], r[1]))
+        return results[:limit]
+
+class RelevanceQuery(object):
+    """
+    Scores the results of one identify call against the book it was made for.
+    """
+
+    def __init__(self, title, authors, keys, prefer_kindle):
+        """
+        :param title: unicode or None: title of the book
+        :param authors: List[unicode] or None: its authors
+        :param keys: Iterable[unicode]: its normalized identifiers (metadatacache.identifier_keys)
+        :param prefer_kindle: bool: rank Kindle editions above print editions, or the other way round
+        """
+        self.title = title_trigrams(title)
+        self.authors = author_trigrams(authors)
+        self.keys = frozenset(keys)
+        self.prefer_kindle = prefer_kindle
+
+    def score(self, grams, keys=(), binding=None):
+        """
+        :param grams: candidate_trigrams of the result's title and authors
+        :param keys: Iterable[unicode]: result normalized identifiers
+        :param binding: unicode or None: result binding, None when unknown
+        :return: float: higher is better
+        """
+        score = similarity(self.title, self.authors, grams[0], grams[1]) if self.title[0] else 0.0
+        if self.keys and not self.keys.isdisjoint(keys):
+            score += IDENTIFIER_BONUS
+        if binding and (binding == KINDLE_BINDING) == self.prefer_kindle:
+            score += BINDING_BONUS
+        return score
+
+    def confident(self, grams):
+        """
+        :param grams: candidate_trigrams of the result's title and authors
+        :return: bool: the result is the book, by title and authors alone
+        """
+        return bool(self.title[0]) and similarity(self.title, self.authors, grams[0], grams[1]) >= CONFIDENT_SCORE
+
+    def rank(self, candidates):
+        """
+        :param candidates: List[Tuple[Any, Tuple, Iterable[unicode], unicode]]: (item, candidate_trigrams, keys, binding), in the source's order
+        :return: List[Any]: the items, best first; equal scores keep the source's order
+        """
+        scored = [(-self.score(*c[1:]), i, c[0]) for i, c in enumerate(candidates)]
+        scored.sort(key=lambda s: s[:2])
+        return [s[2] for s in scored]
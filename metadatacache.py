@@ -0,0 +1,678 @@
+"""
+MetadataCache
+"""
+# coding=utf-8
+#
+# On-disk store for the metadata downloaded by the plugin (METADATA_CACHE_LOCATION).
+#
+# Every record is a file named <identifier>.mi, in the compact binary form of
+# recordformat (or OPF, as older versions wrote them and as RECORD_FORMAT=opf
+# still does; both are read). Files are written to a temporary name and renamed
+# into place, so a crash never leaves a truncated record behind. Every write is also appended to manifest.jsonl (one JSON object
+# per line: file name, fetch time, size, identifiers and lookup keys), which lets
+# the cache be indexed without opening every record.
+#
+# The identity index maps every lookup key of a record (ASIN, ISBN-10, ISBN-13,
+# EAN, EISBN, alternate-version ASINs) to its file, so a record stored as
+# <isbn>.mi is found from its ASIN and the other way round. It is loaded from the
+# manifest on first use, as is the fuzzy title/author index
+# (matchindex.LocalMatchIndex), and every lookup then reads the entries appended
+# since, by this or any other process (a cli_main batch next to calibre): the
+# manifest's size and mtime tell whether there are any.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os
+import re
+import threading
+import time
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.matchindex import LocalMatchIndex
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from matchindex import LocalMatchIndex
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI import recordformat
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    import recordformat
+
+try:
+    from Queue import Queue
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from queue import Queue
+
+MANIFEST = u'manifest.jsonl'
+RECORD_EXTENSION = u'.mi'
+#: Prefetched covers, <record name without .mi>.jpg
+COVERS = u'covers'
+
+# ASINs are 10 characters too; only all-digit values (ISBN-10 may end in X) are ISBN candidates
+_ISBN_SHAPE = re.compile(r'^(?:\d{9}[\dX]|\d{13})$')
+
+def atomic_write(path, data):
+    """Write data to path through a temporary file in the same directory and a rename.
+
+    :param path: unicode: destination
+    :param data: bytes: file content
+    """
+    tmp = u'%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident or 0)
+    with open(tmp, str('wb')) as f:
+        f.write(data)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # Windows will not rename over an existing file
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp, path)
+
+class ISBNConvert(object):
+
+    @staticmethod
+    def _isbn_strip(isbn):
+        """Strip whitespace, hyphens, etc. from an ISBN number and return
+    the result."""
+        short = re.sub(r"\W", "", isbn)
+        return re.sub(r"\D", "X", short)
+
+    @staticmethod
+    def convert(isbn):
+        """Convert an ISBN-10 to ISBN-13 or vice-versa."""
+        short = ISBNConvert._isbn_strip(isbn)
+        if not ISBNConvert.isValid(short):
+            raise Exception(u"Invalid ISBN")
+        if len(short) == 10:
+            stem = "978" + short[:-1]
+            return stem + ISBNConvert._check(stem)
+        else:
+            if short[:3] == "978":
+                stem = short[3:-1]
+                return stem + ISBNConvert._check(stem)
+            else:
+                raise Exception("ISBN not convertible")
+
+    @staticmethod
+    def isValid(isbn):
+        """Check the validity of an ISBN. Works for either ISBN-10 or ISBN-13."""
+        short = ISBNConvert._isbn_strip(isbn)
+        if len(short) == 10:
+            return ISBNConvert.isI10(short)
+        elif len(short) == 13:
+            return ISBNConvert.isI13(short)
+        else:
+            return False
+
+    @staticmethod
+    def _check(stem):
+        """Compute the check digit for the stem of an ISBN. Works with either
+        the first 9 digits of an ISBN-10 or the first 12 digits of an ISBN-13."""
+        short = ISBNConvert._isbn_strip(stem)
+        if len(short) == 9:
+            return ISBNConvert.checkI10(short)
+        elif len(short) == 12:
+            return ISBNConvert._checkI13(short)
+        else:
+            return False
+
+    @staticmethod
+    def checkI10(stem):
+        """Computes the ISBN-10 check digit based on the first 9 digits of a stripped ISBN-10 number."""
+        chars = list(stem)
+        sum_isbn = 0
+        digit = 10
+        for char in chars:
+            sum_isbn += digit * int(char)
+            digit -= 1
+        check = 11 - (sum_isbn % 11)
+        if check == 10:
+            return "X"
+        elif check == 11:
+            return "0"
+        else:
+            return str(check)
+
+    @staticmethod
+    def isI10(isbn):
+        """Checks the validity of an ISBN-10 number."""
+        short = ISBNConvert._isbn_strip(isbn)
+        if len(short) != 10:
+            return False
+        chars = list(short)
+        sum_isbn = 0
+        digit = 10
+        for char in chars:
+            if char == 'X' or char == 'x':
+                char = "10"
+            sum_isbn += digit * int(char)
+            digit -= 1
+        remainder = sum_isbn % 11
+        if remainder == 0:
+            return True
+        else:
+            return False
+
+    @staticmethod
+    def _checkI13(stem):
+        """Compute the ISBN-13 check digit based on the first 12 digits of a stripped ISBN-13 number. """
+        chars = list(stem)
+        sumisbn = 0
+        count = 0
+        for char in chars:
+            if count % 2 == 0:
+                sumisbn += int(char)
+            else:
+                sumisbn += 3 * int(char)
+            count += 1
+        check = 10 - (sumisbn % 10)
+        if check == 10:
+            return "0"
+        else:
+            return str(check)
+
+    @staticmethod
+    def isI13(isbn):
+        """Checks the validity of an ISBN-13 number."""
+        short = ISBNConvert._isbn_strip(isbn)
+        if len(short) != 13:
+            return False
+        chars = list(short)
+        sum_isbn = 0
+        count = 0
+        for char in chars:
+            if count % 2 == 0:
+                sum_isbn += int(char)
+            else:
+                sum_isbn += 3 * int(char)
+            count += 1
+        remainder = sum_isbn % 10
+        if remainder == 0:
+            return True
+        else:
+            return False
+
+def identifier_keys(identifiers):
+    """Every lookup key a record can be found under: ASINs, ISBN/EAN as stored, and the other ISBN form (10 <-> 13).
+
+    :param identifiers: Dict[unicode, unicode]: calibre identifiers (amazon, amazon_XX, mobi-asin, isbn, ean, eisbn)
+    :return: Set[unicode]: normalized keys (alphanumeric, upper case)
+    """
+    keys = set()
+    for name, value in identifiers.items():
+        if not value or not (name in (u'isbn', u'ean', u'eisbn', u'mobi-asin') or name.startswith(u'amazon')):
+            continue
+        key = normalize_identifier(value)
+        if not key:
+            continue
+        keys.add(key)
+        if _ISBN_SHAPE.match(key) and ISBNConvert.isValid(key):
+            try:
+                keys.add(ISBNConvert.convert(key))
+            except Exception:
+                # 979 ISBN-13s have no ISBN-10 form
+                pass
+    return keys
+
+def record_keys(file_name, identifiers, extra_keys=()):
+    """
+    :param file_name: unicode: record file name, <identifier>.mi
+    :param identifiers: Dict[unicode, unicode]: the record's calibre identifiers
+    :param extra_keys: Iterable[unicode]: other identifiers of the same book
+    :return: Set[unicode]: every key the record is indexed under
+    """
+    keys = identifier_keys(identifiers)
+    values = list(extra_keys)
+    if file_name.endswith(RECORD_EXTENSION):
+        values.append(file_name[:-len(RECORD_EXTENSION)])
+    for value in values:
+        # identifier_keys only adds the other ISBN form when value looks like an ISBN
+        keys.update(identifier_keys({u'isbn': value}))
+    return keys
+
+def normalize_identifier(value):
+    """
+    :param value: unicode: ASIN, ISBN or EAN, possibly with hyphens or spaces
+    :return: unicode: the identifier in the form used by the cache indexes
+    """
+    return re.sub(r'[^0-9A-Za-z]', u'', value or u'').upper()
+
+class MetadataCache(object):
+    """
+    The METADATA_CACHE_LOCATION directory.
+    """
+
+    def __init__(self, location, record_format=recordformat.BINARY):
+        """
+        :param location: unicode: METADATA_CACHE_LOCATION
+        :param record_format: unicode: recordformat.BINARY or OPF, how new records are written
+        """
+        self.location = location
+        self.record_format = record_format
+        self._names = None
+        self._index = {}
+        self._fetched = {}
+        self._match = None
+        self._manifest_offset = 0
+        self._manifest_stat = None
+        self._lock = threading.Lock()
+
+    def path(self, file_name):
+        """
+        :param file_name: unicode: record file name (<identifier>.mi)
+        :return: unicode: full path
+        """
+        return os.path.join(self.location, file_name)
+
+    def ensure_location(self):
+        """Create the cache directory if needed."""
+        if not os.path.exists(self.location):
+            os.makedirs(self.location)
+
+    def _known_names(self):
+        names = self._names
+        if names is None:
+            try:
+                listing = os.listdir(self.location)
+            except OSError:
+                listing = []
+            names = self._names = set(n for n in listing if n.endswith(RECORD_EXTENSION))
+        return names
+
+    def __contains__(self, file_name):
+        """One listdir per cache object instead of one stat per record; later writes are known from the manifest."""
+        names = self._known_names()
+        with self._lock:
+            self._refresh()
+        return file_name in names
+
+    def read(self, file_name):
+        """
+        :param file_name: unicode: record file name
+        :return: Metadata or None if there is no such record or it cannot be parsed
+        """
+        data = self.read_raw(file_name)
+        if data is None:
+            return None
+        try:
+            return recordformat.load(data)
+        except Exception:
+            return None
+
+    def read_raw(self, file_name):
+        """
+        :param file_name: unicode: record file name
+        :return: bytes or None: the record as stored, binary or OPF
+        """
+        try:
+            with open(self.path(file_name), str('rb')) as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def read_opf(self, file_name):
+        """
+        :param file_name: unicode: record file name
+        :return: bytes or None: the record as an OPF document, whatever form it is stored in
+        """
+        data = self.read_raw(file_name)
+        return recordformat.to_opf(data) if data is not None else None
+
+    def cover_path(self, file_name):
+        """
+        :param file_name: unicode: record file name
+        :return: unicode: where the record's prefetched cover is kept
+        """
+        if file_name.endswith(RECORD_EXTENSION):
+            file_name = file_name[:-len(RECORD_EXTENSION)]
+        return os.path.join(self.location, COVERS, file_name + u'.jpg')
+
+    def read_cover(self, file_name):
+        """
+        :param file_name: unicode: record file name
+        :return: bytes or None
+        """
+        try:
+            with open(self.cover_path(file_name), str('rb')) as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def write_cover(self, file_name, data):
+        """
+        :param file_name: unicode: record file name
+        :param data: bytes: image
+        """
+        path = self.cover_path(file_name)
+        if not os.path.exists(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # another cover thread created it
+                pass
+        atomic_write(path, data)
+
+    def write(self, file_name, mi, keys=()):
+        """Serialize and atomically write a single record.
+
+        :param file_name: unicode: record file name
+        :param mi: Metadata: record
+        :param keys: Iterable[unicode]: identifiers that are not in mi but should find this record (alternate-version ASINs)
+        """
+        return self.write_many([(file_name, mi, keys)])
+
+    def write_many(self, records):
+        """Serialize and atomically write records, then append them to the manifest in one write.
+
+        :param records: List[Tuple[unicode, Metadata, Iterable[unicode]]]: (file name, record, extra keys)
+        :return: List[Tuple[unicode, Exception]]: records that could not be written
+        """
+        serialized = []
+        failed = []
+        for file_name, mi, extra_keys in records:
+            try:
+                serialized.append(self.serialize(file_name, mi, extra_keys))
+            except Exception as e:
+                failed.append((file_name, e))
+        return failed + self.write_serialized(serialized)
+
+    def serialize(self, file_name, mi, extra_keys=()):
+        """Everything write_serialized needs, so that conversion can happen in another process.
+
+        :param file_name: unicode: record file name
+        :param mi: Metadata: record
+        :param extra_keys: Iterable[unicode]: see write
+        :return: Tuple[unicode, bytes, Dict]: file name, record in record_format, manifest fields (ids, keys, title, authors)
+        """
+        if self.record_format == recordformat.OPF:
+            from calibre.ebooks.metadata.opf2 import metadata_to_opf
+            data = metadata_to_opf(mi, default_lang=u'und')
+        else:
+            data = recordformat.encode(mi)
+        ids = mi.get_identifiers()
+        return file_name, data, {u'ids': ids, u'keys': sorted(record_keys(file_name, ids, extra_keys)), u'title': mi.title, u'authors': list(mi.authors or ())}
+
+    def write_serialized(self, records):
+        """Atomically write serialized records, then append them to the manifest in one write.
+
+        :param records: List[Tuple[unicode, bytes, Dict]]: serialize() output
+        :return: List[Tuple[unicode, Exception]]: records that could not be written
+        """
+        entries = []
+        failed = []
+        now = time.time()
+        for file_name, data, fields in records:
+            try:
+                atomic_write(self.path(file_name), data)
+            except Exception as e:
+                failed.append((file_name, e))
+                continue
+            entry = dict(fields)
+            entry.update({u'file': file_name, u'time': now, u'size': len(data)})
+            entries.append(entry)
+        if entries:
+            self._record(entries)
+        return failed
+
+    def _record(self, entries):
+        """Append entries to the manifest; the in-memory indexes read them back on the next lookup."""
+        with self._lock:
+            with open(self.path(MANIFEST), str('ab')) as f:
+                f.write(u''.join(json.dumps(e, sort_keys=True) + u'\n' for e in entries).encode('utf-8'))
+            if self._names is not None:
+                self._names.update(entry[u'file'] for entry in entries)
+
+    def _read_manifest(self, start, end=None):
+        """
+        :param start: int: byte offset of the first entry to read
+        :param end: int or None: byte offset to stop at, the end of the file by default
+        :return: Tuple[List[Dict], int]: complete entries, offset after the last complete line
+        """
+        entries = []
+        try:
+            f = open(self.path(MANIFEST), str('rb'))
+        except IOError:
+            return entries, start
+        with f:
+            f.seek(start)
+            while end is None or start < end:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    # a line another process is still writing, or the partial last line after a crash
+                    break
+                start += len(line)
+                try:
+                    entries.append(json.loads(line.decode('utf-8')))
+                except ValueError:
+                    continue
+        return entries, start
+
+    def _refresh(self):
+        """Read the manifest entries appended since the last call into the in-memory indexes. Call with the lock held."""
+        try:
+            st = os.stat(self.path(MANIFEST))
+        except OSError:
+            return
+        stat = (st.st_size, st.st_mtime)
+        if stat == self._manifest_stat:
+            return
+        if st.st_size < self._manifest_offset:
+            # the manifest was replaced: index it again
+            self._index, self._fetched, self._manifest_offset = {}, {}, 0
+            if self._match is not None:
+                self._match = LocalMatchIndex()
+        entries, self._manifest_offset = self._read_manifest(self._manifest_offset)
+        self._manifest_stat = stat
+        for entry in entries:
+            file_name = entry[u'file']
+            for key in entry.get(u'keys') or record_keys(file_name, entry.get(u'ids') or {}):
+                self._index[key] = file_name
+            self._fetched[file_name] = entry.get(u'time') or 0
+            if self._names is not None:
+                self._names.add(file_name)
+            if self._match is not None and entry.get(u'title'):
+                self._match.add(file_name, entry[u'title'], entry.get(u'authors'))
+
+    def identity_index(self):
+        """
+        :return: Dict[unicode, unicode]: normalized identifier -> record file name
+        """
+        with self._lock:
+            self._refresh()
+            return self._index
+
+    def match_index(self):
+        """
+        Records written before titles were kept in the manifest are only indexed after reindex().
+        :return: LocalMatchIndex: fuzzy title/author index
+        """
+        with self._lock:
+            self._refresh()
+            if self._match is None:
+                # up to where the identity index got, _refresh adds the rest
+                match = LocalMatchIndex()
+                for entry in self._read_manifest(0, self._manifest_offset)[0]:
+                    if entry.get(u'title'):
+                        match.add(entry[u'file'], entry[u'title'], entry.get(u'authors'))
+                self._match = match
+            return self._match
+
+    def fetched_at(self, file_name):
+        """
+        :param file_name: unicode: record file name
+        :return: float or None: when the record was downloaded (the file time for records that are not in the manifest)
+        """
+        with self._lock:
+            self._refresh()
+            fetched = self._fetched.get(file_name)
+        if fetched is None:
+            try:
+                fetched = os.path.getmtime(self.path(file_name))
+            except OSError:
+                return None
+        return fetched
+
+    def find(self, identifiers):
+        """
+        :param identifiers: Dict[unicode, unicode]: calibre identifiers
+        :return: unicode or None: file name of the record any of the identifiers belongs to
+        """
+        index = self.identity_index()
+        keys = sorted(identifier_keys(identifiers))
+        for key in keys:
+            file_name = index.get(key)
+            if file_name is not None:
+                return file_name
+        # records written before the manifest existed are only known by their file name
+        for key in keys:
+            if os.path.isfile(self.path(key + RECORD_EXTENSION)):
+                return key + RECORD_EXTENSION
+        return None
+
+    def reindex(self, log=None):
+        """Add the records that are not in the manifest, or are in it without their title (written by older versions), to it.
+
+        :param log: calibre Log or None
+        :return: int: number of records added
+        """
+        indexed = set(entry[u'file'] for entry in self.manifest() if u'title' in entry)
+        self._names = None
+        entries = []
+        for file_name in sorted(self._known_names() - indexed):
+            path = self.path(file_name)
+            try:
+                with open(path, str('rb')) as f:
+                    mi = recordformat.load(f.read())
+                ids = mi.get_identifiers()
+            except Exception:
+                if log is not None:
+                    log.error(u'reindex: skipping unreadable record', file_name)
+                continue
+            entries.append({u'file': file_name, u'time': self.fetched_at(file_name), u'size': os.path.getsize(path), u'ids': ids,
+                            u'keys': sorted(record_keys(file_name, ids)), u'title': mi.title, u'authors': list(mi.authors or ())})
+        if entries:
+            self._record(entries)
+        return len(entries)
+
+    def export_opf(self, directory, log=None):
+        """Write every record as an OPF document, <identifier>.opf, whatever form it is kept in.
+
+        :param directory: unicode: destination, created if needed
+        :param log: calibre Log or None
+        :return: int: number of records written
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        written = 0
+        for file_name in sorted(self._known_names()):
+            try:
+                data = self.read_opf(file_name)
+            except Exception:
+                data = None
+            if data is None:
+                if log is not None:
+                    log.error(u'export: skipping unreadable record', file_name)
+                continue
+            atomic_write(os.path.join(directory, file_name[:-len(RECORD_EXTENSION)] + u'.opf'), data)
+            written += 1
+        return written
+
+    def manifest(self):
+        """
+        :return: iterator over the manifest entries (Dict), oldest first; a file may appear more than once
+        """
+        try:
+            f = open(self.path(MANIFEST), str('rb'))
+        except IOError:
+            return
+        with f:
+            for line in f:
+                try:
+                    yield json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # partial last line after a crash
+                    continue
+
+class BulkOPFWriter(object):
+    """
+    Serializes and writes records on a worker thread, batch_size records at a time.
+    put() blocks when queue_size records are waiting, so a fast producer cannot run out of memory.
+
+    Use as a context manager, or call start() and close().
+    """
+    _STOP = object()
+
+    def __init__(self, cache, log=None, batch_size=100, queue_size=1000):
+        self.cache = cache
+        self.log = log
+        self.batch_size = batch_size
+        self.written = 0
+        self.failed = 0
+        self._queue = Queue(queue_size)
+        self._thread = None
+        self._pending = set()
+
+    def start(self):
+        """Start the worker thread."""
+        self.cache.ensure_location()
+        self._thread = threading.Thread(target=self._run, name=str('BulkOPFWriter'))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __contains__(self, file_name):
+        """True if the record is on disk or queued."""
+        return file_name in self._pending or file_name in self.cache
+
+    def put(self, file_name, mi, keys=()):
+        """
+        :param file_name: unicode: record file name
+        :param mi: Metadata: record
+        :param keys: Iterable[unicode]: extra identifiers, see MetadataCache.write
+        """
+        self._pending.add(file_name)
+        self._queue.put((False, (file_name, mi, tuple(keys))))
+
+    def put_serialized(self, record):
+        """
+        :param record: Tuple[unicode, bytes, Dict]: MetadataCache.serialize output, converted elsewhere
+        """
+        self._pending.add(record[0])
+        self._queue.put((True, record))
+
+    def close(self):
+        """Write everything still queued and stop the worker thread."""
+        if self._thread is not None:
+            self._queue.put(self._STOP)
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            # take whatever else is already waiting, up to batch_size
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get())
+            if self._STOP in batch:
+                batch.remove(self._STOP)
+                stop = True
+            if not batch:
+                continue
+            failed = self.cache.write_many([r for serialized, r in batch if not serialized])
+            failed += self.cache.write_serialized([r for serialized, r in batch if serialized])
+            self.written += len(batch) - len(failed)
+            self.failed += len(failed)
+            if self.log is not None:
+                for file_name, e in failed:
+                    self.log.error(u'Failed to write', file_name, u':', e)
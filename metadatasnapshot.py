@@ -0,0 +1,211 @@
+"""
+MetadataSnapshot
+"""
+# coding=utf-8
+#
+# Read-only, memory-mapped snapshot of METADATA_CACHE_LOCATION.
+#
+# compile_snapshot() packs every cached record into one file:
+#
+#   header   magic, version, payload format, record count, key count, index offset
+#   records  the payloads, back to back
+#   index    fixed width entries (key, payload offset, payload length, fetch time) sorted by key
+#
+# Keys are the normalized identifiers of metadatacache.identifier_keys plus the
+# identity index entries: ASIN, ISBN-10, ISBN-13, EAN and alternate-version ASINs
+# all point to the same payload. Payloads are recordformat binary records,
+# whatever form the cached files are in (version 2 snapshots compiled by older
+# versions hold OPF and are still read; version 1 snapshots have no fetch times
+# and are refused, so identify uses the record files until --export-snapshot
+# is run again). MetadataSnapshot maps the file read-only and binary-searches
+# the index in place, so calibre worker processes share the page cache instead
+# of each parsing OPF files, and a payload is only decoded when it is asked
+# for: payload() returns a view of the mapping, not a copy.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import io
+import mmap
+import os
+import struct
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.metadatacache import RECORD_EXTENSION, identifier_keys, normalize_identifier
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from metadatacache import RECORD_EXTENSION, identifier_keys, normalize_identifier
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI import recordformat
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    import recordformat
+
+SNAPSHOT = u'metadata.snapshot'
+
+MAGIC = b'APMS'
+VERSION = 2
+#: Payload formats
+PAYLOAD_OPF = 1
+PAYLOAD_RECORD = 2
+
+_HEADER = struct.Struct(str('<4sHHIIQ'))
+KEY_SIZE = 16
+_ENTRY = struct.Struct(str('<%dsQII' % KEY_SIZE))
+
+try:
+    _view = buffer
+except NameError:
+    # Python 3 has no buffer; Python 2's mmap has no memoryview
+    def _view(data, offset, length):
+        return memoryview(data)[offset:offset + length]
+
+class SnapshotError(Exception):
+    """The file is not a snapshot this code can read."""
+
+def _key_bytes(key):
+    return normalize_identifier(key).encode('ascii', 'ignore')[:KEY_SIZE].ljust(KEY_SIZE, b'\0')
+
+def compile_snapshot(cache, path=None, log=None):
+    """Pack every record of a MetadataCache into a snapshot file (written to a temporary file, then renamed).
+
+    :param cache: metadatacache.MetadataCache
+    :param path: unicode: destination, defaults to SNAPSHOT inside the cache directory
+    :param log: calibre Log or None
+    :return: Tuple[int, int]: number of records and of keys written
+    """
+    path = path or cache.path(SNAPSHOT)
+    tmp = path + u'.tmp'
+    entries = []
+    records = 0
+    indexed_keys = {}
+    for key, file_name in cache.identity_index().items():
+        indexed_keys.setdefault(file_name, set()).add(key)
+    with open(tmp, str('wb')) as out:
+        out.write(_HEADER.pack(MAGIC, VERSION, PAYLOAD_RECORD, 0, 0, 0))
+        for file_name in sorted(os.listdir(cache.location)):
+            if not file_name.endswith(RECORD_EXTENSION):
+                continue
+            try:
+                with open(cache.path(file_name), str('rb')) as f:
+                    payload = f.read()
+                if recordformat.is_record(payload):
+                    # the payload is kept as it is: only its identifiers are needed
+                    identifiers = recordformat.Record(payload).identifiers
+                else:
+                    mi = recordformat.load(payload)
+                    identifiers = mi.get_identifiers()
+                    payload = recordformat.encode(mi)
+            except Exception:
+                if log is not None:
+                    log.error(u'snapshot: skipping unreadable record', file_name)
+                continue
+            keys = identifier_keys(identifiers)
+            keys.add(normalize_identifier(file_name[:-len(RECORD_EXTENSION)]))
+            keys.update(indexed_keys.get(file_name, ()))
+            offset = out.tell()
+            out.write(payload)
+            records += 1
+            fetched = int(cache.fetched_at(file_name) or 0)
+            entries.extend((_key_bytes(k), offset, len(payload), fetched) for k in keys if k)
+        entries.sort()
+        # keep the first payload when two records claim the same key
+        index = []
+        for entry in entries:
+            if not index or index[-1][0] != entry[0]:
+                index.append(entry)
+        index_offset = out.tell()
+        for entry in index:
+            out.write(_ENTRY.pack(*entry))
+        out.seek(0)
+        out.write(_HEADER.pack(MAGIC, VERSION, PAYLOAD_RECORD, records, len(index), index_offset))
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp, path)
+    return records, len(index)
+
+class MetadataSnapshot(object):
+    """
+    A compiled snapshot, mapped read-only.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, str('rb'))
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, self.payload_format, self.records, self.keys, self._index_offset = _HEADER.unpack_from(self._map, 0)
+        except Exception:
+            self._file.close()
+            raise
+        if magic != MAGIC:
+            self.close()
+            raise SnapshotError(u'%s is not a snapshot' % path)
+        if version != VERSION:
+            self.close()
+            raise SnapshotError(u'%s is a version %d snapshot, not %d: run --export-snapshot again' % (path, version, VERSION))
+        self.mtime = os.path.getmtime(path)
+
+    def close(self):
+        """Unmap and close the file."""
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # a payload view is still held: the mapping goes when the last one does
+                pass
+            self._map = None
+        self._file.close()
+
+    def _find(self, key):
+        target = _key_bytes(key)
+        lo, hi = 0, self.keys
+        base, size = self._index_offset, _ENTRY.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = base + mid * size
+            found = self._map[pos:pos + KEY_SIZE]
+            if found < target:
+                lo = mid + 1
+            elif found > target:
+                hi = mid
+            else:
+                return _ENTRY.unpack_from(self._map, pos)[1:]
+        return None
+
+    def __contains__(self, identifier):
+        return bool(identifier) and self._find(identifier) is not None
+
+    def payload(self, identifier):
+        """
+        :param identifier: unicode: ASIN, ISBN-10, ISBN-13 or EAN
+        :return: buffer (memoryview on Python 3) or None: the raw payload, read from the mapping without a copy
+        """
+        if not identifier:
+            return None
+        found = self._find(identifier)
+        if found is None:
+            return None
+        offset, length, fetched = found
+        return _view(self._map, offset, length)
+
+    def fetched_at(self, identifier):
+        """
+        :param identifier: unicode: ASIN, ISBN-10, ISBN-13 or EAN
+        :return: int or None: when the record was downloaded (seconds since the epoch)
+        """
+        found = self._find(identifier) if identifier else None
+        return found[2] if found is not None else None
+
+    def get_metadata(self, identifier):
+        """
+        :param identifier: unicode: ASIN, ISBN-10, ISBN-13 or EAN
+        :return: Metadata or None
+        """
+        payload = self.payload(identifier)
+        if payload is None:
+            return None
+        if self.payload_format == PAYLOAD_RECORD:
+            return recordformat.decode(payload)
+        from calibre.ebooks.metadata.opf import get_metadata
+        return get_metadata(io.BytesIO(payload))[0]
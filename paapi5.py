@@ -0,0 +1,435 @@
+"""
+Paapi5API
+"""
+# coding=utf-8
+#
+# Product Advertising API 5.0 backend: GetItems and SearchItems, JSON over POST,
+# signed with AWS Signature Version 4.
+#
+# Paapi5API has AmazonAPI's interface (item_lookup, item_search,
+# item_lookup_raw, parse_products, upgrade, hedging) and returns Paapi5Product
+# objects with the AmazonProduct properties the plugin uses. Throttling,
+# deadlines, abort, metrics and the response cache are the ones of
+# BottlenoseAmazon, which _Paapi5Call only teaches to build signed POST requests.
+#
+# Differences with the XML API:
+#   - ResponseGroups are translated to the Resources they need (RESOURCES);
+#     AlternateVersions and EditorialReview have no PA-API 5 equivalent.
+#   - GetItems only takes ASINs, 10 per call: longer lookups are split. ISBN
+#     lookups are one SearchItems per ISBN.
+#   - Endpoint (or $PAAPI5_ENDPOINT) replaces https://<marketplace host>, e.g.
+#     with a local stand-in server for tests.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import threading
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.amazonsimpleproductapi import (AmazonAPI, BottlenoseAmazon, RESPONSE_PROFILES, SearchException,
+                                                                                     RequestCancelled, CancelledException)
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from amazonsimpleproductapi import AmazonAPI, BottlenoseAmazon, RESPONSE_PROFILES, SearchException, RequestCancelled, CancelledException
+
+try:
+    import urllib2
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    import urllib.request as urllib2
+
+try:
+    unicode
+except NameError:
+    # noinspection PyShadowingBuiltins
+    unicode = str
+
+SERVICE = u'ProductAdvertisingAPI'
+#: Region code -> (host, AWS region, marketplace)
+MARKETPLACES = {u'AU': (u'webservices.amazon.com.au', u'us-west-2', u'www.amazon.com.au'), u'BR': (u'webservices.amazon.com.br', u'us-east-1', u'www.amazon.com.br'),
+                u'CA': (u'webservices.amazon.ca', u'us-east-1', u'www.amazon.ca'), u'DE': (u'webservices.amazon.de', u'eu-west-1', u'www.amazon.de'),
+                u'ES': (u'webservices.amazon.es', u'eu-west-1', u'www.amazon.es'), u'FR': (u'webservices.amazon.fr', u'eu-west-1', u'www.amazon.fr'),
+                u'IN': (u'webservices.amazon.in', u'eu-west-1', u'www.amazon.in'), u'IT': (u'webservices.amazon.it', u'eu-west-1', u'www.amazon.it'),
+                u'JP': (u'webservices.amazon.co.jp', u'us-west-2', u'www.amazon.co.jp'), u'MX': (u'webservices.amazon.com.mx', u'us-east-1', u'www.amazon.com.mx'),
+                u'UK': (u'webservices.amazon.co.uk', u'eu-west-1', u'www.amazon.co.uk'), u'US': (u'webservices.amazon.com', u'us-east-1', u'www.amazon.com')}
+OPERATIONS = {u'GetItems': u'/paapi5/getitems', u'SearchItems': u'/paapi5/searchitems'}
+TARGET_PREFIX = u'com.amazon.paapi5.v1.ProductAdvertisingAPIv1.'
+#: Request fields sent in the JSON body, by operation; everything else in the call kwargs is for the client
+BODY_FIELDS = {u'GetItems': (u'ItemIdType', u'ItemIds', u'Resources'),
+               u'SearchItems': (u'Author', u'ItemCount', u'ItemPage', u'Keywords', u'Resources', u'SearchIndex', u'Title')}
+#: The Resources each XML ResponseGroup of RESPONSE_PROFILES translates to
+RESOURCES = {u'Images': (u'Images.Primary.Large',),
+             u'ItemAttributes': (u'ItemInfo.ByLineInfo', u'ItemInfo.Classifications', u'ItemInfo.ContentInfo', u'ItemInfo.ExternalIds', u'ItemInfo.ProductInfo',
+                                 u'ItemInfo.Title'), u'BrowseNodes': (u'BrowseNodeInfo.BrowseNodes',), u'AlternateVersions': (), u'EditorialReview': ()}
+#: Error codes of an empty search
+NO_RESULTS = (u'NoResults',)
+#: Most ItemIds of a GetItems call
+GET_ITEMS_MAX = 10
+
+def _hmac(key, msg):
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+def sigv4_headers(access_key, secret_key, region, service, method, host, path, headers, payload, now=None):
+    """AWS Signature Version 4.
+
+    :param access_key: unicode: AWS access key id
+    :param secret_key: unicode: AWS secret key
+    :param region: unicode: AWS region, us-east-1...
+    :param service: unicode: AWS service name
+    :param method: unicode: HTTP method
+    :param host: unicode: Host header
+    :param path: unicode: URL path, no query string
+    :param headers: Dict[unicode, unicode]: headers to sign besides host and x-amz-date (lower case names)
+    :param payload: bytes: request body
+    :param now: datetime.datetime or None: UTC signing time
+    :return: Dict[unicode, unicode]: every signed header plus Authorization
+    """
+    now = now or datetime.datetime.utcnow()
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    date = amz_date[:8]
+    signed = dict((k.lower(), v) for k, v in headers.items())
+    signed.update({u'host': host, u'x-amz-date': amz_date})
+    names = sorted(signed)
+    signed_headers = u';'.join(names)
+    canonical_request = u'\n'.join([method, path, u'', u''.join(u'%s:%s\n' % (k, signed[k].strip()) for k in names), signed_headers,
+                                    hashlib.sha256(payload).hexdigest()])
+    scope = u'%s/%s/%s/aws4_request' % (date, region, service)
+    string_to_sign = u'\n'.join([u'AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+    key = (u'AWS4' + secret_key).encode('utf-8')
+    for part in (date, region, service, u'aws4_request'):
+        key = _hmac(key, part)
+    signature = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+    signed[u'Authorization'] = u'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s' % (access_key, scope, signed_headers, signature)
+    return signed
+
+def resources(groups):
+    """
+    :param groups: Iterable[unicode]: XML ResponseGroups
+    :return: List[unicode]: PA-API 5 Resources
+    """
+    result = set()
+    for group in groups:
+        result.update(RESOURCES.get(group, ()))
+    return sorted(result)
+
+class _Paapi5Call(BottlenoseAmazon):
+    """
+    BottlenoseAmazon's call_api (throttle, deadline, abort, cache, metrics, gzip) over signed JSON POST requests.
+    """
+
+    def __init__(self, Endpoint=None, **kwargs):
+        BottlenoseAmazon.__init__(self, **kwargs)
+        self.Endpoint = Endpoint
+
+    def _body(self, kwargs):
+        body = dict((k, kwargs[k]) for k in BODY_FIELDS[kwargs[u'Operation']] if kwargs.get(k) is not None)
+        body.update({u'PartnerTag': self.AssociateTag, u'PartnerType': u'Associates', u'Marketplace': MARKETPLACES[self.Region][2]})
+        return body
+
+    def _url(self, operation):
+        host = MARKETPLACES[self.Region][0]
+        return (self.Endpoint or u'https://' + host).rstrip(u'/') + OPERATIONS[operation]
+
+    def cache_url(self, **kwargs):
+        body = self._body(kwargs)
+        body.pop(u'PartnerTag')
+        return self._url(kwargs[u'Operation']) + u'?' + json.dumps(body, sort_keys=True)
+
+    def _api_url(self, **kwargs):
+        operation = kwargs[u'Operation']
+        region = MARKETPLACES[self.Region][1]
+        url = self._url(operation)
+        # the Host header urllib2 will send, which is the Endpoint's when there is one
+        host = url.split(u'://', 1)[1].split(u'/', 1)[0]
+        payload = json.dumps(self._body(kwargs), sort_keys=True).encode('utf-8')
+        secret = self.AWSSecretAccessKey
+        if isinstance(secret, bytes):
+            secret = secret.decode('utf-8')
+        headers = sigv4_headers(self.AWSAccessKeyId, secret, region, SERVICE, u'POST', host, OPERATIONS[operation],
+                                {u'content-encoding': u'amz-1.0', u'content-type': u'application/json; charset=utf-8',
+                                 u'x-amz-target': TARGET_PREFIX + operation}, payload)
+        headers[u'Accept-Encoding'] = u'gzip'
+        return urllib2.Request(url, data=payload, headers=dict((str(k), str(v)) for k, v in headers.items()))
+
+    def _call_api(self, api_url, timeout=None):
+        try:
+            return BottlenoseAmazon._call_api(self, api_url, timeout)
+        except urllib2.HTTPError as e:
+            # invalid requests and empty searches come back as 400/404 with the error in the JSON body
+            if e.code in (400, 404):
+                return e
+            raise
+
+    def _cacheable(self, response):
+        # error responses are parsed, never cached
+        return not isinstance(response, urllib2.HTTPError)
+
+class _Node(object):
+    """A browse node: name.text like the XML one."""
+
+    class _Name(unicode):
+        @property
+        def text(self):
+            return unicode(self)
+
+    def __init__(self, node):
+        self.id = node.get(u'Id')
+        self.name = self._Name(node.get(u'DisplayName') or node.get(u'ContextFreeName') or u'')
+
+class Paapi5Product(object):
+    """
+    A GetItems/SearchItems item, with the AmazonProduct properties the plugin uses.
+    """
+
+    def __init__(self, item, response_groups=None):
+        """
+        :param item: Dict: the item JSON
+        :param response_groups: Iterable[unicode] or None: the ResponseGroups it was fetched for, None if unknown
+        """
+        self.item = item
+        self.response_groups = frozenset(response_groups) if response_groups is not None else None
+
+    def __str__(self):
+        return self.title or u''
+
+    __unicode__ = __str__
+
+    def _get(self, path, default=None):
+        value = self.item
+        for part in path.split(u'.'):
+            if not isinstance(value, dict):
+                return default
+            value = value.get(part)
+        return default if value is None else value
+
+    def _values(self, path):
+        return [unicode(v) for v in self._get(path + u'.DisplayValues', [])]
+
+    @staticmethod
+    def _date(value):
+        if not value:
+            return None
+        try:
+            return datetime.datetime.strptime(value[:10], '%Y-%m-%d').date()
+        except ValueError:
+            return None
+
+    def to_string(self):
+        return json.dumps(self.item, indent=1, sort_keys=True)
+
+    def missing_groups(self, profile=u'full'):
+        """See AmazonProduct.missing_groups; groups without a PA-API 5 resource are never missing."""
+        if self.response_groups is None:
+            return frozenset()
+        return frozenset(g for g in RESPONSE_PROFILES[profile].split(u',') if RESOURCES.get(g)) - self.response_groups
+
+    def merge(self, other):
+        """
+        :param other: Paapi5Product: same ASIN, fetched with other resources
+        """
+
+        def merge(into, source):
+            for key, value in source.items():
+                if key not in into:
+                    into[key] = value
+                elif isinstance(into[key], dict) and isinstance(value, dict):
+                    merge(into[key], value)
+
+        merge(self.item, other.item)
+        if self.response_groups is not None and other.response_groups is not None:
+            self.response_groups = self.response_groups | other.response_groups
+        else:
+            self.response_groups = None
+
+    @property
+    def asin(self):
+        return self.item.get(u'ASIN')
+
+    @property
+    def title(self):
+        return self._get(u'ItemInfo.Title.DisplayValue')
+
+    def _contributors(self):
+        return self._get(u'ItemInfo.ByLineInfo.Contributors', [])
+
+    @property
+    def authors(self):
+        return [c.get(u'Name') for c in self._contributors() if (c.get(u'RoleType') or c.get(u'Role') or u'').lower() == u'author' and c.get(u'Name')]
+
+    @property
+    def creators(self):
+        return [(c.get(u'Name'), c.get(u'Role')) for c in self._contributors() if (c.get(u'RoleType') or c.get(u'Role') or u'').lower() != u'author']
+
+    @property
+    def publisher(self):
+        return self._get(u'ItemInfo.ByLineInfo.Manufacturer.DisplayValue')
+
+    @property
+    def isbn(self):
+        isbns = self._values(u'ItemInfo.ExternalIds.ISBNs')
+        return isbns[0] if isbns else None
+
+    @property
+    def eisbn(self):
+        return None
+
+    @property
+    def ean(self):
+        eans = self._values(u'ItemInfo.ExternalIds.EANs')
+        return eans[0] if eans else None
+
+    @property
+    def binding(self):
+        return self._get(u'ItemInfo.Classifications.Binding.DisplayValue')
+
+    @property
+    def publication_date(self):
+        return self._date(self._get(u'ItemInfo.ContentInfo.PublicationDate.DisplayValue'))
+
+    @property
+    def release_date(self):
+        return self._date(self._get(u'ItemInfo.ProductInfo.ReleaseDate.DisplayValue'))
+
+    @property
+    def large_image_url(self):
+        return self._get(u'Images.Primary.Large.URL')
+
+    @property
+    def languages(self):
+        return set(l.get(u'DisplayValue', u'').lower() for l in self._get(u'ItemInfo.ContentInfo.Languages.DisplayValues', []) if l.get(u'DisplayValue'))
+
+    @property
+    def editorial_review(self):
+        return u''
+
+    @property
+    def browse_nodes(self):
+        return [_Node(n) for n in self._get(u'BrowseNodeInfo.BrowseNodes', [])]
+
+    @property
+    def alternate_versions(self):
+        return []
+
+class Paapi5API(AmazonAPI):
+    """
+    AmazonAPI over the Product Advertising API 5.0.
+    """
+
+    def __init__(self, aws_key=os.environ.get(u'AWS_ACCESS_KEY_ID'), aws_secret=os.environ.get(u'AWS_SECRET_ACCESS_KEY'),
+                 aws_associate_tag=os.environ.get(u'AWS_ASSOCIATE_TAG'), Region=u'US', MaxQPS=None, Timeout=None, CacheReader=None, CacheWriter=None, Metrics=None,
+                 Hedge=None, HedgeBudget=0.1, Breaker=None, Quota=None, Scheduler=None, Endpoint=os.environ.get(u'PAAPI5_ENDPOINT')):
+        """
+        Same parameters as AmazonAPI, plus:
+        :param Endpoint: unicode or None: scheme://host[:port] to send the requests to instead of the marketplace's host
+        """
+        if Region not in MARKETPLACES:
+            raise ValueError(u'No Product Advertising API 5.0 marketplace for region %s' % Region)
+        if Hedge and Metrics is None:
+            try:
+                from calibre_plugins.AmazonProductAdvertisingAPI.apimetrics import ApiMetrics
+            except ImportError:
+                # noinspection PyUnresolvedReferences
+                from apimetrics import ApiMetrics
+            Metrics = ApiMetrics()
+        self.breaker = Breaker
+        self.hedge = Hedge
+        self.hedge_budget = HedgeBudget
+        self._hedge_lock = threading.Lock()
+        self._hedge_calls = 0
+        self._hedges = 0
+        self.metrics = Metrics
+        self.api = _Paapi5Call(Endpoint=Endpoint, AWSAccessKeyId=aws_key, AWSSecretAccessKey=aws_secret, AssociateTag=aws_associate_tag, Region=Region, Timeout=Timeout,
+                               MaxQPS=MaxQPS, CacheReader=CacheReader, CacheWriter=CacheWriter, Metrics=Metrics, Quota=Quota,
+                               Scheduler=Scheduler, Parser=json.loads)
+
+    @staticmethod
+    def _groups(ResponseGroup, Profile):
+        if Profile:
+            ResponseGroup = RESPONSE_PROFILES[Profile]
+        if not ResponseGroup or ResponseGroup == u'Large':
+            ResponseGroup = RESPONSE_PROFILES[u'full']
+        return ResponseGroup
+
+    def item_lookup(self, ItemId, IdType=u'ASIN', ResponseGroup=u'Large', Profile=None, **kwargs):
+        """One GetItems per GET_ITEMS_MAX ASINs, one SearchItems per ISBN/EAN otherwise.
+
+        :return: List[Paapi5Product]
+        """
+        groups = self._groups(ResponseGroup, Profile)
+        kwargs.update({u'ResponseGroup': groups, u'Resources': resources(groups.split(u','))})
+        ids = [i for i in unicode(ItemId).split(u',') if i]
+        if IdType == u'ASIN':
+            calls = [dict(kwargs, Operation=u'GetItems', ItemIds=ids[x:x + GET_ITEMS_MAX], ItemIdType=u'ASIN')
+                     for x in range(0, len(ids), GET_ITEMS_MAX)]
+        else:
+            calls = [dict(kwargs, Operation=u'SearchItems', Keywords=item_id, ItemCount=1) for item_id in ids]
+        products = []
+        error = None
+        for call in calls:
+            try:
+                products.extend(self._search(**call))
+            except SearchException as e:
+                error = e
+        if not products and error is not None:
+            raise error
+        return products
+
+    def item_lookup_raw(self, ItemId, IdType=u'ASIN', ResponseGroup=u'Large', Profile=None, **kwargs):
+        """
+        :return: bytes: GetItems response JSON; for more than GET_ITEMS_MAX ASINs, or ISBNs, the results of every call gathered into
+                 one GetItems-like response
+        """
+        groups = self._groups(ResponseGroup, Profile)
+        kwargs.update({u'ResponseGroup': groups, u'Resources': resources(groups.split(u',')), u'Parse': False})
+        ids = [i for i in unicode(ItemId).split(u',') if i]
+        if IdType == u'ASIN':
+            calls = [dict(kwargs, Operation=u'GetItems', ItemIds=ids[x:x + GET_ITEMS_MAX], ItemIdType=u'ASIN')
+                     for x in range(0, len(ids), GET_ITEMS_MAX)]
+        else:
+            calls = [dict(kwargs, Operation=u'SearchItems', Keywords=item_id, ItemCount=1) for item_id in ids]
+        try:
+            if len(calls) == 1 and IdType == u'ASIN':
+                return self._send(**calls[0])
+            items = []
+            errors = []
+            for call in calls:
+                response = json.loads(self._send(**call).decode('utf-8'))
+                items.extend(((response.get(u'ItemsResult') or response.get(u'SearchResult')) or {}).get(u'Items') or [])
+                errors.extend(response.get(u'Errors') or [])
+        except RequestCancelled as e:
+            raise CancelledException(e.reason, u'lookup cancelled')
+        response = {u'ItemsResult': {u'Items': items}} if items else {u'Errors': errors}
+        return json.dumps(response).encode('utf-8')
+
+    def item_search(self, ResponseGroup=u'Large', **kwargs):
+        """SearchItems with Title, Author, Keywords and SearchIndex.
+
+        :return: List[Paapi5Product]
+        """
+        groups = self._groups(ResponseGroup, kwargs.pop(u'Profile', None))
+        kwargs.update({u'Operation': u'SearchItems', u'ResponseGroup': groups, u'Resources': resources(groups.split(u',')), u'ItemCount': 10})
+        return self._search(**kwargs)
+
+    @staticmethod
+    def parse_products(raw, metrics=None, request=None):
+        """
+        :param raw: bytes or Dict: response JSON
+        :return: List[Paapi5Product]
+        :raise SearchException: when the response holds no item
+        """
+        response = json.loads(raw.decode('utf-8')) if isinstance(raw, bytes) else raw
+        result = response.get(u'ItemsResult') or response.get(u'SearchResult') or {}
+        items = result.get(u'Items') or []
+        if not items:
+            error = (response.get(u'Errors') or [{}])[0]
+            code, msg = error.get(u'Code', u'NoResults'), error.get(u'Message', u'')
+            if metrics:
+                metrics.inc(u'api_errors_total', code=code, operation=(request or {}).get(u'Operation'))
+                metrics.emit(u'api_error', code=code, msg=msg, request=request)
+            raise SearchException(code, msg)
+        groups = (request or {}).get(u'ResponseGroup')
+        return [Paapi5Product(item, groups.split(u',') if groups else None) for item in items]
@@ -0,0 +1,271 @@
+"""
+QuotaLedger
+"""
+# coding=utf-8
+#
+# Request quota shared by every process using the same API account.
+#
+# MaxQPS only spaces the requests of one process apart. The ledger counts the
+# requests actually sent, by every process pointing at the same file (calibre's
+# identify, cli_main batches), against rolling-window limits such as 3600
+# requests per hour. Each request takes one unit through acquire(), which waits
+# for the oldest requests to leave the window when the budget is spent; refund()
+# gives it back when the request is cancelled before it is sent.
+#
+# A batch job can reserve() part of the budget up front: the units it reserved
+# and has not used yet are held back from the other callers, so interactive
+# identify cannot eat into a planned run, and vice versa. Reservations expire
+# so that a crashed batch does not hold its share forever.
+#
+# The ledger is a small JSON file: request counts per minute over the longest
+# window, and the reservations. Every read-modify-write happens under an
+# exclusive lock on <file>.lock (flock, or msvcrt on Windows).
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    # noinspection PyUnresolvedReferences
+    import msvcrt
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.metadatacache import atomic_write
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from metadatacache import atomic_write
+
+try:
+    unicode
+except NameError:
+    # noinspection PyShadowingBuiltins
+    unicode = str
+
+QUOTA = u'quota.json'
+#: Width of the ledger's counting buckets, in seconds: windows roll forward by this much
+BUCKET = 60
+#: Default lifetime of a reservation, in seconds
+RESERVATION_TTL = 3600
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on path (created if needed) across processes and machines sharing the file; not reentrant.
+
+    :param path: unicode: lock file
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # another process created it
+            if not os.path.isdir(directory):
+                raise
+    with open(path, str('a+b')) as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+class QuotaLedger(object):
+    """
+    Rolling-window request counts in a file locked across processes.
+    """
+
+    def __init__(self, path, limits):
+        """
+        :param path: unicode: ledger file
+        :param limits: Dict[int, int]: most requests per window, by window length in seconds (3600: 3600 for one per second
+                       on average over an hour)
+        """
+        self.path = path
+        self.limits = dict((int(w), int(n)) for w, n in limits.items() if n)
+        self.reservation = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            with file_lock(self.path + u'.lock'):
+                yield
+
+    def _load(self, now):
+        """
+        :return: Dict: buckets (start -> count) still inside the longest window, unexpired reservations
+        """
+        try:
+            with open(self.path, str('rb')) as f:
+                state = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            state = {}
+        horizon = now - max(self.limits or {0: 0})
+        buckets = dict((int(k), v) for k, v in (state.get(u'buckets') or {}).items() if int(k) + BUCKET > horizon)
+        reservations = dict((k, r) for k, r in (state.get(u'reservations') or {}).items() if r[u'expires'] > now and r[u'used'] < r[u'count'])
+        return {u'buckets': buckets, u'reservations': reservations}
+
+    def _save(self, state):
+        state = {u'buckets': dict((unicode(k), v) for k, v in state[u'buckets'].items()), u'reservations': state[u'reservations']}
+        atomic_write(self.path, json.dumps(state, sort_keys=True).encode('utf-8'))
+
+    def _available(self, state, now, reservation):
+        """
+        :return: Tuple[int, float]: units this caller may use now, and seconds until the next unit frees up when that is 0
+        """
+        held = sum(r[u'count'] - r[u'used'] for k, r in state[u'reservations'].items() if k != reservation)
+        own = state[u'reservations'].get(reservation)
+        available = None
+        wait = 0.0
+        for window, limit in self.limits.items():
+            in_window = sorted((b, n) for b, n in state[u'buckets'].items() if b + BUCKET > now - window)
+            left = limit - sum(n for b, n in in_window) - held
+            if left <= 0:
+                # the window frees up as its oldest buckets leave it; if that is not enough (reservations), check again later
+                freed = 0
+                frees_at = now + BUCKET
+                for b, n in in_window:
+                    freed += n
+                    if freed >= 1 - left:
+                        frees_at = b + BUCKET + window
+                        break
+                wait = max(wait, frees_at - now)
+            available = left if available is None else min(available, left)
+        if own is not None and (available is None or available < own[u'count'] - own[u'used']):
+            # a reservation is only held back from the others
+            available = own[u'count'] - own[u'used']
+            wait = 0.0
+        return (available if available is not None else 1), wait
+
+    def try_acquire(self, reservation=None):
+        """
+        Take one unit if there is one.
+        :param reservation: unicode or None: reserve() id to draw from, self.reservation by default
+        :return: float: 0 when taken, else seconds until a unit could be
+        """
+        reservation = reservation or self.reservation
+        now = time.time()
+        with self._locked():
+            state = self._load(now)
+            available, wait = self._available(state, now, reservation)
+            if available < 1:
+                return max(wait, 0.001)
+            bucket = int(now // BUCKET * BUCKET)
+            state[u'buckets'][bucket] = state[u'buckets'].get(bucket, 0) + 1
+            own = state[u'reservations'].get(reservation)
+            if own is not None:
+                own[u'used'] += 1
+            self._save(state)
+        return 0.0
+
+    def wait_time(self, reservation=None):
+        """
+        :param reservation: unicode or None: see try_acquire
+        :return: float: seconds until a unit could be taken, 0 if one can now (nothing is taken)
+        """
+        reservation = reservation or self.reservation
+        now = time.time()
+        with self._locked():
+            state = self._load(now)
+        available, wait = self._available(state, now, reservation)
+        return 0.0 if available >= 1 else max(wait, 0.001)
+
+    def acquire(self, deadline=None, abort=None, wait=True, reservation=None):
+        """
+        Take one unit, waiting for one to free up.
+        :param deadline: float or None: time.time() by which it must be taken
+        :param abort: threading.Event or None: stops the wait once set
+        :param wait: bool: False to give up at once instead of waiting
+        :param reservation: unicode or None: see try_acquire
+        :return: float or None: seconds waited, None if no unit was taken (deadline, abort, or none now and wait is False)
+        """
+        start = time.time()
+        while True:
+            needed = self.try_acquire(reservation)
+            if not needed:
+                return time.time() - start
+            if not wait or (deadline is not None and time.time() + needed > deadline):
+                return None
+            # other processes may release units before then
+            pause = min(needed, BUCKET)
+            if abort is not None:
+                if abort.wait(pause):
+                    return None
+            else:
+                time.sleep(pause)
+
+    def refund(self, reservation=None):
+        """
+        Give back a unit taken for a request that was cancelled before it was sent.
+        :param reservation: unicode or None: the reservation it was drawn from, see try_acquire
+        """
+        reservation = reservation or self.reservation
+        with self._locked():
+            state = self._load(time.time())
+            taken = [b for b, n in state[u'buckets'].items() if n > 0]
+            if not taken:
+                return
+            bucket = max(taken)
+            state[u'buckets'][bucket] -= 1
+            own = state[u'reservations'].get(reservation)
+            if own is not None and own[u'used'] > 0:
+                own[u'used'] -= 1
+            self._save(state)
+
+    def reserve(self, count, ttl=RESERVATION_TTL):
+        """
+        Hold back count units for the caller; they are only given to it (try_acquire with the returned id).
+        The reservation is capped by what is left in the tightest window.
+        :param count: int: units wanted
+        :param ttl: float: seconds after which the unused units go back to everyone
+        :return: Tuple[unicode, int]: reservation id, units reserved
+        """
+        now = time.time()
+        key = uuid.uuid4().hex
+        with self._locked():
+            state = self._load(now)
+            available, wait = self._available(state, now, None)
+            count = max(0, min(int(count), available))
+            if count:
+                state[u'reservations'][key] = {u'count': count, u'used': 0, u'expires': now + ttl, u'pid': os.getpid()}
+                self._save(state)
+        return key, count
+
+    def release(self, reservation):
+        """
+        Give the unused units of a reservation back.
+        :param reservation: unicode: reserve() id
+        """
+        with self._locked():
+            state = self._load(time.time())
+            if state[u'reservations'].pop(reservation, None) is not None:
+                self._save(state)
+        if self.reservation == reservation:
+            self.reservation = None
+
+    def remaining(self, reservation=None):
+        """
+        :param reservation: unicode or None: count that reservation's unused units as the caller's
+        :return: Dict[int, int]: units left per window, after the other callers' reservations
+        """
+        now = time.time()
+        with self._locked():
+            state = self._load(now)
+        held = sum(r[u'count'] - r[u'used'] for k, r in state[u'reservations'].items() if k != reservation)
+        return dict((window, max(0, limit - held - sum(n for b, n in state[u'buckets'].items() if b + BUCKET > now - window)))
+                    for window, limit in self.limits.items())
@@ -0,0 +1,185 @@
+"""
+RecordFormat
+"""
+# coding=utf-8
+#
+# Compact binary form of a cached record.
+#
+# AmazonProduct_to_Metadata only fills a handful of fields, yet an OPF record
+# is a few KB of XML that get_cached_mi has to parse back. A binary record
+# keeps just those fields:
+#
+#   header  magic, format version, field count
+#   fields  (tag, length) then the field's bytes, for every field that is set
+#
+# Text is UTF-8. Lists (authors, languages, tags) are joined with NUL, and
+# identifiers are key NUL value pairs. The pubdate is a signed 64-bit count of
+# seconds since 1970-01-01 UTC (a naive datetime is taken as local time, as the
+# OPF writer does). Readers skip fields with a tag they do not know, so fields
+# can be added without a version bump. The binding is not a calibre field: it is
+# set on the Metadata as a plain attribute, and only binary records keep it.
+#
+# Record reads the field table only; each field is decoded on first use.
+# load() reads either format, so caches holding OPF records keep working, and
+# to_opf() gives the OPF form back when it is wanted (--export-opf).
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import calendar
+import datetime
+import io
+import struct
+
+try:
+    unicode
+except NameError:
+    # noinspection PyShadowingBuiltins
+    unicode = str
+
+#: No OPF record (XML text) starts with a NUL byte
+MAGIC = b'\0APR'
+VERSION = 1
+#: Record formats, the RECORD_FORMAT pref
+BINARY = u'binary'
+OPF = u'opf'
+
+_HEADER = struct.Struct(str('<4sBB'))
+_FIELD = struct.Struct(str('<BI'))
+_PUBDATE = struct.Struct(str('<q'))
+
+TEXT, LIST, PAIRS, DATE = range(4)
+#: (Metadata attribute, tag, kind); tags are never reused
+FIELDS = ((u'title', 1, TEXT), (u'authors', 2, LIST), (u'identifiers', 3, PAIRS), (u'publisher', 4, TEXT), (u'pubdate', 5, DATE),
+          (u'languages', 6, LIST), (u'tags', 7, LIST), (u'comments', 8, TEXT), (u'binding', 9, TEXT))
+_BY_TAG = dict((tag, (name, kind)) for name, tag, kind in FIELDS)
+_BY_NAME = dict((name, (tag, kind)) for name, tag, kind in FIELDS)
+_EMPTY = {TEXT: None, LIST: [], PAIRS: {}, DATE: None}
+
+class RecordError(ValueError):
+    """The data is not a binary record this code can read."""
+
+def is_record(data):
+    """
+    :param data: bytes, buffer or memoryview: cached record
+    :return: bool: a binary record (else OPF)
+    """
+    return data[:len(MAGIC)] == MAGIC
+
+def _encode_field(kind, value):
+    if kind == TEXT:
+        return unicode(value).encode('utf-8')
+    if kind == LIST:
+        return u'\0'.join(unicode(v) for v in value).encode('utf-8')
+    if kind == PAIRS:
+        return u'\0'.join(u'%s\0%s' % item for item in sorted(value.items())).encode('utf-8')
+    from calibre.utils.date import as_utc
+    return _PUBDATE.pack(calendar.timegm(as_utc(value, assume_utc=False).utctimetuple()))
+
+def _decode_field(kind, data):
+    if kind == TEXT:
+        return data.decode('utf-8')
+    if kind == LIST:
+        return data.decode('utf-8').split(u'\0')
+    if kind == PAIRS:
+        values = data.decode('utf-8').split(u'\0')
+        return dict(zip(values[::2], values[1::2]))
+    from calibre.utils.date import utc_tz
+    return datetime.datetime(1970, 1, 1, tzinfo=utc_tz) + datetime.timedelta(seconds=_PUBDATE.unpack(data)[0])
+
+def encode(mi):
+    """
+    :param mi: Metadata
+    :return: bytes: binary record of the FIELDS that are set
+    """
+    parts = []
+    for name, tag, kind in FIELDS:
+        value = mi.get_identifiers() if kind == PAIRS else getattr(mi, name, None)
+        if not value:
+            continue
+        data = _encode_field(kind, value)
+        parts.append(_FIELD.pack(tag, len(data)))
+        parts.append(data)
+    return _HEADER.pack(MAGIC, VERSION, len(parts) // 2) + b''.join(parts)
+
+class Record(object):
+    """
+    A binary record whose fields are decoded on first access (record.title, record.tags, ...).
+    """
+
+    def __init__(self, data):
+        """
+        :param data: bytes, buffer or memoryview: encode() output, kept (not copied) until the record is dropped
+        :raise RecordError: not a binary record, or a newer version
+        """
+        if len(data) < _HEADER.size:
+            raise RecordError(u'truncated record')
+        magic, version, count = _HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version > VERSION:
+            raise RecordError(u'not a version %d record' % VERSION)
+        self._data = data
+        self._fields = {}
+        self._decoded = {}
+        offset = _HEADER.size
+        for _ in range(count):
+            tag, length = _FIELD.unpack_from(data, offset)
+            offset += _FIELD.size
+            if tag in _BY_TAG:
+                self._fields[_BY_TAG[tag][0]] = (offset, length)
+            offset += length
+        if offset > len(data):
+            raise RecordError(u'truncated record')
+
+    def __getattr__(self, name):
+        # only called for the fields: everything else is an instance attribute
+        if name not in _BY_NAME:
+            raise AttributeError(name)
+        if name not in self._decoded:
+            kind = _BY_NAME[name][1]
+            field = self._fields.get(name)
+            if field is None:
+                self._decoded[name] = _EMPTY[kind]
+            else:
+                offset, length = field
+                data = self._data[offset:offset + length]
+                # bytes() of a Python 2 memoryview is its repr
+                self._decoded[name] = _decode_field(kind, data.tobytes() if isinstance(data, memoryview) else bytes(data))
+        return self._decoded[name]
+
+    def to_metadata(self):
+        """
+        :return: Metadata
+        """
+        from calibre.ebooks.metadata.book.base import Metadata
+        mi = Metadata(self.title, self.authors)
+        mi.set_identifiers(self.identifiers)
+        for name in (u'publisher', u'pubdate', u'languages', u'tags', u'comments', u'binding'):
+            if name in self._fields:
+                setattr(mi, name, getattr(self, name))
+        return mi
+
+def decode(data):
+    """
+    :param data: bytes, buffer or memoryview: encode() output
+    :return: Metadata
+    """
+    return Record(data).to_metadata()
+
+def load(data):
+    """
+    :param data: bytes: cached record, binary or OPF
+    :return: Metadata
+    """
+    if is_record(data):
+        return decode(data)
+    from calibre.ebooks.metadata.opf import get_metadata
+    return get_metadata(io.BytesIO(data))[0]
+
+def to_opf(data):
+    """
+    :param data: bytes: cached record, binary or OPF
+    :return: bytes: the record as an OPF document
+    """
+    if not is_record(data):
+        return data
+    from calibre.ebooks.metadata.opf2 import metadata_to_opf
+    return metadata_to_opf(decode(data), default_lang=u'und')
@@ -0,0 +1,141 @@
+"""
+RequestPlan
+"""
+# coding=utf-8
+#
+# Planning of a bulk_identify run.
+#
+# The raw identifiers of a batch (batch.txt, --identifiers) are classified as
+# ASIN or ISBN and normalized; ISBN-10 and ISBN-13 forms of the same book, and
+# repeats, count once. Identifiers already in the metadata cache, and the ones
+# an earlier lookup found nothing for (kept in the SearchCache under
+# searchcache.lookup_key), are dropped. What is left is grouped by what an
+# ItemLookup must share (IdType, SearchIndex for ISBNs, region) and cut into
+# requests of 10 identifiers, so that only the last request of a group is not
+# full. Requests are ordered by the best priority of their identifiers (input
+# order by default).
+#
+# The plan is reported (calls, estimated run time) before any request is sent.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import re
+from collections import namedtuple
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.metadatacache import ISBNConvert, identifier_keys, normalize_identifier
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from metadatacache import ISBNConvert, identifier_keys, normalize_identifier
+
+#: Most identifiers an ItemLookup takes
+IDS_PER_REQUEST = 10
+#: Error codes of a lookup whose identifiers Amazon does not know (4.0 and 5.0 APIs)
+NOT_FOUND_CODES = (u'AWS.InvalidParameterValue', u'AWS.ECommerceService.ItemNotAccessible', u'InvalidParameterValue', u'ItemNotAccessible', u'NoResults')
+
+_ISBN = re.compile(r'^(?:\d{9}[\dX]|\d{13})$')
+_ASIN = re.compile(r'^B[0-9A-Z]{9}$')
+
+#: One ItemLookup: id_type is ASIN or ISBN, search_index is None for ASINs, ids are normalized, priority is the best of its ids'
+PlannedRequest = namedtuple(str('PlannedRequest'), [str(f) for f in (u'id_type', u'search_index', u'region', u'ids', u'priority')])
+
+def classify(value):
+    """
+    :param value: unicode: raw identifier
+    :return: Tuple[unicode, unicode] or None: (ASIN or ISBN, normalized identifier), None if it is neither
+    """
+    key = normalize_identifier(value)
+    if _ISBN.match(key) and ISBNConvert.isValid(key):
+        return u'ISBN', key
+    if _ASIN.match(key):
+        return u'ASIN', key
+    return None
+
+class RequestPlan(object):
+    """
+    The ItemLookups of a batch, in the order they should be sent.
+    """
+
+    def __init__(self, requests, total, duplicates, cached, missing, invalid, seconds_per_call):
+        """
+        :param requests: List[PlannedRequest]
+        :param total: int: raw identifiers planned for
+        :param duplicates: int: dropped as repeats of another identifier
+        :param cached: int: dropped as already in the metadata cache
+        :param missing: int: dropped as known to find nothing
+        :param invalid: int: dropped as neither ASIN nor ISBN
+        :param seconds_per_call: float: expected time between two calls
+        """
+        self.requests = requests
+        self.total = total
+        self.duplicates = duplicates
+        self.cached = cached
+        self.missing = missing
+        self.invalid = invalid
+        self.seconds_per_call = seconds_per_call
+
+    @property
+    def calls(self):
+        return len(self.requests)
+
+    @property
+    def ids(self):
+        return sum(len(r.ids) for r in self.requests)
+
+    @property
+    def estimated_seconds(self):
+        return self.calls * self.seconds_per_call
+
+    def summary(self):
+        """
+        :return: unicode: one line report
+        """
+        return (u'%d identifiers: %d to look up in %d calls (~%.0fs), %d duplicates, %d cached, %d known missing, %d invalid' %
+                (self.total, self.ids, self.calls, self.estimated_seconds, self.duplicates, self.cached, self.missing, self.invalid))
+
+def plan_requests(identifiers, is_cached, is_missing, region, search_index, seconds_per_call, priorities=None):
+    """
+    :param identifiers: Iterable[unicode]: raw identifiers, in input order
+    :param is_cached: callable(id_type, identifier) -> bool: the identifier has a metadata record
+    :param is_missing: callable(id_type, identifier) -> bool: an earlier lookup of the identifier found nothing
+    :param region: unicode: API region
+    :param search_index: unicode: SearchIndex of ISBN lookups
+    :param seconds_per_call: float: expected time between two calls, for the run time estimate
+    :param priorities: Dict[unicode, float] or None: lower is sooner, by raw identifier; input order when None
+    :return: RequestPlan
+    """
+    total = duplicates = cached = missing = invalid = 0
+    seen = set()
+    groups = {}
+    for position, value in enumerate(identifiers):
+        if not value or not value.strip():
+            continue
+        total += 1
+        classified = classify(value)
+        if classified is None:
+            invalid += 1
+            continue
+        id_type, key = classified
+        keys = identifier_keys({u'isbn': key})
+        if not keys.isdisjoint(seen):
+            duplicates += 1
+            continue
+        seen.update(keys)
+        if is_cached(id_type, key):
+            cached += 1
+            continue
+        if is_missing(id_type, key):
+            missing += 1
+            continue
+        priority = priorities.get(value, position) if priorities else position
+        group = (id_type, search_index if id_type == u'ISBN' else None, region)
+        groups.setdefault(group, []).append((priority, position, key))
+    requests = []
+    for (id_type, group_index, group_region), entries in groups.items():
+        entries.sort()
+        for x in range(0, len(entries), IDS_PER_REQUEST):
+            chunk = entries[x:x + IDS_PER_REQUEST]
+            requests.append(PlannedRequest(id_type, group_index, group_region, [e[2] for e in chunk], chunk[0][:2]))
+    requests.sort(key=lambda r: r.priority)
+    requests = [r._replace(priority=r.priority[0]) for r in requests]
+    return RequestPlan(requests, total, duplicates, cached, missing, invalid, seconds_per_call)
@@ -0,0 +1,406 @@
+"""
+ResponseArchive
+"""
+# coding=utf-8
+#
+# Append-only archive of the raw API responses (ARCHIVE_RESPONSES), so that
+# records can be derived again when the conversion changes (cli_main
+# --rederive) without asking Amazon again.
+#
+# responses.dat holds the responses back to back, each behind a header (magic,
+# fetch time, format, dictionary id, length, the ASINs of its items, profile).
+# responses.idx is the random-access index: one fixed width entry per ASIN of
+# every response (ASIN, fetch time, offset, length, dictionary id, format,
+# profile), so the newest response of an ASIN is found without reading the data
+# file. It can be rebuilt from the headers.
+#
+# The profile is the RESPONSE_PROFILES name of the lookup the response answers
+# (request_profile), empty for searches: only the newest full lookup of an ASIN
+# holds everything its record is made of, a cover or identity lookup does not.
+#
+# Responses are raw deflate streams compressed against a preset dictionary
+# trained on the archive's own first responses: the strings that recur across
+# them (element names, JSON keys, bindings, languages...), most valuable last,
+# in at most one deflate window. Python 2's zlib has no zdict, so the dictionary
+# is preset by priming a compressor (and a decompressor) with it once, and
+# copying the primed stream for every response: the deflate window then holds
+# the dictionary, whatever encoding of it primed the stream. Responses archived
+# before there is a dictionary use none (dictionary id of zeros).
+#
+# Appends from several threads and processes are serialized by an exclusive
+# lock on archive.lock (quotaledger.file_lock).
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import binascii
+import hashlib
+import json
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+try:
+    from urlparse import parse_qs
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from urllib.parse import parse_qs
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.amazonsimpleproductapi import RESPONSE_PROFILES
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from amazonsimpleproductapi import RESPONSE_PROFILES
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.paapi5 import OPERATIONS, resources
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from paapi5 import OPERATIONS, resources
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.quotaledger import file_lock
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from quotaledger import file_lock
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.metadatacache import atomic_write, normalize_identifier
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from metadatacache import atomic_write, normalize_identifier
+
+ARCHIVE = u'archive'
+DATA = u'responses.dat'
+INDEX = u'responses.idx'
+#: Holds the id of the dictionary new responses are compressed with
+DICTIONARY = u'dictionary'
+#: Largest useful dictionary: a deflate window, less its lookahead
+DICTIONARY_SIZE = 32 * 1024 - 262
+#: Responses archived without a dictionary before one is trained from them
+TRAIN_SAMPLES = 100
+LEVEL = 9
+
+#: Response formats
+XML = 0
+JSON = 1
+
+#: Profile of the lookups --rederive converts again
+FULL = u'full'
+
+MAGIC = b'APRA'
+NO_DICTIONARY = b'\0' * 8
+PROFILE_SIZE = 8
+_RECORD = struct.Struct(str('<4sdB8sIB%ds' % PROFILE_SIZE))
+KEY_SIZE = 16
+_KEY = struct.Struct(str('<%ds' % KEY_SIZE))
+_ENTRY = struct.Struct(str('<%dsdQI8sB%ds' % (KEY_SIZE, PROFILE_SIZE)))
+
+#: Index entry: offset and length are the compressed response's, in DATA
+Entry = namedtuple(str('Entry'), [str(f) for f in (u'key', u'fetched', u'offset', u'length', u'dictionary', u'format', u'profile')])
+
+_XML_ITEM = re.compile(br'<Item>\s*<ASIN>([^<]{1,16})</ASIN>')
+_JSON_ITEM = re.compile(br'"ASIN"\s*:\s*"([^"]{1,16})"')
+#: What the trainer counts: a tag with the text after it (XML), a quoted string with its colon (JSON)
+_SEGMENT = re.compile(br'<[^<>]{1,128}>[^<]{0,64}|"[^"]{1,128}"\s*:?')
+
+def response_format(raw):
+    """
+    :param raw: bytes: API response
+    :return: int: XML (4.0 API) or JSON (5.0 API)
+    """
+    return JSON if raw.lstrip()[:1] == b'{' else XML
+
+def request_profile(cache_url):
+    """
+    :param cache_url: unicode: bottlenose cache_url of the request (4.0 query string, or 5.0 URL and JSON body)
+    :return: unicode: the largest RESPONSE_PROFILES profile a lookup (ItemLookup, GetItems) asked for all of, empty for searches
+             and for lookups that asked for less than any profile
+    """
+    base, _, query = cache_url.partition(u'?')
+    if base.endswith(OPERATIONS[u'GetItems']):
+        asked = set(json.loads(query).get(u'Resources') or ())
+        groups_of = resources
+    elif base.endswith(OPERATIONS[u'SearchItems']):
+        return u''
+    else:
+        params = parse_qs(query)
+        if params.get(u'Operation') != [u'ItemLookup']:
+            return u''
+        asked = set(u','.join(params.get(u'ResponseGroup') or ()).split(u','))
+        groups_of = list
+    for name in (FULL, u'identity', u'cover'):
+        if asked.issuperset(groups_of(RESPONSE_PROFILES[name].split(u','))):
+            return name
+    return u''
+
+def item_asins(raw):
+    """
+    :param raw: bytes: API response
+    :return: List[unicode]: the ASINs of its items, in order, without those of alternate versions (4.0 API)
+    """
+    pattern = _JSON_ITEM if response_format(raw) == JSON else _XML_ITEM
+    asins = []
+    for match in pattern.finditer(raw):
+        asin = normalize_identifier(match.group(1).decode('ascii', 'ignore'))
+        if asin and asin not in asins:
+            asins.append(asin)
+    return asins
+
+def train_dictionary(samples, size=DICTIONARY_SIZE):
+    """
+    :param samples: Iterable[bytes]: responses
+    :param size: int: most bytes in the dictionary
+    :return: bytes: the segments found in more than one sample, the most valuable (occurrences times length) last
+    """
+    counts = {}
+    for raw in samples:
+        for segment in set(_SEGMENT.findall(raw)):
+            counts[segment] = counts.get(segment, 0) + 1
+    ranked = sorted(((n * len(s), s) for s, n in counts.items() if n > 1 and len(s) > 3), reverse=True)
+    chosen = []
+    used = 0
+    for value, segment in ranked:
+        if used + len(segment) > size:
+            continue
+        chosen.append(segment)
+        used += len(segment)
+    return b''.join(reversed(chosen))
+
+class _Codec(object):
+    """
+    Raw deflate with a preset dictionary, for Pythons whose zlib takes none.
+    """
+
+    def __init__(self, dictionary):
+        self.dictionary = dictionary
+        self._compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, -15)
+        self._decompressor = zlib.decompressobj(-15)
+        if dictionary:
+            primer = self._compressor.compress(dictionary) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._decompressor.decompress(primer)
+
+    def compress(self, data):
+        compressor = self._compressor.copy()
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        decompressor = self._decompressor.copy()
+        return decompressor.decompress(data) + decompressor.flush()
+
+class ResponseArchive(object):
+    """
+    The ARCHIVE directory.
+    """
+
+    def __init__(self, location):
+        """
+        :param location: unicode: archive directory
+        """
+        self.location = location
+        self._lock = threading.Lock()
+        self._codecs = {}
+        self._entries = {}
+        self._index_size = 0
+
+    def path(self, file_name):
+        return os.path.join(self.location, file_name)
+
+    def _locked(self):
+        return file_lock(self.path(u'archive.lock'))
+
+    def _codec(self, dictionary_id):
+        """
+        :param dictionary_id: bytes: 8 bytes, NO_DICTIONARY for none
+        :return: _Codec
+        """
+        codec = self._codecs.get(dictionary_id)
+        if codec is None:
+            dictionary = b''
+            if dictionary_id != NO_DICTIONARY:
+                with open(self.path(u'%s.dict' % _hex(dictionary_id)), str('rb')) as f:
+                    dictionary = f.read()
+            codec = self._codecs[dictionary_id] = _Codec(dictionary)
+        return codec
+
+    def current_dictionary(self):
+        """
+        :return: bytes: id of the dictionary new responses are compressed with, NO_DICTIONARY until one is trained
+        """
+        try:
+            with open(self.path(DICTIONARY), str('rb')) as f:
+                dictionary_id = binascii.unhexlify(f.read().strip())
+        except (IOError, OSError, TypeError, ValueError, binascii.Error):
+            return NO_DICTIONARY
+        return dictionary_id if len(dictionary_id) == 8 else NO_DICTIONARY
+
+    def _train(self, samples=TRAIN_SAMPLES):
+        """
+        Train a dictionary on the newest responses and compress the next ones with it. Call with the lock held.
+        :param samples: int: responses to train on
+        :return: bytes: dictionary id, NO_DICTIONARY if there were too few responses
+        """
+        offsets = sorted(set((e.offset, e.length, e.dictionary) for e in self._all_entries()))[-samples:]
+        if len(offsets) < 2:
+            return NO_DICTIONARY
+        dictionary = train_dictionary(self._read(offset, length, dictionary_id) for offset, length, dictionary_id in offsets)
+        dictionary_id = hashlib.sha1(dictionary).digest()[:8]
+        atomic_write(self.path(u'%s.dict' % _hex(dictionary_id)), dictionary)
+        atomic_write(self.path(DICTIONARY), _hex(dictionary_id).encode('ascii'))
+        return dictionary_id
+
+    def append(self, raw, profile=u'', fetched=None):
+        """
+        :param raw: bytes: API response
+        :param profile: unicode: request_profile of the request
+        :param fetched: float or None: time.time() it was received, now by default
+        :return: int: number of ASINs it was archived under, 0 (and not archived) if it has no item
+        """
+        keys = item_asins(raw)
+        if not keys:
+            return 0
+        fetched = time.time() if fetched is None else fetched
+        fmt = response_format(raw)
+        with self._lock:
+            # file_lock creates the directory
+            with self._locked():
+                dictionary_id = self.current_dictionary()
+                if dictionary_id == NO_DICTIONARY and self._responses() >= TRAIN_SAMPLES:
+                    dictionary_id = self._train()
+                data = self._codec(dictionary_id).compress(raw)
+                keys = keys[:255]
+                profile_bytes = profile.encode('ascii')[:PROFILE_SIZE]
+                header = (_RECORD.pack(MAGIC, fetched, fmt, dictionary_id, len(data), len(keys), profile_bytes) +
+                          b''.join(_KEY.pack(_key_bytes(k)) for k in keys))
+                with open(self.path(DATA), str('ab')) as f:
+                    f.seek(0, os.SEEK_END)
+                    offset = f.tell() + len(header)
+                    f.write(header + data)
+                with open(self.path(INDEX), str('ab')) as f:
+                    f.write(b''.join(_ENTRY.pack(_key_bytes(k), fetched, offset, len(data), dictionary_id, fmt, profile_bytes) for k in keys))
+        return len(keys)
+
+    def _responses(self):
+        """
+        :return: int: distinct responses in the index
+        """
+        return len(set(e.offset for e in self._all_entries()))
+
+    def _all_entries(self):
+        return [e for by_profile in self._load_index().values() for e in by_profile.values()]
+
+    def _load_index(self):
+        """
+        Read the index entries appended since the last call (by any process).
+        :return: Dict[unicode, Dict[unicode, Entry]]: newest entry by ASIN and profile
+        """
+        path = self.path(INDEX)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        if size < self._index_size:
+            self._entries = {}
+            self._index_size = 0
+        size -= (size - self._index_size) % _ENTRY.size
+        if size > self._index_size:
+            with open(path, str('rb')) as f:
+                f.seek(self._index_size)
+                data = f.read(size - self._index_size)
+            for pos in range(0, len(data), _ENTRY.size):
+                entry = Entry(*_ENTRY.unpack_from(data, pos))
+                key = entry.key.rstrip(b'\0').decode('ascii')
+                profile = entry.profile.rstrip(b'\0').decode('ascii')
+                by_profile = self._entries.setdefault(key, {})
+                current = by_profile.get(profile)
+                if current is None or entry.fetched >= current.fetched:
+                    by_profile[profile] = entry._replace(key=key, profile=profile)
+            self._index_size = size
+        return self._entries
+
+    def _read(self, offset, length, dictionary_id):
+        with open(self.path(DATA), str('rb')) as f:
+            f.seek(offset)
+            return self._codec(dictionary_id).decompress(f.read(length))
+
+    def get(self, asin, profile=None):
+        """
+        :param asin: unicode
+        :param profile: unicode or None: only responses to lookups of that profile, any response when None
+        :return: Tuple[bytes, float] or None: the newest response holding the ASIN, and when it was received
+        """
+        with self._lock:
+            by_profile = self._load_index().get(normalize_identifier(asin)) or {}
+            if profile is None:
+                entry = max(by_profile.values(), key=lambda e: e.fetched) if by_profile else None
+            else:
+                entry = by_profile.get(profile)
+            if entry is None:
+                return None
+            return self._read(entry.offset, entry.length, entry.dictionary), entry.fetched
+
+    def latest_responses(self, profile=FULL):
+        """
+        Every response that is the newest lookup of that profile of at least one ASIN, in archive order.
+        :param profile: unicode: request_profile of the lookups
+        :return: iterator over Tuple[bytes, List[unicode]]: response, the ASINs it is the newest such response of
+        """
+        with self._lock:
+            by_offset = {}
+            for key, by_profile in self._load_index().items():
+                entry = by_profile.get(profile)
+                if entry is None:
+                    continue
+                by_offset.setdefault((entry.offset, entry.length, entry.dictionary), []).append(key)
+        for (offset, length, dictionary_id), keys in sorted(by_offset.items()):
+            yield self._read(offset, length, dictionary_id), keys
+
+    def rebuild_index(self):
+        """
+        Write the index again from the response headers (after it was lost or truncated by a crash).
+        :return: int: responses indexed
+        """
+        entries = []
+        with self._locked():
+            with open(self.path(DATA), str('rb')) as f:
+                while True:
+                    header = f.read(_RECORD.size)
+                    if len(header) < _RECORD.size:
+                        break
+                    magic, fetched, fmt, dictionary_id, length, count, profile = _RECORD.unpack(header)
+                    if magic != MAGIC:
+                        break
+                    keys = [f.read(KEY_SIZE) for _ in range(count)]
+                    offset = f.tell()
+                    f.seek(length, os.SEEK_CUR)
+                    if f.tell() > os.fstat(f.fileno()).st_size:
+                        # partly written last response
+                        break
+                    entries.append(b''.join(_ENTRY.pack(k, fetched, offset, length, dictionary_id, fmt, profile) for k in keys))
+            atomic_write(self.path(INDEX), b''.join(entries))
+        with self._lock:
+            self._entries = {}
+            self._index_size = 0
+        return len(entries)
+
+    def stats(self):
+        """
+        :return: Dict: responses and ASINs archived, size of the data file, id of the current dictionary
+        """
+        with self._lock:
+            entries = self._load_index()
+            responses = self._responses()
+        try:
+            size = os.path.getsize(self.path(DATA))
+        except OSError:
+            size = 0
+        return {u'responses': responses, u'asins': len(entries), u'bytes': size, u'dictionary': _hex(self.current_dictionary())}
+
+def _key_bytes(key):
+    return key.encode('ascii', 'ignore')[:KEY_SIZE].ljust(KEY_SIZE, b'\0')
+
+def _hex(data):
+    return binascii.hexlify(data).decode('ascii')
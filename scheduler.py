@@ -0,0 +1,132 @@
+"""
+RequestScheduler
+"""
+# coding=utf-8
+#
+# Priority scheduling of the MaxQPS rate limit inside one process.
+#
+# Without it, every call takes the next free MaxQPS slot in arrival order, so an
+# identify started during a bulk run or a background refresh waits behind every
+# lookup already queued. With a RequestScheduler, calls wait in one queue per
+# priority class and each slot goes to a class by weighted fair sharing (stride
+# scheduling): a class is charged 1/weight per slot, and the waiting class that
+# was charged the least gets the next one. With the default weights, a queued
+# interactive call is served within a slot or two while batch traffic keeps
+# getting the slots nobody else wants, and one sixteenth of them when it has to
+# share. A class that was idle does not bank credit: it rejoins at the current
+# charge level.
+#
+# Across processes, the request quota ledger (quotaledger) is what is shared.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import itertools
+import threading
+import time
+from collections import deque
+
+INTERACTIVE = u'interactive'
+BACKGROUND = u'background'
+BATCH = u'batch'
+#: Share of the rate each class gets when all of them are waiting
+WEIGHTS = {INTERACTIVE: 16, BACKGROUND: 2, BATCH: 1}
+
+class RequestScheduler(object):
+    """
+    Hands out MaxQPS slots by priority class.
+    """
+
+    def __init__(self, max_qps, weights=None):
+        """
+        :param max_qps: float: slots per second
+        :param weights: Dict[unicode, float] or None: weight by priority class, WEIGHTS by default
+        """
+        self.interval = 1.0 / max_qps if max_qps else 0.0
+        self.weights = dict(weights or WEIGHTS)
+        self._cond = threading.Condition(threading.Lock())
+        self._queues = dict((c, deque()) for c in self.weights)
+        self._charged = dict((c, 0.0) for c in self.weights)
+        self._level = 0.0
+        self._next_slot = 0.0
+        self._tickets = itertools.count()
+        self.served = dict((c, 0) for c in self.weights)
+
+    def waiting(self):
+        """
+        :return: Dict[unicode, int]: calls waiting, by priority class
+        """
+        with self._cond:
+            return dict((c, len(q)) for c, q in self._queues.items())
+
+    def _chosen(self):
+        """
+        :return: unicode or None: the class the next slot goes to
+        """
+        waiting = [c for c, q in self._queues.items() if q]
+        if not waiting:
+            return None
+        return min(waiting, key=lambda c: (self._charged[c], -self.weights[c]))
+
+    def _serve(self, priority, now):
+        self._charged[priority] += 1.0 / self.weights[priority]
+        self._level = max(self._level, min(self._charged[c] for c, q in self._queues.items() if q or c == priority))
+        self._next_slot = max(now, self._next_slot) + self.interval
+        self.served[priority] += 1
+
+    def acquire(self, priority=INTERACTIVE, deadline=None, abort=None):
+        """
+        Wait for a slot.
+        :param priority: unicode: a class of weights
+        :param deadline: float or None: time.time() by which the slot must be had
+        :param abort: threading.Event or None: stops the wait once set
+        :return: float or None: seconds waited, None if the deadline or abort ended the wait
+        """
+        if priority not in self.weights:
+            priority = INTERACTIVE
+        start = time.time()
+        ticket = next(self._tickets)
+        with self._cond:
+            queue = self._queues[priority]
+            if not queue:
+                # an idle class rejoins at the current level instead of spending credit it banked while idle
+                self._charged[priority] = max(self._charged[priority], self._level)
+            queue.append(ticket)
+            try:
+                while True:
+                    now = time.time()
+                    if queue[0] == ticket and self._chosen() == priority and now >= self._next_slot:
+                        queue.popleft()
+                        self._serve(priority, now)
+                        self._cond.notify_all()
+                        return now - start
+                    if abort is not None and abort.is_set():
+                        break
+                    if deadline is not None and max(now, self._next_slot) >= deadline:
+                        # not even the next slot would come in time
+                        break
+                    # woken by every slot handed out; poll for abort
+                    self._cond.wait(min(max(self._next_slot - now, 0.001), 0.05))
+            except Exception:
+                self._remove(queue, ticket)
+                raise
+            self._remove(queue, ticket)
+            return None
+
+    def _remove(self, queue, ticket):
+        try:
+            queue.remove(ticket)
+        except ValueError:
+            pass
+        self._cond.notify_all()
+
+    def try_acquire(self, priority=INTERACTIVE):
+        """
+        Take a slot only if one is free now and nobody is waiting for it (hedged duplicates).
+        :return: bool
+        """
+        with self._cond:
+            now = time.time()
+            if any(self._queues.values()) or now < self._next_slot:
+                return False
+            self._serve(priority if priority in self.weights else INTERACTIVE, now)
+            return True
@@ -0,0 +1,165 @@
+"""
+SearchCache
+"""
+# coding=utf-8
+#
+# Title/author search results, kept next to the metadata records.
+#
+# A search is identified by its normalized query: the sorted, lower cased title
+# and author tokens (Source.get_title_tokens/get_author_tokens output), the
+# SearchIndex and the region. Only the ASINs it returned are kept, in order; the
+# products themselves are records of the metadata cache, so a repeated search is
+# answered from disk without any API call. Empty results are kept too, and so
+# are the identifiers an ItemLookup found nothing for (lookup_key).
+#
+# searches.jsonl is append only (one JSON object per line: key, time, ASINs);
+# the last line for a key wins. It is rewritten without the expired and
+# superseded lines when it has grown to more than twice the live entries.
+# Every get and put first reads the lines appended since the last one, by this or
+# another process, when the file's size or mtime changed, and reads it all again
+# when it was rewritten.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os
+import threading
+import time
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.metadatacache import atomic_write
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from metadatacache import atomic_write
+
+SEARCHES = u'searches.jsonl'
+
+def search_key(title_tokens, author_tokens, search_index, region):
+    """
+    :param title_tokens: Iterable[unicode]: get_title_tokens output
+    :param author_tokens: Iterable[unicode]: get_author_tokens output
+    :param search_index: unicode: SearchIndex, or comma separated SearchIndexes
+    :param region: unicode: API region
+    :return: unicode: the same for every query with the same token sets
+    """
+    def norm(tokens):
+        return u' '.join(sorted(set(t.lower() for t in tokens if t)))
+    return u'|'.join((region or u'', search_index or u'', norm(title_tokens), norm(author_tokens)))
+
+def lookup_key(id_type, identifier, search_index, region):
+    """An ItemLookup that found nothing is kept as an empty search under this key (requestplan).
+
+    :param id_type: unicode: ASIN or ISBN
+    :param identifier: unicode: normalized identifier
+    :param search_index: unicode or None: SearchIndex of ISBN lookups
+    :param region: unicode: API region
+    :return: unicode
+    """
+    return u'|'.join((region or u'', search_index or u'', u'lookup', id_type, identifier))
+
+class SearchCache(object):
+    """
+    ASINs returned by previous searches, with a time to live.
+    """
+
+    def __init__(self, location, ttl):
+        """
+        :param location: unicode: METADATA_CACHE_LOCATION
+        :param ttl: float: seconds a search result is kept, 0 to disable the cache
+        """
+        self.location = location
+        self.ttl = ttl
+        self._entries = {}
+        self._offset = 0
+        self._stat = None
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return os.path.join(self.location, SEARCHES)
+
+    def _fresh(self, entry, now):
+        return now - entry[0] <= self.ttl
+
+    def _load(self):
+        """
+        Read the lines appended since the last call. Call with the lock held.
+        :return: Dict[unicode, Tuple[float, List[unicode]]]: search key -> (time, ASINs)
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return self._entries
+        stat = (st.st_ino, st.st_size, st.st_mtime)
+        if stat == self._stat:
+            return self._entries
+        if self._stat is None or stat[0] != self._stat[0] or st.st_size < self._offset:
+            # first load, or the file was rewritten
+            self._entries, self._offset = {}, 0
+        reload = not self._offset
+        lines = 0
+        try:
+            f = open(self.path, str('rb'))
+        except IOError:
+            return self._entries
+        with f:
+            f.seek(self._offset)
+            while True:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    # a line another process is still writing, or the partial last line after a crash
+                    break
+                self._offset += len(line)
+                lines += 1
+                try:
+                    e = json.loads(line.decode('utf-8'))
+                    self._entries[e[u'key']] = (e[u'time'], e[u'asins'])
+                except (ValueError, KeyError):
+                    continue
+        self._stat = stat
+        if reload:
+            now = time.time()
+            self._entries = dict((k, v) for k, v in self._entries.items() if self._fresh(v, now))
+            if lines > 2 * len(self._entries) + 100:
+                self._rewrite(self._entries)
+        return self._entries
+
+    def _rewrite(self, entries):
+        try:
+            atomic_write(self.path, u''.join(json.dumps({u'key': k, u'time': v[0], u'asins': v[1]}, sort_keys=True) + u'\n'
+                                             for k, v in sorted(entries.items())).encode('utf-8'))
+        except (IOError, OSError):
+            pass
+
+    def get(self, key):
+        """
+        :param key: unicode: search_key()
+        :return: List[unicode] or None: the ASINs of an unexpired search, in the order Amazon returned them
+        """
+        if not self.ttl:
+            return None
+        with self._lock:
+            entry = self._load().get(key)
+        if entry is None or not self._fresh(entry, time.time()):
+            return None
+        return list(entry[1])
+
+    def put(self, key, asins):
+        """
+        :param key: unicode: search_key()
+        :param asins: List[unicode]: what the search returned, possibly nothing
+        """
+        if not self.ttl:
+            return
+        entry = (time.time(), [a for a in asins if a])
+        line = json.dumps({u'key': key, u'time': entry[0], u'asins': entry[1]}, sort_keys=True) + u'\n'
+        with self._lock:
+            self._load()[key] = entry
+            try:
+                if not os.path.exists(self.location):
+                    os.makedirs(self.location)
+                with open(self.path, str('ab')) as f:
+                    f.write(line.encode('utf-8'))
+            except (IOError, OSError):
+                # still cached for this process
+                pass
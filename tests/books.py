@@ -0,0 +1,46 @@
+# coding=utf-8
+#
+# Stand-ins for the calibre objects the plugin modules are handed, for the tests
+# that run without calibre.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+class Book(object):
+    """The part of calibre's Metadata that recordformat.encode and MetadataCache.serialize read."""
+
+    def __init__(self, title, authors=(), identifiers=None, **fields):
+        self.title = title
+        self.authors = list(authors)
+        self.identifiers = dict(identifiers or {})
+        self.publisher = self.pubdate = self.comments = None
+        self.languages = []
+        self.tags = []
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    def get_identifiers(self):
+        return dict(self.identifiers)
+
+class Log(object):
+    """calibre's Log: keeps the messages of each level."""
+
+    def __init__(self):
+        self.messages = []
+
+    def _log(self, level, *args):
+        self.messages.append((level, u' '.join(u'%s' % (a,) for a in args)))
+
+    def info(self, *args):
+        self._log(u'info', *args)
+
+    def warn(self, *args):
+        self._log(u'warn', *args)
+
+    def error(self, *args):
+        self._log(u'error', *args)
+
+    def exception(self, *args):
+        self._log(u'exception', *args)
+
+    debug = info
+    warning = warn
@@ -0,0 +1,16 @@
+# coding=utf-8
+#
+# The plugin modules are imported by their file names, as calibre-debug and
+# cli_main runs outside calibre's plugin loader do; none of the tests needs
+# calibre. Run them with `python -m pytest tests` (tests/pytest.ini keeps
+# pytest from importing the plugin's __init__.py), or under Python 2 with:
+#
+#   PYTHONPATH=.:tests python2 -m unittest discover -s tests
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(HERE), HERE]
@@ -0,0 +1,146 @@
+"""
+Paapi5StandIn
+"""
+# coding=utf-8
+#
+# A local stand-in for the Product Advertising API 5.0, for Paapi5API's tests
+# (Endpoint=server.endpoint).
+#
+# It answers GetItems and SearchItems from a fixed catalog of items, checks the
+# SigV4 signature of every request with the secret key it was given, and
+# answers like the real service where the client can get it wrong: more than
+# GET_ITEMS_MAX ItemIds is a 400, unknown ASINs are listed in Errors next to
+# the items found, and a search or lookup that finds nothing is a 404 with a
+# NoResults error. Every request body is kept in `requests`.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import datetime
+import json
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from paapi5 import GET_ITEMS_MAX, OPERATIONS, SERVICE, sigv4_headers
+
+ACCESS_KEY = u'AKIDSTANDIN'
+SECRET_KEY = u'standin-secret'
+
+def item(asin, title, authors=(), isbn=None, binding=u'Paperback', publisher=None, published=None, image=None, languages=(),
+         browse_nodes=()):
+    """
+    :return: Dict: an item as GetItems and SearchItems return it, with every resource the plugin asks for
+    """
+    info = {u'Title': {u'DisplayValue': title},
+            u'ByLineInfo': {u'Contributors': [{u'Name': a, u'Role': u'Author', u'RoleType': u'author'} for a in authors]},
+            u'Classifications': {u'Binding': {u'DisplayValue': binding}},
+            u'ContentInfo': {u'Languages': {u'DisplayValues': [{u'DisplayValue': l, u'Type': u'Published'} for l in languages]}},
+            u'ExternalIds': {}}
+    if publisher:
+        info[u'ByLineInfo'][u'Manufacturer'] = {u'DisplayValue': publisher}
+    if published:
+        info[u'ContentInfo'][u'PublicationDate'] = {u'DisplayValue': published}
+    if isbn:
+        info[u'ExternalIds'][u'ISBNs'] = {u'DisplayValues': [isbn]}
+    result = {u'ASIN': asin, u'ItemInfo': info}
+    if image:
+        result[u'Images'] = {u'Primary': {u'Large': {u'URL': image}}}
+    if browse_nodes:
+        result[u'BrowseNodeInfo'] = {u'BrowseNodes': [{u'Id': node_id, u'DisplayName': name} for node_id, name in browse_nodes]}
+    return result
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, response):
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header(str('Content-Type'), str('application/json'))
+        self.send_header(str('Content-Length'), str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status, code, message):
+        self._reply(status, {u'Errors': [{u'Code': code, u'Message': message}]})
+
+    def _signature_ok(self, payload):
+        headers = dict((k.lower(), v) for k, v in self.headers.items())
+        amz_date = headers.get(u'x-amz-date', u'')
+        try:
+            now = datetime.datetime.strptime(amz_date, '%Y%m%dT%H%M%SZ')
+        except ValueError:
+            return False
+        signed = headers.get(u'authorization', u'').split(u'SignedHeaders=')[-1].split(u',')[0].split(u';')
+        expected = sigv4_headers(ACCESS_KEY, SECRET_KEY, u'us-east-1', SERVICE, u'POST', headers.get(u'host', u''), self.path,
+                                 dict((k, headers[k]) for k in signed if k not in (u'host', u'x-amz-date') and k in headers), payload, now)
+        return expected[u'Authorization'] == headers.get(u'authorization')
+
+    def do_POST(self):
+        server = self.server
+        payload = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if not self._signature_ok(payload):
+            return self._error(401, u'InvalidSignature', u'The request signature does not match')
+        body = json.loads(payload.decode('utf-8'))
+        with server.lock:
+            server.requests.append((self.path, body))
+        catalog = server.catalog
+        if self.path == OPERATIONS[u'GetItems']:
+            ids = body.get(u'ItemIds') or []
+            if len(ids) > GET_ITEMS_MAX:
+                return self._error(400, u'InvalidParameterValue', u'ItemIds accepts at most %d values' % GET_ITEMS_MAX)
+            items = [catalog[i] for i in ids if i in catalog]
+            errors = [{u'Code': u'InvalidParameterValue', u'Message': u'The ItemId %s is not accessible through the Product Advertising API.' % i}
+                      for i in ids if i not in catalog]
+            if not items:
+                return self._reply(404, {u'Errors': errors})
+            response = {u'ItemsResult': {u'Items': items}}
+            if errors:
+                response[u'Errors'] = errors
+            return self._reply(200, response)
+        if self.path == OPERATIONS[u'SearchItems']:
+            words = (body.get(u'Keywords') or body.get(u'Title') or u'').lower()
+            items = [i for i in catalog.values()
+                     if words and (words in i[u'ItemInfo'][u'Title'][u'DisplayValue'].lower()
+                                   or words in i[u'ItemInfo'][u'ExternalIds'].get(u'ISBNs', {}).get(u'DisplayValues', []))]
+            items = sorted(items, key=lambda i: i[u'ASIN'])[:body.get(u'ItemCount') or 10]
+            if not items:
+                return self._error(404, u'NoResults', u'No results found for your request.')
+            return self._reply(200, {u'SearchResult': {u'Items': items, u'TotalResultCount': len(items)}})
+        self._error(404, u'UnknownOperation', self.path)
+
+class Paapi5StandIn(HTTPServer):
+    """
+    The stand-in server, on a free localhost port and its own thread; use as a context manager.
+    """
+
+    def __init__(self, items):
+        """
+        :param items: Iterable[Dict]: item() output
+        """
+        HTTPServer.__init__(self, (str('127.0.0.1'), 0), _Handler)
+        self.catalog = dict((i[u'ASIN'], i) for i in items)
+        self.requests = []
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        return u'http://127.0.0.1:%d' % self.server_address[1]
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, name=str('Paapi5StandIn'))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+        return False
@@ -0,0 +1,91 @@
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import urllib2
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    import urllib.request as urllib2
+
+from apimetrics import ApiMetrics
+
+class ApiMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = ApiMetrics()
+
+    def test_counters_by_labels(self):
+        self.metrics.inc(u'hits', result=u'hit')
+        self.metrics.inc(u'hits', 2, result=u'hit')
+        self.metrics.inc(u'hits', result=u'miss', ignored=None)
+        counters = dict((c[u'labels'][u'result'], c[u'value']) for c in self.metrics.snapshot()[u'counters'])
+        self.assertEqual(counters, {u'hit': 3, u'miss': 1})
+
+    def test_histogram_quantile(self):
+        self.assertIsNone(self.metrics.quantile(u'latency', 0.5))
+        for seconds in (0.02,) * 50 + (0.2,) * 50:
+            self.metrics.observe(u'latency', seconds)
+        self.assertEqual(self.metrics.count(u'latency'), 100)
+        self.assertTrue(0.01 <= self.metrics.quantile(u'latency', 0.25) <= 0.025)
+        self.assertTrue(0.1 <= self.metrics.quantile(u'latency', 0.9) <= 0.25)
+        self.metrics.observe(u'latency', 100.0)
+        self.assertEqual(self.metrics.quantile(u'latency', 1.0), ApiMetrics.BUCKETS[-1])
+
+    def test_record_request(self):
+        events = []
+        self.metrics.add_listener(lambda event, fields: events.append(event))
+        self.metrics.record_request(u'ItemLookup', u'US', {u'connect': 0.01, u'ttfb': 0.1, u'parse': 0.001}, cache=u'miss')
+        self.metrics.record_request(u'ItemLookup', u'US', {u'parse': 0.001}, cache=u'hit')
+        self.metrics.record_request(u'ItemLookup', u'US', {u'connect': 0.01}, error=u'503')
+        self.assertEqual(self.metrics.count(u'request_seconds', operation=u'ItemLookup', region=u'US'), 3)
+        # only the answered network requests count for the hedging delay
+        self.assertEqual(self.metrics.count(u'response_seconds', region=u'US'), 1)
+        self.assertEqual(events, [u'request'] * 3)
+
+    def test_listener_errors_are_ignored(self):
+        def broken(event, fields):
+            raise ValueError(event)
+
+        self.metrics.add_listener(broken)
+        self.metrics.emit(u'request')
+        self.metrics.remove_listener(broken)
+        self.metrics.remove_listener(broken)
+
+    def test_prometheus_text(self):
+        self.metrics.inc(u'errors_total', code=u'say "no"')
+        self.metrics.observe(u'request_seconds', 0.3, region=u'US')
+        text = self.metrics.to_prometheus()
+        self.assertIn(u'# TYPE amazonapi_errors_total counter\n', text)
+        self.assertIn(u'amazonapi_errors_total{code="say \\"no\\""} 1\n', text)
+        self.assertIn(u'amazonapi_request_seconds_bucket{region="US",le="0.25"} 0\n', text)
+        self.assertIn(u'amazonapi_request_seconds_bucket{region="US",le="0.5"} 1\n', text)
+        self.assertIn(u'amazonapi_request_seconds_count{region="US"} 1\n', text)
+
+    def test_write_and_serve(self):
+        self.metrics.inc(u'requests_total')
+        directory = tempfile.mkdtemp()
+        try:
+            self.metrics.write(os.path.join(directory, u'metrics.json'))
+            with open(os.path.join(directory, u'metrics.json'), 'rb') as f:
+                self.assertEqual(json.loads(f.read().decode('utf-8'))[u'counters'][0][u'value'], 1)
+            self.metrics.write(os.path.join(directory, u'metrics.prom'))
+            self.assertEqual(sorted(os.listdir(directory)), [u'metrics.json', u'metrics.prom'])
+        finally:
+            shutil.rmtree(directory)
+        server = self.metrics.serve(0)
+        try:
+            body = urllib2.urlopen(u'http://127.0.0.1:%d/metrics' % server.server_address[1]).read().decode('utf-8')
+            self.assertIn(u'amazonapi_requests_total 1\n', body)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == '__main__':
+    unittest.main()
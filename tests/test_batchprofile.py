@@ -0,0 +1,79 @@
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from batchprofile import BatchProfiler
+
+def _busy(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+class BatchProfilerTest(unittest.TestCase):
+
+    def test_disabled_is_a_no_op(self):
+        profiler = BatchProfiler()
+        profiler.start()
+        with profiler.stage(u'request'):
+            pass
+        self.assertIs(profiler.wrap(u'parse', _busy), _busy)
+        profiler.stop()
+        self.assertEqual((profiler.profiles, profiler.stage_seconds, profiler.write(u'unused')), ({}, {}, []))
+
+    def test_nested_stages(self):
+        profiler = BatchProfiler(enabled=True, interval=0.001)
+        profiler.start()
+        with profiler.stage(u'request'):
+            _busy(0.02)
+            profiler.wrap(u'parse', _busy)(0.05)
+        profiler.stop()
+        # the time of an inner stage is not counted in the outer one
+        self.assertTrue(profiler.stage_seconds[u'parse'] > profiler.stage_seconds[u'request'])
+        self.assertEqual(set(profiler.profiles), set([u'request', u'parse']))
+        self.assertTrue(any(key.startswith(u'parse;') and u'_busy' in key for key in profiler.folded))
+
+    def test_other_threads_are_not_profiled(self):
+        profiler = BatchProfiler(enabled=True)
+        profiler.start()
+
+        def other():
+            with profiler.stage(u'convert'):
+                pass
+
+        thread = threading.Thread(target=other)
+        thread.start()
+        thread.join()
+        profiler.stop()
+        self.assertEqual(profiler.stage_seconds, {})
+
+    def test_stop_closes_open_stages(self):
+        profiler = BatchProfiler(enabled=True)
+        profiler.start()
+        profiler.stage(u'write').__enter__()
+        profiler.stop()
+        self.assertIn(u'write', profiler.stage_seconds)
+
+    def test_write(self):
+        profiler = BatchProfiler(enabled=True, interval=0.001)
+        profiler.start()
+        with profiler.stage(u'ingest'):
+            _busy(0.02)
+        profiler.stop()
+        directory = os.path.join(tempfile.mkdtemp(), u'out')
+        try:
+            written = profiler.write(directory)
+            self.assertEqual(sorted(os.path.basename(p) for p in written), [u'profile.folded', u'profile.ingest.prof', u'profile.txt'])
+            with open(os.path.join(directory, u'profile.txt'), 'rb') as f:
+                self.assertTrue(f.read().decode('utf-8').startswith(u'stage'))
+        finally:
+            shutil.rmtree(os.path.dirname(directory))
+
+if __name__ == '__main__':
+    unittest.main()
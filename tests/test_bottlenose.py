@@ -0,0 +1,75 @@
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import io
+import unittest
+
+try:
+    import urllib2
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    import urllib.request as urllib2
+
+try:
+    from urllib import addinfourl
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from urllib.response import addinfourl
+
+import bottlenose
+
+class _Answer(urllib2.BaseHandler):
+    """Answers every HTTPS request before the HTTPS handler would connect, recording the host it would connect to."""
+    handler_order = 400
+
+    def __init__(self):
+        self.requests = []
+
+    def https_open(self, req):
+        self.requests.append((req.get_full_url(), req.host))
+        response = addinfourl(io.BytesIO(b'ok'), {}, req.get_full_url())
+        response.code = 200
+        response.msg = str('OK')
+        return response
+
+class TimedOpenerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.installed = getattr(urllib2, '_opener', None)
+
+    def tearDown(self):
+        urllib2.install_opener(self.installed)
+
+    def _handlers(self, opener, kind):
+        return [h for h in opener.handlers if isinstance(h, kind)]
+
+    def test_default_opener(self):
+        urllib2.install_opener(None)
+        opener = bottlenose._timed_opener()
+        self.assertEqual([h.__class__ for h in self._handlers(opener, urllib2.HTTPSHandler)], [bottlenose._TimedHTTPSHandler])
+        self.assertIs(bottlenose._timed_opener(), opener)
+
+    def test_installed_opener_is_followed(self):
+        answer = _Answer()
+        installed = urllib2.build_opener(urllib2.ProxyHandler({str('https'): str('http://proxy.example:3128')}), answer)
+        installed.addheaders = [(str('User-agent'), str('calibre'))]
+        urllib2.install_opener(installed)
+        opener = bottlenose._timed_opener()
+        self.assertIs(bottlenose._timed_opener(), opener)
+        self.assertEqual(opener.addheaders, installed.addheaders)
+        # the installed opener's HTTPS handler is swapped for a timed one with the same SSL settings
+        plain = self._handlers(installed, urllib2.HTTPSHandler)[0]
+        timed = self._handlers(opener, urllib2.HTTPSHandler)
+        self.assertEqual([h.__class__ for h in timed], [bottlenose._TimedHTTPSHandler])
+        self.assertIs(getattr(timed[0], '_context', None), getattr(plain, '_context', None))
+        # and every handler it shares stays the installed opener's
+        self.assertTrue(all(h.parent is installed for h in installed.handlers))
+        self.assertEqual(opener.open(urllib2.Request(str('https://webservices.amazon.com/paapi5/getitems'))).read(), b'ok')
+        self.assertEqual(answer.requests, [(u'https://webservices.amazon.com/paapi5/getitems', u'proxy.example:3128')])
+        # a newly installed opener is picked up
+        urllib2.install_opener(urllib2.build_opener())
+        self.assertIsNot(bottlenose._timed_opener(), opener)
+
+if __name__ == '__main__':
+    unittest.main()
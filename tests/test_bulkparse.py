@@ -0,0 +1,107 @@
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from books import Book, Log
+from bulkparse import ParsePool, available, convert
+from metadatacache import MetadataCache
+from paapi5_standin import item
+
+def _response(*items):
+    return json.dumps({u'ItemsResult': {u'Items': list(items)}}).encode('utf-8')
+
+class _Plugin(object):
+    """The parts of the calibre plugin bulkparse uses."""
+
+    def __init__(self, location):
+        self.log = Log()
+        self.metadata_cache = MetadataCache(location)
+        self.covers = {}
+
+    @staticmethod
+    def bulk_file_name(product, id_type):
+        return product.asin + u'.mi' if product.asin else None
+
+    def product_record(self, product):
+        if product.large_image_url:
+            self.cache_identifier_to_cover_url(product.asin, product.large_image_url)
+        return Book(product.title, [u'Someone'], {u'amazon': product.asin}), [product.isbn]
+
+    def cache_identifier_to_cover_url(self, identifier, url):
+        self.covers[identifier] = url
+
+DUNE = item(u'B000FC0PDA', u'Dune', image=u'https://images.example/dune.jpg')
+FARM = item(u'B00ABC1234', u'Animal Farm', isbn=u'9780451526342')
+
+class ConvertTest(unittest.TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.plugin = _Plugin(os.path.join(self.location, u'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def test_convert(self):
+        covers = []
+        records, lost, error, code = convert(self.plugin, _response(DUNE, FARM), u'ASIN', covers)
+        self.assertEqual([(name, fields[u'title']) for name, data, fields in records], [(u'B000FC0PDA.mi', u'Dune'), (u'B00ABC1234.mi', u'Animal Farm')])
+        self.assertIn(u'9780451526342', records[1][2][u'keys'])
+        self.assertEqual((lost, error, code), (0, None, None))
+        self.assertEqual(covers, [(u'B000FC0PDA', u'https://images.example/dune.jpg')])
+
+    def test_errors_are_returned(self):
+        records, lost, error, code = convert(self.plugin, json.dumps({u'Errors': [{u'Code': u'ItemNotAccessible', u'Message': u'No'}]}).encode('utf-8'),
+                                             u'ASIN')
+        self.assertEqual((records, code), ([], u'ItemNotAccessible'))
+        records, lost, error, code = convert(self.plugin, b'{not json', u'ASIN')
+        self.assertEqual((records, code), ([], None))
+        self.assertTrue(error.startswith(u'ValueError') or error.startswith(u'JSONDecodeError'), error)
+
+@unittest.skipUnless(available(), u'no fork')
+class ParsePoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.plugin = _Plugin(os.path.join(self.location, u'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def test_pool(self):
+        results = {}
+        lock = threading.Lock()
+
+        def on_result(context, records, lost, error, code):
+            if context == u'raises':
+                raise RuntimeError(u'callback failed')
+            with lock:
+                results[context] = [name for name, data, fields in records], error
+
+        pool = ParsePool(self.plugin, 2, on_result, queue_size=2)
+        for n in range(6):
+            pool.submit(_response(FARM), u'ASIN', n)
+        pool.submit(_response(DUNE), u'ASIN', u'dune')
+        pool.submit(b'{not json', u'ASIN', u'bad')
+        pool.submit(_response(FARM), u'ASIN', u'raises')
+        # a callback that raises neither stops the pool nor blocks close()
+        pool.submit(_response(FARM), u'ASIN', u'after')
+        pool.close()
+        self.assertEqual(results[u'dune'], ([u'B000FC0PDA.mi'], None))
+        self.assertEqual(results[5], ([u'B00ABC1234.mi'], None))
+        self.assertEqual(results[u'after'], ([u'B00ABC1234.mi'], None))
+        self.assertIsNotNone(results[u'bad'][1])
+        self.assertNotIn(u'raises', results)
+        self.assertEqual(self.plugin.log.messages, [(u'exception', u'Failed to handle a converted response')])
+        # the cover URLs the pool processes found are cached in this process
+        self.assertEqual(self.plugin.covers, {u'B000FC0PDA': u'https://images.example/dune.jpg'})
+
+if __name__ == '__main__':
+    unittest.main()
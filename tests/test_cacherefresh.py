@@ -0,0 +1,114 @@
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+import time
+import unittest
+
+from books import Log
+from cacherefresh import CacheRefresher
+
+def _wait_for(condition, timeout=5.0):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise AssertionError(u'timed out')
+        time.sleep(0.005)
+
+class CacheRefresherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.refused = set()
+        self.refresher = None
+
+    def tearDown(self):
+        if self.refresher is not None:
+            self.refresher.close(5)
+
+    def _refresh(self, batch):
+        self.batches.append(dict(batch))
+        return [asin for asin in batch if asin not in self.refused]
+
+    def _make(self, **kwargs):
+        options = dict(linger=0.05, min_interval=0.0, retry_after=0.2, max_retry_after=0.3)
+        options.update(kwargs)
+        self.refresher = CacheRefresher(self._refresh, **options)
+        return self.refresher
+
+    def test_batches(self):
+        refresher = self._make(batch_size=3)
+        self.assertFalse(refresher.submit(u'', u'x.mi'))
+        for n in range(7):
+            self.assertTrue(refresher.submit(u'B%09d' % n, u'%d.mi' % n))
+        self.assertFalse(refresher.submit(u'B000000000', u'0.mi'))
+        _wait_for(lambda: refresher.refreshed == 7)
+        self.assertEqual([len(b) for b in self.batches], [3, 3, 1])
+        submitted = {}
+        for batch in self.batches:
+            submitted.update(batch)
+        self.assertEqual(submitted, dict((u'B%09d' % n, u'%d.mi' % n) for n in range(7)))
+        self.assertEqual(refresher.pending(), 0)
+
+    def test_min_interval(self):
+        refresher = self._make(batch_size=1, linger=0.0, min_interval=0.2)
+        start = time.time()
+        refresher.submit(u'B000000001', u'1.mi')
+        refresher.submit(u'B000000002', u'2.mi')
+        _wait_for(lambda: refresher.refreshed == 2)
+        self.assertTrue(time.time() - start >= 0.2)
+
+    def test_failures_back_off(self):
+        refresher = self._make()
+        self.refused.add(u'B000000001')
+        refresher.submit(u'B000000001', u'1.mi')
+        _wait_for(lambda: len(self.batches) == 1 and refresher.pending() == 0)
+        # withdrawn from Amazon: not asked for again until retry_after has passed
+        self.assertFalse(refresher.submit(u'B000000001', u'1.mi'))
+        time.sleep(0.25)
+        self.assertTrue(refresher.submit(u'B000000001', u'1.mi'))
+        _wait_for(lambda: len(self.batches) == 2 and refresher.pending() == 0)
+        # the second failure doubles the backoff, up to max_retry_after
+        self.assertEqual(refresher._backoff[u'B000000001'][0], 2)
+        self.assertTrue(refresher._backoff[u'B000000001'][1] - time.time() <= 0.3)
+        self.refused.clear()
+        time.sleep(0.35)
+        refresher.submit(u'B000000001', u'1.mi')
+        _wait_for(lambda: refresher.refreshed == 1)
+        self.assertNotIn(u'B000000001', refresher._backoff)
+
+    def test_errors_are_logged(self):
+        log = Log()
+
+        def broken(batch):
+            raise IOError(u'network down')
+
+        self.refresher = CacheRefresher(broken, linger=0.0, min_interval=0.0, log=log)
+        self.refresher.submit(u'B000000001', u'1.mi')
+        _wait_for(lambda: log.messages)
+        self.assertEqual(log.messages[0], (u'exception', u'Background refresh failed for B000000001'))
+        _wait_for(lambda: self.refresher.pending() == 0)
+        self.assertFalse(self.refresher.submit(u'B000000001', u'1.mi'))
+
+    def test_close_drops_the_queue(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow(batch):
+            started.set()
+            release.wait(5)
+            return batch
+
+        self.refresher = CacheRefresher(slow, batch_size=1, linger=0.0, min_interval=0.0)
+        self.refresher.submit(u'B000000001', u'1.mi')
+        started.wait(5)
+        self.refresher.submit(u'B000000002', u'2.mi')
+        self.assertEqual(self.refresher.pending(), 2)
+        release.set()
+        self.refresher.close(5)
+        self.assertEqual((self.refresher.refreshed, self.refresher.pending()), (1, 0))
+        self.assertFalse(self.refresher.submit(u'B000000003', u'3.mi'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+import unittest
+
+from apimetrics import ApiMetrics
+from books import Log
+from circuitbreaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = ApiMetrics()
+        self.breaker = CircuitBreaker(failures=3, reset_after=0.05, max_reset_after=0.15, metrics=self.metrics, log=Log())
+
+    def _open(self):
+        for _ in range(3):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record_failure(u'503')
+
+    def test_consecutive_failures_open(self):
+        self.breaker.record_failure(u'503')
+        self.breaker.record_failure(u'503')
+        self.breaker.record_success()
+        self.breaker.record_failure(u'503')
+        self.breaker.record_failure(u'503')
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.breaker.record_failure(u'Timeout')
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertTrue(self.breaker.is_open())
+        self.assertFalse(self.breaker.allow())
+        report = self.breaker.report()
+        self.assertEqual((report[u'state'], report[u'consecutive_failures'], report[u'last_error']), (OPEN, 3, u'Timeout'))
+        self.assertTrue(0 < report[u'retry_in'] <= 0.05)
+
+    def test_fatal_code_opens_at_once(self):
+        self.breaker.record_failure(u'InvalidSignature')
+        self.assertEqual(self.breaker.state, OPEN)
+        self.breaker = CircuitBreaker()
+        self.breaker.record_failure(403)
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_one_trial_call_closes(self):
+        self._open()
+        time.sleep(0.06)
+        self.assertFalse(self.breaker.is_open())
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        # one trial at a time
+        self.assertFalse(self.breaker.allow())
+        self.assertTrue(self.breaker.is_open())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.breaker.allow())
+        self.assertIsNone(self.breaker.report()[u'retry_in'])
+
+    def test_failed_trial_doubles_the_wait(self):
+        self._open()
+        for wait in (0.1, 0.15, 0.15):
+            time.sleep(self.breaker.report()[u'retry_in'] + 0.01)
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record_failure(u'503')
+            self.assertEqual(self.breaker.state, OPEN)
+            self.assertTrue(wait - 0.02 < self.breaker.report()[u'retry_in'] <= wait, wait)
+        time.sleep(0.16)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        # closing resets the wait
+        self._open()
+        self.assertTrue(self.breaker.report()[u'retry_in'] <= 0.05)
+
+    def test_release_lets_another_trial_through(self):
+        self._open()
+        time.sleep(0.06)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.release()
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+
+    def test_state_changes_are_counted_and_logged(self):
+        events = []
+        self.metrics.add_listener(lambda event, fields: events.append((event, fields[u'state'])))
+        self._open()
+        time.sleep(0.06)
+        self.breaker.allow()
+        self.breaker.record_success()
+        self.assertEqual(events, [(u'circuit', OPEN), (u'circuit', HALF_OPEN), (u'circuit', CLOSED)])
+        counters = dict((c[u'labels'][u'state'], c[u'value']) for c in self.metrics.snapshot()[u'counters'] if c[u'name'] == u'circuit_total')
+        self.assertEqual(counters, {OPEN: 1, HALF_OPEN: 1, CLOSED: 1})
+        self.assertEqual(self.breaker.log.messages[0], (u'info', u'API circuit breaker: open (last error: 503)'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import unittest
+
+from matchindex import (BINDING_BONUS, CANDIDATES, IDENTIFIER_BONUS, KINDLE_BINDING, LocalMatchIndex, RelevanceQuery, author_trigrams, candidate_trigrams,
+                        dice, normalize_words, title_trigrams, trigrams)
+
+class TrigramTest(unittest.TestCase):
+
+    def test_normalize_words(self):
+        self.assertEqual(normalize_words(u'Les Misérables, J. R. R. Tolkien!'), [u'les', u'miserables', u'tolkien'])
+        self.assertEqual(normalize_words(None), [])
+
+    def test_trigrams(self):
+        self.assertEqual(trigrams([u'cat']), frozenset([u'$ca', u'cat', u'at$']))
+        self.assertEqual(dice(trigrams([u'cat']), trigrams([u'cat'])), 1.0)
+        self.assertEqual(dice(frozenset(), trigrams([u'cat'])), 0.0)
+
+    def test_title_without_subtitle(self):
+        full, main = title_trigrams(u'Dune: Deluxe Edition')
+        self.assertEqual(main, trigrams([u'dune']))
+        self.assertTrue(main < full)
+        full, main = title_trigrams(u'Dune')
+        self.assertIs(main, full)
+        self.assertEqual(author_trigrams([u'F. Herbert']), trigrams([u'herbert']))
+
+class LocalMatchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = LocalMatchIndex()
+        self.index.add(u'1984.mi', u'Nineteen Eighty-Four', [u'George Orwell'])
+        self.index.add(u'farm.mi', u'Animal Farm: A Fairy Story', [u'George Orwell'])
+        self.index.add(u'dune.mi', u'Dune', [u'Frank Herbert'])
+
+    def test_exact_match_scores_one(self):
+        score, file_name = self.index.query(u'Nineteen Eighty-Four', [u'George Orwell'])[0]
+        self.assertEqual((round(score, 6), file_name), (1.0, u'1984.mi'))
+
+    def test_small_differences_cost_a_little_score(self):
+        for title, authors in ((u'nineteen eighty four', [u'Orwell, George']), (u'Ninteen Eighty-Four', None),
+                               (u'Eighty-Four Nineteen', [u'G. Orwell'])):
+            score, file_name = self.index.query(title, authors)[0]
+            self.assertEqual(file_name, u'1984.mi')
+            self.assertTrue(0.7 < score <= 1.0, (title, score))
+
+    def test_subtitle(self):
+        score, file_name = self.index.query(u'Animal Farm', [u'George Orwell'])[0]
+        self.assertEqual(file_name, u'farm.mi')
+        self.assertTrue(score >= 0.95)
+
+    def test_no_match(self):
+        self.assertEqual(self.index.query(u'Zz'), [])
+        self.assertTrue(all(score < 0.3 for score, f in self.index.query(u'Pride and Prejudice')))
+
+    def test_add_replaces(self):
+        self.index.add(u'dune.mi', u'Children of Dune', [u'Frank Herbert'])
+        self.index.add(u'empty.mi', u'', [])
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.query(u'Children of Dune')[0][1], u'dune.mi')
+        self.assertTrue(self.index.query(u'Dune')[0][0] < 1.0)
+
+    def test_limit_and_candidates(self):
+        index = LocalMatchIndex()
+        for n in range(CANDIDATES + 20):
+            index.add(u'%03d.mi' % n, u'The Book of Things volume x%03d' % n, [])
+        results = index.query(u'The Book of Things volume x007', limit=3)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0][1], u'007.mi')
+        self.assertEqual([r[0] for r in results], sorted((r[0] for r in results), reverse=True))
+
+    def test_trigrams_of(self):
+        self.assertEqual(self.index.trigrams_of(u'dune.mi'), candidate_trigrams(u'Dune', [u'Frank Herbert']))
+        self.assertIsNone(self.index.trigrams_of(u'missing.mi'))
+
+class RelevanceQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.query = RelevanceQuery(u'Nineteen Eighty-Four', [u'George Orwell'], [u'0451524934'], prefer_kindle=True)
+
+    def test_score(self):
+        grams = candidate_trigrams(u'Nineteen Eighty-Four', [u'George Orwell'])
+        self.assertAlmostEqual(self.query.score(grams), 1.0)
+        self.assertAlmostEqual(self.query.score(grams, [u'0451524934'], KINDLE_BINDING), 1.0 + IDENTIFIER_BONUS + BINDING_BONUS)
+        self.assertAlmostEqual(self.query.score(grams, [u'B000FC0PDA'], u'Paperback'), 1.0)
+        self.assertAlmostEqual(RelevanceQuery(u'', None, [], prefer_kindle=False).score(grams, (), u'Paperback'), BINDING_BONUS)
+        self.assertTrue(self.query.confident(candidate_trigrams(u'Nineteen Eighty Four', [u'George Orwell'])))
+        self.assertFalse(self.query.confident(candidate_trigrams(u'Animal Farm', [u'George Orwell'])))
+
+    def test_rank(self):
+        candidates = [(u'farm', candidate_trigrams(u'Animal Farm', [u'George Orwell']), (), KINDLE_BINDING),
+                      (u'print', candidate_trigrams(u'Nineteen Eighty-Four', [u'George Orwell']), (), u'Paperback'),
+                      (u'other print', candidate_trigrams(u'Nineteen Eighty-Four', [u'George Orwell']), (), None),
+                      (u'kindle', candidate_trigrams(u'1984: Nineteen Eighty-Four', [u'George Orwell']), (), KINDLE_BINDING),
+                      (u'same book', candidate_trigrams(u'1984', [u'George Orwell']), [u'9780451524935', u'0451524934'], None)]
+        # equal scores keep the source's order
+        self.assertEqual(self.query.rank(candidates), [u'same book', u'kindle', u'print', u'other print', u'farm'])
+        self.assertEqual(self.query.rank([]), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import recordformat
+from books import Book, Log
+from metadatacache import MANIFEST, BulkOPFWriter, ISBNConvert, MetadataCache, atomic_write, identifier_keys, normalize_identifier
+
+ORWELL = Book(u'Nineteen Eighty-Four', [u'George Orwell'], {u'amazon': u'0451524934', u'isbn': u'978-0-451-52493-5'})
+
+class IdentifierTest(unittest.TestCase):
+
+    def test_isbn_forms(self):
+        self.assertTrue(ISBNConvert.isValid(u'0-451-52493-4'))
+        self.assertFalse(ISBNConvert.isValid(u'0451524935'))
+        self.assertEqual(ISBNConvert.convert(u'0451524934'), u'9780451524935')
+        self.assertEqual(ISBNConvert.convert(u'9780451524935'), u'0451524934')
+        self.assertEqual(ISBNConvert.convert(u'080442957X'), u'9780804429573')
+
+    def test_identifier_keys(self):
+        self.assertEqual(normalize_identifier(u' 978-0-451 '), u'9780451')
+        self.assertEqual(identifier_keys(ORWELL.identifiers), set([u'0451524934', u'9780451524935']))
+        # an ASIN is never taken for an ISBN, and identifiers of other sites are ignored
+        self.assertEqual(identifier_keys({u'amazon_de': u'b00abc1234', u'goodreads': u'5470', u'isbn': u''}), set([u'B00ABC1234']))
+        # 979 ISBN-13s have no ISBN-10
+        self.assertEqual(identifier_keys({u'isbn': u'9791032305690'}), set([u'9791032305690']))
+
+class MetadataCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.cache = MetadataCache(os.path.join(self.location, u'cache'))
+        self.cache.ensure_location()
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def test_write_and_find(self):
+        self.assertEqual(self.cache.write(u'0451524934.mi', ORWELL, keys=[u'B000FC0PDA']), [])
+        self.assertTrue(recordformat.is_record(self.cache.read_raw(u'0451524934.mi')))
+        self.assertIn(u'0451524934.mi', self.cache)
+        for identifiers in ({u'isbn': u'0451524934'}, {u'ean': u'9780451524935'}, {u'amazon_uk': u'B000FC0PDA'}):
+            self.assertEqual(self.cache.find(identifiers), u'0451524934.mi')
+        self.assertIsNone(self.cache.find({u'isbn': u'9780140817744'}))
+        self.assertIsNotNone(self.cache.fetched_at(u'0451524934.mi'))
+        self.assertIsNone(self.cache.read_raw(u'missing.mi'))
+        entry, = list(self.cache.manifest())
+        self.assertEqual((entry[u'file'], entry[u'title'], entry[u'authors']), (u'0451524934.mi', ORWELL.title, ORWELL.authors))
+
+    def test_records_without_a_manifest_entry_are_found_by_name(self):
+        atomic_write(self.cache.path(u'0140817743.mi'), recordformat.encode(Book(u'Old')))
+        self.assertEqual(self.cache.find({u'isbn': u'0140817743'}), u'0140817743.mi')
+        self.assertEqual(self.cache.identity_index(), {})
+
+    def test_other_writers_are_seen(self):
+        self.assertEqual(self.cache.identity_index(), {})
+        other = MetadataCache(self.cache.location)
+        other.write(u'0451524934.mi', ORWELL)
+        self.assertEqual(self.cache.find({u'isbn': u'0451524934'}), u'0451524934.mi')
+        self.assertIn(u'0451524934.mi', self.cache)
+
+    def test_partial_manifest_line_is_read_once_complete(self):
+        self.cache.write(u'0451524934.mi', ORWELL)
+        line = json.dumps({u'file': u'B000FC0PDA.mi', u'keys': [u'B000FC0PDA'], u'time': 1}) + u'\n'
+        with open(self.cache.path(MANIFEST), 'ab') as f:
+            f.write(line[:10].encode('utf-8'))
+        self.assertIsNone(self.cache.find({u'amazon': u'B000FC0PDA'}))
+        with open(self.cache.path(MANIFEST), 'ab') as f:
+            f.write(line[10:].encode('utf-8'))
+        self.assertEqual(self.cache.find({u'amazon': u'B000FC0PDA'}), u'B000FC0PDA.mi')
+        self.assertEqual(self.cache.fetched_at(u'B000FC0PDA.mi'), 1)
+
+    def test_replaced_manifest_is_indexed_again(self):
+        self.cache.write(u'0451524934.mi', ORWELL)
+        self.cache.write(u'B000FC0PDA.mi', Book(u'Other', identifiers={u'amazon': u'B000FC0PDA'}))
+        self.assertEqual(len(self.cache.identity_index()), 3)
+        with open(self.cache.path(MANIFEST), 'wb') as f:
+            f.write((json.dumps({u'file': u'X.mi', u'keys': [u'X']}) + u'\n').encode('utf-8'))
+        self.assertEqual(self.cache.identity_index(), {u'X': u'X.mi'})
+
+    def test_match_index(self):
+        self.cache.write(u'0451524934.mi', ORWELL)
+        match = self.cache.match_index()
+        self.cache.write(u'B000FC0PDA.mi', Book(u'Animal Farm', [u'George Orwell'], {u'amazon': u'B000FC0PDA'}))
+        self.assertIs(self.cache.match_index(), match)
+        self.assertEqual(match.query(u'animal farm', [u'orwell'])[0][1], u'B000FC0PDA.mi')
+
+    def test_covers(self):
+        self.assertIsNone(self.cache.read_cover(u'0451524934.mi'))
+        self.cache.write_cover(u'0451524934.mi', b'jpeg')
+        self.assertEqual(self.cache.read_cover(u'0451524934'), b'jpeg')
+
+class BulkOPFWriterTest(unittest.TestCase):
+
+    def test_writes_in_batches(self):
+        location = tempfile.mkdtemp()
+        try:
+            cache = MetadataCache(location)
+            log = Log()
+            with BulkOPFWriter(cache, log, batch_size=3, queue_size=2) as writer:
+                for n in range(7):
+                    writer.put(u'B%09d.mi' % n, Book(u'Book %d' % n, identifiers={u'amazon': u'B%09d' % n}))
+                writer.put_serialized(cache.serialize(u'0451524934.mi', ORWELL))
+                writer.put(u'bad.mi', None)
+                self.assertIn(u'bad.mi', writer)
+            self.assertEqual((writer.written, writer.failed), (8, 1))
+            self.assertEqual(len(log.messages), 1)
+            self.assertEqual(cache.find({u'amazon': u'B000000006'}), u'B000000006.mi')
+            self.assertEqual(len(list(cache.manifest())), 8)
+        finally:
+            shutil.rmtree(location)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import recordformat
+from books import Book, Log
+from metadatacache import MetadataCache, atomic_write
+from metadatasnapshot import _ENTRY, _HEADER, MAGIC, KEY_SIZE, SNAPSHOT, MetadataSnapshot, SnapshotError, compile_snapshot
+
+class MetadataSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.cache = MetadataCache(self.location)
+        self.snapshot = None
+
+    def tearDown(self):
+        if self.snapshot is not None:
+            self.snapshot.close()
+        shutil.rmtree(self.location)
+
+    def _compile(self, log=None):
+        result = compile_snapshot(self.cache, log=log)
+        self.snapshot = MetadataSnapshot(self.cache.path(SNAPSHOT))
+        return result
+
+    def test_every_identifier_finds_the_record(self):
+        self.cache.write(u'0451524934.mi', Book(u'Nineteen Eighty-Four', [u'George Orwell'], {u'isbn': u'0451524934'}), keys=[u'B000FC0PDA'])
+        self.cache.write(u'B00ABC1234.mi', Book(u'Other', identifiers={u'amazon': u'B00ABC1234'}))
+        self.assertEqual(self._compile(), (2, 4))
+        self.assertEqual((self.snapshot.records, self.snapshot.keys), (2, 4))
+        for identifier in (u'0451524934', u'978-0-451-52493-5', u'b000fc0pda'):
+            self.assertIn(identifier, self.snapshot)
+            self.assertEqual(recordformat.Record(self.snapshot.payload(identifier)).title, u'Nineteen Eighty-Four')
+        self.assertEqual(recordformat.Record(self.snapshot.payload(u'B00ABC1234')).title, u'Other')
+        self.assertEqual(int(self.snapshot.fetched_at(u'0451524934')), int(self.cache.fetched_at(u'0451524934.mi')))
+        for missing in (u'', None, u'0000000000', u'ZZZZZZZZZZ', u'0'):
+            self.assertNotIn(missing, self.snapshot)
+            self.assertIsNone(self.snapshot.payload(missing))
+            self.assertIsNone(self.snapshot.fetched_at(missing))
+
+    def test_binary_search_over_many_keys(self):
+        asins = [u'B%09d' % (n * 7919 % 100000) for n in range(300)]
+        for asin in asins:
+            self.cache.write(asin + u'.mi', Book(asin, identifiers={u'amazon': asin}))
+        self.assertEqual(self._compile(), (300, 300))
+        for asin in asins:
+            self.assertEqual(recordformat.Record(self.snapshot.payload(asin)).title, asin)
+        self.assertNotIn(u'B999999999', self.snapshot)
+        # the index is sorted, in place in the file
+        keys = [_ENTRY.unpack_from(self.snapshot._map, self.snapshot._index_offset + i * _ENTRY.size)[0] for i in range(self.snapshot.keys)]
+        self.assertEqual(keys, sorted(keys))
+
+    def test_payload_is_a_view_of_the_mapping(self):
+        self.cache.write(u'B00ABC1234.mi', Book(u'Other', identifiers={u'amazon': u'B00ABC1234'}))
+        self._compile()
+        payload = self.snapshot.payload(u'B00ABC1234')
+        self.assertNotIsInstance(payload, bytes)
+        self.assertTrue(recordformat.is_record(payload))
+        self.assertEqual(bytes(payload), self.cache.read_raw(u'B00ABC1234.mi'))
+        # closing while a payload is held does not fail
+        self.snapshot.close()
+        self.snapshot = None
+
+    def test_unreadable_records_are_skipped(self):
+        self.cache.write(u'B00ABC1234.mi', Book(u'Other', identifiers={u'amazon': u'B00ABC1234'}))
+        atomic_write(self.cache.path(u'B00BROKEN0.mi'), recordformat.encode(Book(u'Broken'))[:-2])
+        log = Log()
+        self.assertEqual(self._compile(log), (1, 1))
+        self.assertEqual(log.messages, [(u'error', u'snapshot: skipping unreadable record B00BROKEN0.mi')])
+
+    def test_other_files_are_refused(self):
+        path = os.path.join(self.location, u'old.snapshot')
+        with open(path, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, 1, 1, 0, 0, _HEADER.size))
+        with self.assertRaises(SnapshotError) as raised:
+            MetadataSnapshot(path)
+        self.assertIn(u'run --export-snapshot again', u'%s' % raised.exception)
+        with open(path, 'wb') as f:
+            f.write(b'<?xml version="1.0"?><package/>' + b' ' * _HEADER.size)
+        self.assertRaises(SnapshotError, MetadataSnapshot, path)
+        with open(path, 'wb') as f:
+            f.write(b'APMS')
+        self.assertRaises(struct.error, MetadataSnapshot, path)
+
+    def test_long_keys_are_truncated(self):
+        self.assertEqual(KEY_SIZE, 16)
+        self.cache.write(u'X.mi', Book(u'Long', identifiers={u'amazon': u'A' * 20}))
+        self._compile()
+        self.assertIn(u'A' * 20, self.snapshot)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+# coding=utf-8
+#
+# Paapi5API against the stand-in server of paapi5_standin, plus the pieces that
+# need no server: SigV4 known answers, Paapi5Product and parse_products.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import datetime
+import json
+import unittest
+
+from amazonsimpleproductapi import SearchException
+from paapi5 import GET_ITEMS_MAX, OPERATIONS, Paapi5API, Paapi5Product, sigv4_headers
+from paapi5_standin import ACCESS_KEY, SECRET_KEY, Paapi5StandIn, item
+
+class _Metrics(object):
+    """Records what parse_products reports; record_request and the rest are no-ops."""
+
+    def __init__(self):
+        self.counters = []
+        self.events = []
+
+    def inc(self, name, **labels):
+        self.counters.append((name, labels))
+
+    def emit(self, event, **fields):
+        self.events.append((event, fields))
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+CATALOG = [item(u'B%09d' % n, u'Book %d' % n, [u'Author %d' % n]) for n in range(25)] + [
+    item(u'0451524934', u'Nineteen Eighty-Four', [u'George Orwell'], isbn=u'9780451524935', publisher=u'Signet Classic',
+         published=u'1961-01-01', image=u'https://images.example/1984.jpg', languages=[u'English'], browse_nodes=[(u'25', u'Classics')])]
+
+class SigV4Test(unittest.TestCase):
+    """The get-vanilla and post-vanilla cases of the AWS Signature Version 4 test suite."""
+
+    KEY = u'AKIDEXAMPLE'
+    SECRET = u'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY'
+    NOW = datetime.datetime(2015, 8, 30, 12, 36, 0)
+
+    def _authorization(self, method):
+        return sigv4_headers(self.KEY, self.SECRET, u'us-east-1', u'service', method, u'example.amazonaws.com', u'/', {}, b'', self.NOW)
+
+    def test_get_vanilla(self):
+        headers = self._authorization(u'GET')
+        self.assertEqual(headers[u'x-amz-date'], u'20150830T123600Z')
+        self.assertEqual(headers[u'Authorization'],
+                         u'AWS4-HMAC-SHA256 Credential=AKIDEXAMPLE/20150830/us-east-1/service/aws4_request, SignedHeaders=host;x-amz-date, '
+                         u'Signature=5fa00fa31553b73ebf1942676e86291e8372ff2a2260956d9b8aae1d763fbf31')
+
+    def test_post_vanilla(self):
+        self.assertTrue(self._authorization(u'POST')[u'Authorization'].endswith(
+            u'Signature=5da7c1a2acd57cee7505fc6676e4e544621c30862966e37dddb68e92efbe5d6b'))
+
+    def test_extra_headers_are_signed(self):
+        headers = sigv4_headers(self.KEY, self.SECRET, u'us-east-1', u'service', u'POST', u'example.amazonaws.com', u'/',
+                                {u'X-Amz-Target': u'op', u'content-type': u'application/json'}, b'{}', self.NOW)
+        self.assertIn(u'SignedHeaders=content-type;host;x-amz-date;x-amz-target,', headers[u'Authorization'])
+
+class Paapi5ProductTest(unittest.TestCase):
+
+    def test_fields(self):
+        product = Paapi5Product(CATALOG[-1], [u'Images', u'ItemAttributes'])
+        self.assertEqual(product.asin, u'0451524934')
+        self.assertEqual(product.title, u'Nineteen Eighty-Four')
+        self.assertEqual(product.authors, [u'George Orwell'])
+        self.assertEqual(product.creators, [])
+        self.assertEqual(product.publisher, u'Signet Classic')
+        self.assertEqual(product.isbn, u'9780451524935')
+        self.assertIsNone(product.ean)
+        self.assertEqual(product.binding, u'Paperback')
+        self.assertEqual(product.publication_date, datetime.date(1961, 1, 1))
+        self.assertIsNone(product.release_date)
+        self.assertEqual(product.large_image_url, u'https://images.example/1984.jpg')
+        self.assertEqual(product.languages, set([u'english']))
+        self.assertEqual([(n.id, n.name.text) for n in product.browse_nodes], [(u'25', u'Classics')])
+        self.assertEqual(product.editorial_review, u'')
+        self.assertEqual(product.alternate_versions, [])
+
+    def test_missing_fields(self):
+        product = Paapi5Product({u'ASIN': u'B000000000', u'ItemInfo': {u'ContentInfo': {u'PublicationDate': {u'DisplayValue': u'1961'}}}})
+        self.assertIsNone(product.title)
+        self.assertEqual(product.authors, [])
+        self.assertIsNone(product.isbn)
+        self.assertIsNone(product.publication_date)
+        self.assertIsNone(product.large_image_url)
+        self.assertEqual(product.browse_nodes, [])
+
+    def test_missing_groups_and_merge(self):
+        cover = Paapi5Product({u'ASIN': u'0451524934', u'Images': CATALOG[-1][u'Images']}, [u'Images'])
+        self.assertEqual(cover.missing_groups(u'cover'), frozenset())
+        # AlternateVersions and EditorialReview have no resource, so they are never missing
+        self.assertEqual(cover.missing_groups(), frozenset([u'BrowseNodes', u'ItemAttributes']))
+        self.assertEqual(Paapi5Product(cover.item).missing_groups(), frozenset())
+        cover.merge(Paapi5Product(dict(CATALOG[-1], Images={u'Primary': {u'Large': {u'URL': u'other'}}}), [u'ItemAttributes', u'BrowseNodes']))
+        self.assertEqual(cover.missing_groups(), frozenset())
+        self.assertEqual(cover.title, u'Nineteen Eighty-Four')
+        self.assertEqual(cover.large_image_url, u'https://images.example/1984.jpg')
+
+class ParseProductsTest(unittest.TestCase):
+
+    def test_items(self):
+        raw = json.dumps({u'ItemsResult': {u'Items': CATALOG[:2]}}).encode('utf-8')
+        products = Paapi5API.parse_products(raw, request={u'ResponseGroup': u'Images'})
+        self.assertEqual([p.asin for p in products], [u'B000000000', u'B000000001'])
+        self.assertEqual(products[0].response_groups, frozenset([u'Images']))
+        self.assertIsNone(Paapi5API.parse_products({u'SearchResult': {u'Items': CATALOG[:1]}})[0].response_groups)
+
+    def test_error(self):
+        metrics = _Metrics()
+        raw = {u'Errors': [{u'Code': u'InvalidParameterValue', u'Message': u'bad ItemId'}]}
+        with self.assertRaises(SearchException) as raised:
+            Paapi5API.parse_products(raw, metrics, {u'Operation': u'GetItems'})
+        self.assertEqual((raised.exception.code, raised.exception.msg), (u'InvalidParameterValue', u'bad ItemId'))
+        self.assertEqual(metrics.counters, [(u'api_errors_total', {u'code': u'InvalidParameterValue', u'operation': u'GetItems'})])
+        self.assertEqual(metrics.events[0][0], u'api_error')
+
+    def test_empty_response_is_no_results(self):
+        with self.assertRaises(SearchException) as raised:
+            Paapi5API.parse_products(b'{"SearchResult": {"Items": []}}')
+        self.assertEqual(raised.exception.code, u'NoResults')
+
+class Paapi5APITest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Paapi5StandIn(CATALOG).__enter__()
+        self.cache = {}
+        self.api = Paapi5API(ACCESS_KEY, SECRET_KEY, u'tag-20', Region=u'US', MaxQPS=1000, Endpoint=self.server.endpoint,
+                             CacheReader=self.cache.get, CacheWriter=self.cache.__setitem__)
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+
+    def test_lookup_is_split_in_get_items_calls(self):
+        asins = [i[u'ASIN'] for i in CATALOG[:23]]
+        products = self.api.item_lookup(u','.join(asins))
+        self.assertEqual([p.asin for p in products], asins)
+        self.assertEqual([len(body[u'ItemIds']) for path, body in self.server.requests], [GET_ITEMS_MAX, GET_ITEMS_MAX, 3])
+        self.assertTrue(all(path == OPERATIONS[u'GetItems'] and u'PartnerTag' in body for path, body in self.server.requests))
+        # every call went to the cache: the same lookup sends nothing
+        self.assertEqual(len(self.cache), 3)
+        self.api.item_lookup(u','.join(asins))
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_lookup_raw_gathers_the_calls(self):
+        asins = [i[u'ASIN'] for i in CATALOG[:12]] + [u'B999999999']
+        response = json.loads(self.api.item_lookup_raw(u','.join(asins)).decode('utf-8'))
+        self.assertEqual([i[u'ASIN'] for i in response[u'ItemsResult'][u'Items']], asins[:-1])
+        self.assertEqual(len(self.server.requests), 2)
+        single = json.loads(self.api.item_lookup_raw(asins[0]).decode('utf-8'))
+        self.assertEqual(single[u'ItemsResult'][u'Items'][0][u'ASIN'], asins[0])
+
+    def test_isbn_lookup(self):
+        products = self.api.item_lookup(u'9780451524935', IdType=u'ISBN')
+        self.assertEqual([p.asin for p in products], [u'0451524934'])
+        path, body = self.server.requests[0]
+        self.assertEqual((path, body[u'Keywords'], body[u'ItemCount']), (OPERATIONS[u'SearchItems'], u'9780451524935', 1))
+
+    def test_search(self):
+        products = self.api.item_search(Title=u'eighty-four')
+        self.assertEqual(products[0].authors, [u'George Orwell'])
+        self.assertEqual(products[0].missing_groups(), frozenset())
+
+    def test_errors_are_not_cached(self):
+        with self.assertRaises(SearchException) as raised:
+            self.api.item_search(Keywords=u'no such book')
+        self.assertEqual(raised.exception.code, u'NoResults')
+        with self.assertRaises(SearchException):
+            self.api.item_lookup(u'B999999999')
+        self.assertEqual(self.cache, {})
+        with self.assertRaises(SearchException):
+            self.api.item_search(Keywords=u'no such book')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_bad_signature_is_refused(self):
+        api = Paapi5API(ACCESS_KEY, u'wrong secret', u'tag-20', Region=u'US', MaxQPS=1000, Endpoint=self.server.endpoint)
+        with self.assertRaises(Exception) as raised:
+            api.item_lookup(CATALOG[0][u'ASIN'])
+        self.assertEqual(getattr(raised.exception, 'code', None), 401)
+        self.assertEqual(self.server.requests, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from quotaledger import BUCKET, QuotaLedger
+
+def _take(path, count):
+    ledger = QuotaLedger(path, {3600: 100000})
+    for _ in range(count):
+        assert ledger.try_acquire() == 0.0
+
+class QuotaLedgerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, u'quota', u'quota.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _count(self):
+        with open(self.path, 'rb') as f:
+            return sum(json.loads(f.read().decode('utf-8'))[u'buckets'].values())
+
+    def test_limit(self):
+        ledger = QuotaLedger(self.path, {3600: 3, 86400: 10, 60: 0})
+        self.assertEqual(ledger.limits, {3600: 3, 86400: 10})
+        for _ in range(3):
+            self.assertEqual(ledger.try_acquire(), 0.0)
+        self.assertEqual(ledger.remaining(), {3600: 0, 86400: 7})
+        # the oldest requests leave the hour window within the hour
+        wait = ledger.try_acquire()
+        self.assertTrue(3600 - BUCKET < wait <= 3600 + BUCKET, wait)
+        self.assertAlmostEqual(ledger.wait_time(), wait, places=1)
+        self.assertIsNone(ledger.acquire(wait=False))
+        self.assertIsNone(ledger.acquire(deadline=time.time() + 1))
+        abort = threading.Event()
+        abort.set()
+        self.assertIsNone(ledger.acquire(abort=abort))
+
+    def test_no_limits(self):
+        ledger = QuotaLedger(self.path, {})
+        self.assertEqual(ledger.wait_time(), 0.0)
+        self.assertIsNotNone(ledger.acquire())
+
+    def test_refund(self):
+        ledger = QuotaLedger(self.path, {3600: 1})
+        ledger.acquire()
+        self.assertTrue(ledger.wait_time() > 0)
+        ledger.refund()
+        self.assertEqual(ledger.wait_time(), 0.0)
+        self.assertEqual(self._count(), 0)
+        ledger.refund()
+        self.assertEqual(self._count(), 0)
+
+    def test_reservation(self):
+        batch = QuotaLedger(self.path, {3600: 5})
+        interactive = QuotaLedger(self.path, {3600: 5})
+        batch.reservation, reserved = batch.reserve(3)
+        self.assertEqual(reserved, 3)
+        # the reserved units are held back from everyone else
+        self.assertEqual(interactive.remaining(), {3600: 2})
+        self.assertEqual(interactive.try_acquire(), 0.0)
+        self.assertEqual(interactive.try_acquire(), 0.0)
+        self.assertTrue(interactive.try_acquire() > 0)
+        for _ in range(3):
+            self.assertEqual(batch.try_acquire(), 0.0)
+        self.assertTrue(batch.try_acquire() > 0)
+        # capped by what is left
+        self.assertEqual(interactive.reserve(10)[1], 0)
+
+    def test_release_and_expiry(self):
+        batch = QuotaLedger(self.path, {3600: 5})
+        batch.reservation, reserved = batch.reserve(4)
+        other = QuotaLedger(self.path, {3600: 5})
+        self.assertEqual(other.remaining(), {3600: 1})
+        batch.release(batch.reservation)
+        self.assertIsNone(batch.reservation)
+        self.assertEqual(other.remaining(), {3600: 5})
+        key, reserved = batch.reserve(4, ttl=0.05)
+        time.sleep(0.1)
+        self.assertEqual(other.remaining(), {3600: 5})
+
+    def test_threads_share_the_ledger(self):
+        ledger = QuotaLedger(self.path, {3600: 100000})
+        threads = [threading.Thread(target=lambda: [ledger.try_acquire() for _ in range(25)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self._count(), 100)
+
+    def test_processes_share_the_ledger(self):
+        processes = [multiprocessing.Process(target=_take, args=(self.path, 25)) for _ in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual([p.exitcode for p in processes], [0] * 4)
+        # no read-modify-write was lost
+        self.assertEqual(self._count(), 100)
+
+if __name__ == '__main__':
+    unittest.main()
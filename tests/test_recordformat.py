@@ -0,0 +1,55 @@
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import struct
+import unittest
+
+from books import Book
+from recordformat import MAGIC, VERSION, Record, RecordError, encode, is_record
+
+def _book(**fields):
+    # the pubdate needs calibre's date helpers, so it is left out
+    return Book(u'Nineteen Eighty-Four', [u'George Orwell', u'Ünïcode Author'],
+                {u'amazon': u'B000FC0PDA', u'isbn': u'9780451524935'}, **fields)
+
+class RecordFormatTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        data = encode(_book(publisher=u'Signet', languages=[u'eng'], tags=[u'Fiction', u'Classics'], comments=u'<p>Big Brother</p>',
+                            binding=u'Mass Market Paperback'))
+        self.assertTrue(is_record(data))
+        record = Record(data)
+        self.assertEqual(record.title, u'Nineteen Eighty-Four')
+        self.assertEqual(record.authors, [u'George Orwell', u'Ünïcode Author'])
+        self.assertEqual(record.identifiers, {u'amazon': u'B000FC0PDA', u'isbn': u'9780451524935'})
+        self.assertEqual((record.publisher, record.languages, record.tags), (u'Signet', [u'eng'], [u'Fiction', u'Classics']))
+        self.assertEqual((record.comments, record.binding), (u'<p>Big Brother</p>', u'Mass Market Paperback'))
+
+    def test_unset_fields(self):
+        record = Record(encode(Book(u'Title')))
+        self.assertEqual((record.authors, record.identifiers, record.pubdate, record.publisher), ([], {}, None, None))
+        self.assertRaises(AttributeError, getattr, record, u'rating')
+
+    def test_views_are_read_in_place(self):
+        data = b'padding' + encode(_book(tags=[u'Fiction']))
+        view = memoryview(data)[len(b'padding'):]
+        self.assertTrue(is_record(view))
+        record = Record(view)
+        self.assertEqual((record.title, record.tags), (u'Nineteen Eighty-Four', [u'Fiction']))
+
+    def test_unknown_tags_are_skipped(self):
+        data = encode(_book())
+        extra = struct.pack(str('<BI'), 200, 3) + b'new'
+        data = data[:5] + struct.pack(str('<B'), struct.unpack(str('<B'), data[5:6])[0] + 1) + data[6:] + extra
+        self.assertEqual(Record(data).title, u'Nineteen Eighty-Four')
+
+    def test_bad_records(self):
+        data = encode(_book())
+        self.assertFalse(is_record(b'<?xml version="1.0"?><package/>'))
+        for bad in (b'', MAGIC, data[:-3], b'<?xml version="1.0"?><package/>',
+                    MAGIC + struct.pack(str('<B'), VERSION + 1) + data[5:]):
+            self.assertRaises(RecordError, Record, bad)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import unittest
+
+from requestplan import IDS_PER_REQUEST, classify, plan_requests
+
+def _never(id_type, key):
+    return False
+
+class ClassifyTest(unittest.TestCase):
+
+    def test_classify(self):
+        self.assertEqual(classify(u'978-0-451-52493-5'), (u'ISBN', u'9780451524935'))
+        self.assertEqual(classify(u'080442957x'), (u'ISBN', u'080442957X'))
+        self.assertEqual(classify(u' b000fc0pda '), (u'ASIN', u'B000FC0PDA'))
+        for value in (u'0451524935', u'A000FC0PDA', u'B000FC0PD', u'hello'):
+            self.assertIsNone(classify(value), value)
+
+class PlanRequestsTest(unittest.TestCase):
+
+    def test_grouped_and_cut_in_requests(self):
+        asins = [u'B%09d' % n for n in range(23)]
+        plan = plan_requests(asins + [u'9780451524935'], _never, _never, u'US', u'Books', 1.5)
+        self.assertEqual([(r.id_type, r.search_index, len(r.ids)) for r in plan.requests],
+                         [(u'ASIN', None, IDS_PER_REQUEST), (u'ASIN', None, IDS_PER_REQUEST), (u'ASIN', None, 3), (u'ISBN', u'Books', 1)])
+        self.assertEqual(plan.requests[0].ids, asins[:IDS_PER_REQUEST])
+        self.assertEqual((plan.calls, plan.ids, plan.estimated_seconds), (4, 24, 6.0))
+        self.assertEqual(plan.requests[-1].region, u'US')
+
+    def test_dropped_identifiers(self):
+        cached = set([u'B000000001'])
+        missing = set([u'9780140817744'])
+        plan = plan_requests([u'B000000001', u'0451524934', u'978-0451524935', u'', u'  ', u'nonsense', u'B000000002', u'B000000002',
+                              u'9780140817744'],
+                             lambda id_type, key: key in cached, lambda id_type, key: key in missing, u'US', u'Books', 1.0)
+        self.assertEqual((plan.total, plan.duplicates, plan.cached, plan.missing, plan.invalid), (7, 2, 1, 1, 1))
+        self.assertEqual([r.ids for r in plan.requests], [[u'0451524934'], [u'B000000002']])
+        self.assertEqual(plan.summary(), u'7 identifiers: 2 to look up in 2 calls (~2s), 2 duplicates, 1 cached, 1 known missing, 1 invalid')
+
+    def test_priorities(self):
+        asins = [u'B%09d' % n for n in range(12)]
+        priorities = {u'B000000011': -1, u'B000000010': -1}
+        plan = plan_requests(asins, _never, _never, u'US', u'Books', 1.0, priorities)
+        self.assertEqual(plan.requests[0].ids[:2], [u'B000000010', u'B000000011'])
+        self.assertEqual([r.priority for r in plan.requests], [-1, 8])
+
+    def test_empty(self):
+        plan = plan_requests([], _never, _never, u'US', u'Books', 1.0)
+        self.assertEqual((plan.calls, plan.ids, plan.requests), (0, 0, []))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from amazonsimpleproductapi import RESPONSE_PROFILES
+from paapi5 import resources
+from responsearchive import (DATA, FULL, INDEX, JSON, NO_DICTIONARY, TRAIN_SAMPLES, XML, ResponseArchive, _Codec, item_asins, request_profile,
+                             response_format, train_dictionary)
+
+def _xml(*asins, **kwargs):
+    title = kwargs.get(u'title', u'Nineteen Eighty-Four')
+    items = u''.join(u'<Item><ASIN>%s</ASIN><ItemAttributes><Binding>Paperback</Binding><Title>%s</Title></ItemAttributes>'
+                     u'<AlternateVersions><AlternateVersion><ASIN>B999999999</ASIN></AlternateVersion></AlternateVersions></Item>'
+                     % (asin, title) for asin in asins)
+    return (u'<?xml version="1.0"?><ItemLookupResponse><Items>%s</Items></ItemLookupResponse>' % items).encode('utf-8')
+
+def _json(*asins):
+    return json.dumps({u'ItemsResult': {u'Items': [{u'ASIN': asin, u'ItemInfo': {u'Title': {u'DisplayValue': u'Dune'}}} for asin in asins]}}).encode('utf-8')
+
+class FunctionsTest(unittest.TestCase):
+
+    def test_formats_and_asins(self):
+        self.assertEqual((response_format(_xml(u'B000FC0PDA')), response_format(b'  ' + _json(u'B000FC0PDA'))), (XML, JSON))
+        self.assertEqual(item_asins(_xml(u'B000FC0PDA', u'0451524934', u'B000FC0PDA')), [u'B000FC0PDA', u'0451524934'])
+        self.assertEqual(item_asins(_json(u'B00ABC1234')), [u'B00ABC1234'])
+        self.assertEqual(item_asins(b'<ItemSearchResponse><Items/></ItemSearchResponse>'), [])
+
+    def test_request_profile(self):
+        def xml_url(operation, groups):
+            return u'https://webservices.amazon.com/onca/xml?Operation=%s&ResponseGroup=%s' % (operation, groups.replace(u',', u'%2C'))
+
+        def json_url(operation, groups):
+            return u'https://webservices.amazon.com/paapi5/%s?%s' % (operation, json.dumps({u'Resources': resources(groups.split(u','))}))
+
+        for name in (FULL, u'identity', u'cover'):
+            self.assertEqual(request_profile(xml_url(u'ItemLookup', RESPONSE_PROFILES[name])), name)
+        self.assertEqual(request_profile(xml_url(u'ItemLookup', RESPONSE_PROFILES[FULL] + u',Reviews')), FULL)
+        self.assertEqual(request_profile(xml_url(u'ItemLookup', u'Small')), u'')
+        self.assertEqual(request_profile(xml_url(u'ItemSearch', RESPONSE_PROFILES[FULL])), u'')
+        self.assertEqual(request_profile(json_url(u'getitems', RESPONSE_PROFILES[FULL])), FULL)
+        self.assertEqual(request_profile(json_url(u'getitems', RESPONSE_PROFILES[u'cover'])), u'cover')
+        self.assertEqual(request_profile(json_url(u'searchitems', RESPONSE_PROFILES[FULL])), u'')
+
+    def test_dictionary(self):
+        samples = [_xml(u'B%09d' % n, title=u'Title %d' % n) for n in range(5)]
+        dictionary = train_dictionary(samples)
+        self.assertIn(b'<Binding>Paperback', dictionary)
+        self.assertNotIn(b'Title 3', dictionary)
+        self.assertTrue(len(train_dictionary(samples, size=20)) <= 20)
+        codec = _Codec(dictionary)
+        plain = _Codec(b'')
+        raw = _xml(u'B000FC0PDA', title=u'Dune')
+        self.assertTrue(len(codec.compress(raw)) < len(plain.compress(raw)))
+        # the primed streams are copied, so every response decompresses on its own
+        for data in (raw, samples[0], raw):
+            self.assertEqual(codec.decompress(codec.compress(data)), data)
+            self.assertEqual(_Codec(dictionary).decompress(codec.compress(data)), data)
+
+class ResponseArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive = ResponseArchive(os.path.join(self.directory, u'archive'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_append_and_get(self):
+        self.assertIsNone(self.archive.get(u'B000FC0PDA'))
+        self.assertEqual(self.archive.append(b'<ItemSearchResponse/>'), 0)
+        full = _xml(u'B000FC0PDA', u'0451524934')
+        self.assertEqual(self.archive.append(full, FULL, fetched=100.0), 2)
+        cover = _json(u'B000FC0PDA')
+        self.archive.append(cover, u'cover', fetched=200.0)
+        self.assertEqual(self.archive.get(u'b000fc0pda'), (cover, 200.0))
+        self.assertEqual(self.archive.get(u'B000FC0PDA', FULL), (full, 100.0))
+        self.assertIsNone(self.archive.get(u'0451524934', u'cover'))
+        # another process's appends are read from the index
+        other = ResponseArchive(self.archive.location)
+        self.assertEqual(other.get(u'0451524934'), (full, 100.0))
+        newer = _xml(u'0451524934')
+        other.append(newer, FULL, fetched=300.0)
+        self.assertEqual(self.archive.get(u'0451524934'), (newer, 300.0))
+        self.assertEqual(sorted(self.archive.latest_responses()), sorted([(full, [u'B000FC0PDA']), (newer, [u'0451524934'])]))
+        stats = self.archive.stats()
+        self.assertEqual((stats[u'responses'], stats[u'asins'], stats[u'dictionary']), (3, 2, u'0' * 16))
+
+    def test_dictionary_is_trained(self):
+        for n in range(TRAIN_SAMPLES + 1):
+            self.archive.append(_xml(u'B%09d' % n, title=u'Title %d' % n), FULL)
+        self.assertNotEqual(self.archive.current_dictionary(), NO_DICTIONARY)
+        self.assertNotEqual(self.archive.stats()[u'dictionary'], u'0' * 16)
+        # old and new responses read back, from a fresh process too
+        other = ResponseArchive(self.archive.location)
+        for n in (0, TRAIN_SAMPLES):
+            self.assertEqual(other.get(u'B%09d' % n)[0], _xml(u'B%09d' % n, title=u'Title %d' % n))
+
+    def test_rebuild_index(self):
+        self.archive.append(_xml(u'B000FC0PDA'), FULL, fetched=100.0)
+        self.archive.append(_json(u'B00ABC1234', u'B000FC0PDA'), u'', fetched=200.0)
+        with open(self.archive.path(DATA), 'ab') as f:
+            f.write(b'APRA partial')
+        os.remove(self.archive.path(INDEX))
+        self.assertEqual(self.archive.rebuild_index(), 2)
+        self.assertEqual(self.archive.get(u'B000FC0PDA', FULL), (_xml(u'B000FC0PDA'), 100.0))
+        self.assertEqual(self.archive.get(u'B000FC0PDA')[1], 200.0)
+        self.assertEqual(self.archive.stats()[u'asins'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+import time
+import unittest
+
+from scheduler import BATCH, INTERACTIVE, RequestScheduler
+
+class RequestSchedulerTest(unittest.TestCase):
+
+    def _run(self, scheduler, priority, stop):
+        while not stop.is_set():
+            scheduler.acquire(priority, abort=stop)
+
+    def _threads(self, scheduler, priorities, stop):
+        threads = [threading.Thread(target=self._run, args=(scheduler, p, stop)) for p in priorities]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        return threads
+
+    def test_rate(self):
+        scheduler = RequestScheduler(20)
+        self.assertTrue(scheduler.try_acquire())
+        self.assertFalse(scheduler.try_acquire())
+        start = time.time()
+        for _ in range(3):
+            self.assertIsNotNone(scheduler.acquire(u'unknown'))
+        self.assertTrue(time.time() - start >= 3 * 0.05 - 0.01)
+        self.assertEqual(scheduler.served[INTERACTIVE], 4)
+
+    def test_deadline_and_abort(self):
+        scheduler = RequestScheduler(1)
+        scheduler.acquire()
+        self.assertIsNone(scheduler.acquire(deadline=time.time() + 0.1))
+        abort = threading.Event()
+        threading.Timer(0.1, abort.set).start()
+        start = time.time()
+        self.assertIsNone(scheduler.acquire(BATCH, abort=abort))
+        self.assertTrue(time.time() - start < 0.5)
+        # the abandoned calls left the queues
+        self.assertEqual(scheduler.waiting(), {INTERACTIVE: 0, u'background': 0, BATCH: 0})
+
+    def test_weighted_share(self):
+        scheduler = RequestScheduler(200, {u'a': 3, u'b': 1})
+        stop = threading.Event()
+        threads = self._threads(scheduler, [u'a', u'a', u'b', u'b'], stop)
+        while sum(scheduler.served.values()) < 80:
+            time.sleep(0.01)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        share = scheduler.served[u'a'] / scheduler.served[u'b']
+        self.assertTrue(2 <= share <= 4, scheduler.served)
+
+    def test_interactive_overtakes_batch(self):
+        scheduler = RequestScheduler(50)
+        stop = threading.Event()
+        threads = self._threads(scheduler, [BATCH] * 5, stop)
+        time.sleep(0.1)
+        waits = []
+        for _ in range(3):
+            waits.append(scheduler.acquire(INTERACTIVE))
+        stop.set()
+        for thread in threads:
+            thread.join()
+        # within a slot or two, not behind the five queued batch calls
+        self.assertTrue(max(waits) < 4 * scheduler.interval, waits)
+
+    def test_idle_class_does_not_bank_credit(self):
+        scheduler = RequestScheduler(200, {u'a': 1, u'b': 1})
+        for _ in range(10):
+            scheduler.acquire(u'a')
+        stop = threading.Event()
+        threads = self._threads(scheduler, [u'a', u'b'], stop)
+        while sum(scheduler.served.values()) < 30:
+            time.sleep(0.01)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        # b does not get the ten slots a took alone back in a row
+        self.assertTrue(scheduler.served[u'a'] - 10 >= scheduler.served[u'b'] - 2, scheduler.served)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from searchcache import SearchCache, lookup_key, search_key
+
+class SearchKeyTest(unittest.TestCase):
+
+    def test_token_order_and_case_do_not_matter(self):
+        self.assertEqual(search_key([u'Eighty-Four', u'Nineteen', u''], [u'Orwell'], u'Books', u'US'),
+                         search_key([u'nineteen', u'eighty-four', u'nineteen'], [u'ORWELL'], u'Books', u'US'))
+        self.assertNotEqual(search_key([u'a'], [], u'Books', u'US'), search_key([u'a'], [], u'Books', u'UK'))
+        self.assertNotEqual(search_key([u'a'], [], u'Books', u'US'), search_key([], [u'a'], u'Books', u'US'))
+        self.assertEqual(lookup_key(u'ISBN', u'9780451524935', u'Books', u'US'), u'US|Books|lookup|ISBN|9780451524935')
+
+class SearchCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.cache = SearchCache(os.path.join(self.location, u'cache'), ttl=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def test_put_and_get(self):
+        self.assertIsNone(self.cache.get(u'k'))
+        self.cache.put(u'k', [u'B2', u'', u'B1'])
+        self.cache.put(u'empty', [])
+        self.assertEqual(self.cache.get(u'k'), [u'B2', u'B1'])
+        # an empty result is a result
+        self.assertEqual(self.cache.get(u'empty'), [])
+        self.cache.put(u'k', [u'B3'])
+        self.assertEqual(SearchCache(self.cache.location, 60).get(u'k'), [u'B3'])
+
+    def test_disabled(self):
+        cache = SearchCache(self.cache.location, 0)
+        cache.put(u'k', [u'B1'])
+        self.assertIsNone(cache.get(u'k'))
+        self.assertFalse(os.path.exists(cache.path))
+
+    def test_expired_entries(self):
+        self.cache.put(u'k', [u'B1'])
+        self.cache.ttl = 0.05
+        time.sleep(0.1)
+        self.assertIsNone(self.cache.get(u'k'))
+
+    def test_other_processes_appends_are_read(self):
+        other = SearchCache(self.cache.location, 60)
+        self.assertIsNone(self.cache.get(u'k'))
+        other.put(u'k', [u'B1'])
+        self.assertEqual(self.cache.get(u'k'), [u'B1'])
+        other.put(u'k', [u'B2'])
+        self.assertEqual(self.cache.get(u'k'), [u'B2'])
+
+    def test_partial_line_is_read_once_complete(self):
+        self.cache.put(u'k', [u'B1'])
+        line = json.dumps({u'key': u'other', u'time': time.time(), u'asins': [u'B9']}) + u'\n'
+        with open(self.cache.path, 'ab') as f:
+            f.write(line[:5].encode('utf-8'))
+        self.assertIsNone(self.cache.get(u'other'))
+        with open(self.cache.path, 'ab') as f:
+            f.write(line[5:].encode('utf-8'))
+        self.assertEqual(self.cache.get(u'other'), [u'B9'])
+
+    def test_superseded_and_expired_lines_are_compacted(self):
+        os.makedirs(self.cache.location)
+        now = time.time()
+        with open(self.cache.path, 'wb') as f:
+            for n in range(150):
+                f.write((json.dumps({u'key': u'k', u'time': now, u'asins': [u'B%d' % n]}) + u'\n').encode('utf-8'))
+            f.write((json.dumps({u'key': u'old', u'time': now - 3600, u'asins': []}) + u'\n').encode('utf-8'))
+        self.assertEqual(self.cache.get(u'k'), [u'B149'])
+        self.assertIsNone(self.cache.get(u'old'))
+        with open(self.cache.path, 'rb') as f:
+            self.assertEqual(len(f.readlines()), 1)
+        # the rewritten file is read like any other
+        other = SearchCache(self.cache.location, 60)
+        self.assertEqual(other.get(u'k'), [u'B149'])
+        self.cache.put(u'new', [u'B1'])
+        self.assertEqual(other.get(u'new'), [u'B1'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from books import Log
+from warmup import CoverFetcher, Progress, read_csv_identifiers, read_library_identifiers
+
+class ReadIdentifiersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_library(self):
+        connection = sqlite3.connect(os.path.join(self.directory, u'metadata.db'))
+        connection.execute(u'CREATE TABLE identifiers (id INTEGER PRIMARY KEY, book INTEGER, type TEXT, val TEXT)')
+        connection.executemany(u'INSERT INTO identifiers (book, type, val) VALUES (?, ?, ?)',
+                               [(2, u'isbn', u'9780451524935'), (1, u'amazon', u'B000FC0PDA'), (2, u'amazon', u'0451524934')])
+        connection.commit()
+        connection.close()
+        expected = [{u'amazon': u'B000FC0PDA'}, {u'isbn': u'9780451524935', u'amazon': u'0451524934'}]
+        self.assertEqual(read_library_identifiers(self.directory), expected)
+        self.assertEqual(read_library_identifiers(os.path.join(self.directory, u'metadata.db')), expected)
+
+    def test_csv(self):
+        path = os.path.join(self.directory, u'catalog.csv')
+        with io.open(path, u'w', encoding=u'utf-8-sig') as f:
+            f.write(u'title,identifiers,isbn,amazon_de\n'
+                    u'"Ünïcode","amazon:B000FC0PDA, goodreads:5470",,\n'
+                    u'Columns,,9780451524935,B00ABC1234\n'
+                    u'Both,isbn:0451524934,9780451524935,\n'
+                    u'Nothing,,,\n')
+        self.assertEqual(read_csv_identifiers(path), [{u'amazon': u'B000FC0PDA', u'goodreads': u'5470'},
+                                                      {u'isbn': u'9780451524935', u'amazon_de': u'B00ABC1234'},
+                                                      {u'isbn': u'0451524934'}])
+
+class ProgressTest(unittest.TestCase):
+
+    def test_line(self):
+        stream = io.StringIO()
+        progress = Progress(3, u'lookup', stream=stream, every=3600)
+        progress.update()
+        self.assertTrue(stream.getvalue().startswith(u'\rlookup 1/3 '))
+        # not shown again before `every` seconds, except for the last item
+        progress.update()
+        self.assertEqual(stream.getvalue().count(u'\r'), 1)
+        progress.update(1, covers=1)
+        progress.finish()
+        last = stream.getvalue().split(u'\r')[-1]
+        self.assertTrue(last.startswith(u'lookup 3/3 '), last)
+        self.assertTrue(last.endswith(u' covers=1\n'), last)
+
+class CoverFetcherTest(unittest.TestCase):
+
+    def test_downloads(self):
+        saved = {}
+        lock = threading.Lock()
+
+        def open_url(url):
+            if url.endswith(u'404'):
+                raise IOError(u'not found')
+            return url.encode('utf-8')
+
+        def save(name, data):
+            with lock:
+                saved[name] = data
+
+        log = Log()
+        fetcher = CoverFetcher(open_url, save, workers=3, log=log)
+        for n in range(20):
+            fetcher.put(u'B%09d' % n, u'https://images.example/%d' % n)
+        fetcher.put(u'missing', u'https://images.example/404')
+        fetcher.close()
+        self.assertEqual((fetcher.fetched, fetcher.failed), (20, 1))
+        self.assertEqual(saved[u'B000000007'], b'https://images.example/7')
+        self.assertEqual(log.messages, [(u'error', u'cover download failed: https://images.example/404 not found')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# coding=utf-8
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from requestplan import PlannedRequest
+from workqueue import FAILED, LEASED, PENDING, RESULTS, WorkQueue
+
+def _request(n, region=u'US'):
+    return PlannedRequest(u'ASIN', None, region, [u'B%09d' % n], [0, n])
+
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.queue = WorkQueue(os.path.join(self.directory, u'queue'), ttl=60, max_attempts=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_leased_in_plan_order(self):
+        self.assertFalse(self.queue.is_open())
+        self.assertFalse(self.queue.finished())
+        self.assertEqual(self.queue.enqueue([_request(n) for n in range(3)]), 3)
+        self.assertEqual(self.queue.enqueue([_request(3, u'UK')]), 1)
+        self.assertTrue(self.queue.is_open())
+        uk = self.queue.lease(u'uk-worker', regions=[u'UK'])
+        self.assertEqual((uk.shard, uk.request), (u'00000003.json', _request(3, u'UK')))
+        leases = [self.queue.lease(u'worker') for _ in range(3)]
+        self.assertEqual([l.request for l in leases], [_request(n) for n in range(3)])
+        self.assertIsNone(self.queue.lease(u'worker'))
+        self.assertEqual(self.queue.status(), {PENDING: 0, LEASED: 4, FAILED: 0, RESULTS: 0})
+
+    def test_results(self):
+        self.queue.enqueue([_request(0), _request(1)])
+        first = self.queue.lease(u'a')
+        second = self.queue.lease(u'b')
+        self.queue.complete(first, [(u'B000000000.mi', b'\x00\x01binary', {u'title': u'T'})], lost=1)
+        self.queue.complete(second, error=u'throttled', code=u'TooManyRequests')
+        self.assertTrue(self.queue.finished())
+        results = sorted(self.queue.take_results())
+        self.assertEqual(results[0].records, [(u'B000000000.mi', b'\x00\x01binary', {u'title': u'T'})])
+        self.assertEqual((results[0].worker, results[0].lost, results[0].error), (u'a', 1, None))
+        self.assertEqual((results[1].request, results[1].records, results[1].code), (_request(1), [], u'TooManyRequests'))
+        self.assertEqual(self.queue.take_results(), [])
+
+    def test_expired_lease_is_requeued_then_failed(self):
+        self.queue.enqueue([_request(0)])
+        self.queue.ttl = -1
+        lost = self.queue.lease(u'a')
+        self.assertEqual(self.queue.requeue_expired(), 1)
+        self.assertIsNone(self.queue.renew(lost))
+        again = self.queue.lease(u'b')
+        self.assertEqual(again.shard, lost.shard)
+        # a late answer from the first worker is still kept
+        self.queue.complete(lost, [(u'B000000000.mi', b'data', {})])
+        self.assertEqual(self.queue.status()[LEASED], 0)
+        self.assertEqual(len(self.queue.take_results()), 1)
+        self.queue.enqueue([_request(1)])
+        self.queue.lease(u'a')
+        self.queue.lease(u'b')
+        self.assertIsNone(self.queue.lease(u'c'))
+        self.assertEqual(self.queue.status(), {PENDING: 0, LEASED: 0, FAILED: 1, RESULTS: 0})
+        self.assertTrue(self.queue.finished())
+
+    def test_renew_and_release(self):
+        self.queue.enqueue([_request(0)])
+        lease = self.queue.lease(u'a')
+        time.sleep(0.01)
+        renewed = self.queue.renew(lease)
+        self.assertTrue(renewed.expires > lease.expires)
+        self.queue.release(renewed)
+        self.assertEqual(self.queue.status()[PENDING], 1)
+        # a released lease does not count as an attempt
+        for worker in (u'b', u'c'):
+            self.queue.release(self.queue.lease(worker))
+        self.queue.ttl = -1
+        self.queue.lease(u'd')
+        self.assertEqual(self.queue.requeue_expired(), 1)
+        self.queue.release(lease)
+        self.assertEqual(self.queue.status()[PENDING], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+"""
+Warm-up
+"""
+# coding=utf-8
+#
+# Helpers for cli_main --warm-library / --warm-csv, which prefetch the metadata
+# and covers of a whole calibre library into METADATA_CACHE_LOCATION so that
+# later identify and download_cover calls are answered from the cache.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import csv
+import io
+import os
+import sys
+import threading
+import time
+
+try:
+    from Queue import Queue
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from queue import Queue
+
+def read_library_identifiers(path):
+    """
+    :param path: unicode: a calibre library directory or its metadata.db
+    :return: List[Dict[unicode, unicode]]: the identifiers of every book that has any
+    """
+    import sqlite3
+    if os.path.isdir(path):
+        path = os.path.join(path, u'metadata.db')
+    # read only, calibre may have the library open
+    connection = sqlite3.connect(u'file:%s?mode=ro' % path, uri=True) if sys.version_info[0] >= 3 else sqlite3.connect(path)
+    try:
+        books = {}
+        for book, id_type, value in connection.execute(u'SELECT book, type, val FROM identifiers'):
+            books.setdefault(book, {})[id_type] = value
+    finally:
+        connection.close()
+    return [books[b] for b in sorted(books)]
+
+def read_csv_identifiers(path):
+    """
+    Read a calibre catalog export (or any CSV) with an identifiers column ("isbn:...,amazon:...")
+    and/or one column per identifier type (isbn, amazon, mobi-asin...).
+    :param path: unicode: CSV file
+    :return: List[Dict[unicode, unicode]]
+    """
+    books = []
+    with io.open(path, u'r', encoding=u'utf-8-sig', newline=u'') as f:
+        rows = f.read().splitlines()
+    if sys.version_info[0] < 3:
+        reader = (dict((k.decode('utf-8'), (v or b'').decode('utf-8')) for k, v in row.items()) for row in csv.DictReader([r.encode('utf-8') for r in rows]))
+    else:
+        reader = csv.DictReader(rows)
+    for row in reader:
+        ids = {}
+        for part in (row.get(u'identifiers') or u'').split(u','):
+            if u':' in part:
+                id_type, value = part.split(u':', 1)
+                ids[id_type.strip()] = value.strip()
+        for column, value in row.items():
+            if column and value and (column in (u'isbn', u'mobi-asin') or column.startswith(u'amazon')):
+                ids.setdefault(column, value.strip())
+        if ids:
+            books.append(ids)
+    return books
+
+class Progress(object):
+    """
+    A single, rewritten status line: done/total, rate and ETA.
+    """
+
+    def __init__(self, total, label=u'', stream=None, every=0.5):
+        self.total = total
+        self.label = label
+        self.done = 0
+        self.stream = stream or sys.stderr
+        self.every = every
+        self.started = time.time()
+        self._shown = 0.0
+        self._lock = threading.Lock()
+
+    def update(self, done=1, **counters):
+        """
+        :param done: int: items finished since the last call
+        :param counters: extra values to display, e.g. covers=12
+        """
+        with self._lock:
+            self.done += done
+            now = time.time()
+            if now - self._shown < self.every and self.done < self.total:
+                return
+            self._shown = now
+            elapsed = now - self.started
+            rate = self.done / elapsed if elapsed > 0 else 0.0
+            eta = (self.total - self.done) / rate if rate > 0 else 0.0
+            extra = u''.join(u' %s=%s' % kv for kv in sorted(counters.items()))
+            line = u'\r%s %d/%d %.1f/s eta %ds%s' % (self.label, self.done, self.total, rate, eta, extra)
+            try:
+                self.stream.write(line)
+                self.stream.flush()
+            except Exception:
+                pass
+
+    def finish(self):
+        """End the status line."""
+        try:
+            self.stream.write(u'\n')
+        except Exception:
+            pass
+
+class CoverFetcher(object):
+    """
+    Downloads covers on a few worker threads while the metadata lookups go on.
+    """
+    _STOP = object()
+
+    def __init__(self, open_url, save, workers=4, log=None):
+        """
+        :param open_url: callable(url) -> bytes
+        :param save: callable(name, data)
+        :param workers: int: download threads
+        :param log: calibre Log or None
+        """
+        self.open_url = open_url
+        self.save = save
+        self.log = log
+        self.fetched = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._queue = Queue(workers * 50)
+        self._threads = [threading.Thread(target=self._run, name=str('CoverFetcher')) for _ in range(workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def put(self, name, url):
+        """
+        :param name: unicode: cover name, the record's identifier
+        :param url: unicode: image URL
+        """
+        self._queue.put((name, url))
+
+    def close(self):
+        """Finish the queued downloads and stop the workers."""
+        for _ in self._threads:
+            self._queue.put(self._STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                return
+            name, url = item
+            try:
+                self.save(name, self.open_url(url))
+                with self._lock:
+                    self.fetched += 1
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                if self.log is not None:
+                    self.log.error(u'cover download failed:', url, e)
@@ -0,0 +1,272 @@
+"""
+WorkQueue
+"""
+# coding=utf-8
+#
+# Batch identification shared by several machines (cli_main --coordinator and
+# --worker).
+#
+# The coordinator plans the batch (requestplan) and puts every PlannedRequest in
+# a queue directory on a filesystem all the machines mount. Workers, each with
+# its own credentials, MaxQPS, quota and circuit breaker, lease one request at a
+# time, send it, and hand the serialized records back to the queue (base64, as
+# they may be binary records); only the coordinator writes them into its
+# metadata cache, so that cache keeps a single writer.
+#
+# A lease lasts `ttl` seconds. When a worker dies, or its call outlives the
+# lease, the request goes back to pending/ on the next lease() or
+# requeue_expired(), up to max_attempts times, after which it is moved to
+# failed/. The machines' clocks are assumed to agree to well within ttl.
+#
+# Layout: queue.json (shard count, written once the requests are queued),
+# pending/, leased/ and failed/ (one JSON file per request, named by its plan
+# position so that requests are leased in plan order), results/ (one JSON file
+# per answered request). Every move happens under an exclusive lock on
+# queue.lock (quotaledger.file_lock), so a request has one lease at a time.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import base64
+import json
+import os
+import time
+from collections import namedtuple
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.metadatacache import atomic_write
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from metadatacache import atomic_write
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.quotaledger import file_lock
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from quotaledger import file_lock
+
+try:
+    from calibre_plugins.AmazonProductAdvertisingAPI.requestplan import PlannedRequest
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from requestplan import PlannedRequest
+
+QUEUE = u'queue.json'
+PENDING = u'pending'
+LEASED = u'leased'
+FAILED = u'failed'
+RESULTS = u'results'
+#: Default lease length, in seconds
+LEASE_TTL = 300
+#: Leases of a request before it is given up
+MAX_ATTEMPTS = 3
+
+#: A leased request: shard is its file name, expires a time.time()
+Lease = namedtuple(str('Lease'), [str(f) for f in (u'shard', u'request', u'worker', u'expires')])
+#: An answered request: records are MetadataCache.serialize output, error and code describe a failed request
+Result = namedtuple(str('Result'), [str(f) for f in (u'shard', u'request', u'worker', u'records', u'lost', u'error', u'code')])
+
+class WorkQueue(object):
+    """
+    PlannedRequests shared through a directory.
+    """
+
+    def __init__(self, directory, ttl=LEASE_TTL, max_attempts=MAX_ATTEMPTS):
+        """
+        :param directory: unicode: queue directory, on a filesystem every machine mounts
+        :param ttl: float: lease length in seconds
+        :param max_attempts: int: leases of a request before it is moved to failed/
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+
+    def _path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    @staticmethod
+    def _read(path):
+        """
+        :return: Dict or None if the file is gone
+        """
+        try:
+            with open(path, str('rb')) as f:
+                return json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError):
+            return None
+
+    @staticmethod
+    def _write(path, data):
+        atomic_write(path, json.dumps(data, sort_keys=True).encode('utf-8'))
+
+    def _names(self, state):
+        try:
+            return sorted(n for n in os.listdir(self._path(state)) if n.endswith(u'.json'))
+        except OSError:
+            return []
+
+    def _move(self, shard, source, target, data):
+        """Write data as target/shard, then drop source/shard. Call with the lock held."""
+        self._write(self._path(target, shard), data)
+        try:
+            os.remove(self._path(source, shard))
+        except OSError:
+            pass
+
+    def _locked(self):
+        return file_lock(self._path(u'queue.lock'))
+
+    def enqueue(self, requests):
+        """
+        :param requests: Iterable[PlannedRequest]: in the order they should be leased
+        :return: int: requests queued
+        """
+        with self._locked():
+            for state in (PENDING, LEASED, FAILED, RESULTS):
+                if not os.path.isdir(self._path(state)):
+                    os.makedirs(self._path(state))
+            info = self._read(self._path(QUEUE)) or {}
+            start = count = info.get(u'shards', 0)
+            for request in requests:
+                self._write(self._path(PENDING, u'%08d.json' % count), {u'request': list(request), u'attempts': 0})
+                count += 1
+            info.update({u'shards': count, u'queued_at': time.time()})
+            self._write(self._path(QUEUE), info)
+        return count - start
+
+    def is_open(self):
+        """
+        :return: bool: requests have been queued (workers started first wait for this)
+        """
+        return os.path.isfile(self._path(QUEUE))
+
+    def _requeue_expired(self, now):
+        requeued = 0
+        for shard in self._names(LEASED):
+            data = self._read(self._path(LEASED, shard))
+            if data is None or data[u'expires'] > now:
+                continue
+            data.pop(u'worker', None)
+            data.pop(u'expires', None)
+            if data[u'attempts'] >= self.max_attempts:
+                self._move(shard, LEASED, FAILED, data)
+            else:
+                self._move(shard, LEASED, PENDING, data)
+                requeued += 1
+        return requeued
+
+    def requeue_expired(self):
+        """
+        Put the requests whose lease ran out back in pending/ (or failed/ after max_attempts).
+        :return: int: requests put back
+        """
+        with self._locked():
+            return self._requeue_expired(time.time())
+
+    def lease(self, worker, regions=None):
+        """
+        :param worker: unicode: who takes the lease (host and pid)
+        :param regions: Iterable[unicode] or None: only requests planned for these API regions
+        :return: Lease or None when nothing is pending
+        """
+        now = time.time()
+        with self._locked():
+            self._requeue_expired(now)
+            for shard in self._names(PENDING):
+                data = self._read(self._path(PENDING, shard))
+                if data is None:
+                    continue
+                request = PlannedRequest(*data[u'request'])
+                if regions is not None and request.region not in regions:
+                    continue
+                data.update({u'worker': worker, u'expires': now + self.ttl, u'attempts': data[u'attempts'] + 1})
+                self._move(shard, PENDING, LEASED, data)
+                return Lease(shard, request, worker, data[u'expires'])
+        return None
+
+    def _held(self, lease):
+        """
+        :return: Dict or None: the leased request's file, if the lease is still the caller's. Call with the lock held.
+        """
+        data = self._read(self._path(LEASED, lease.shard))
+        if data is None or data.get(u'worker') != lease.worker:
+            return None
+        return data
+
+    def renew(self, lease):
+        """
+        :param lease: Lease
+        :return: Lease or None if it was lost (expired and leased again)
+        """
+        with self._locked():
+            data = self._held(lease)
+            if data is None:
+                return None
+            data[u'expires'] = time.time() + self.ttl
+            self._write(self._path(LEASED, lease.shard), data)
+            return lease._replace(expires=data[u'expires'])
+
+    def release(self, lease):
+        """
+        Give a request back without answering it (the call was cancelled); the lease does not count as an attempt.
+        :param lease: Lease
+        """
+        with self._locked():
+            data = self._held(lease)
+            if data is None:
+                return
+            data.pop(u'worker', None)
+            data.pop(u'expires', None)
+            data[u'attempts'] -= 1
+            self._move(lease.shard, LEASED, PENDING, data)
+
+    def complete(self, lease, records=(), lost=0, error=None, code=None):
+        """
+        Hand the answer to a request back. It is kept even if the lease was lost, since the request was answered.
+        :param lease: Lease
+        :param records: List[Tuple[unicode, bytes, Dict]]: MetadataCache.serialize output
+        :param lost: int: products without a usable identifier
+        :param error: unicode or None: why the request failed
+        :param code: AmazonException code of the error
+        """
+        result = {u'request': list(lease.request), u'worker': lease.worker, u'lost': lost, u'error': error, u'code': code,
+                  u'records': [[name, base64.b64encode(data).decode('ascii'), fields] for name, data, fields in records]}
+        with self._locked():
+            self._write(self._path(RESULTS, lease.shard), result)
+            for state in (LEASED, PENDING):
+                try:
+                    os.remove(self._path(state, lease.shard))
+                except OSError:
+                    pass
+
+    def take_results(self):
+        """
+        Remove the answers handed back so far from the queue.
+        :return: List[Result]
+        """
+        results = []
+        with self._locked():
+            for shard in self._names(RESULTS):
+                path = self._path(RESULTS, shard)
+                data = self._read(path)
+                if data is None:
+                    continue
+                results.append(Result(shard, PlannedRequest(*data[u'request']), data[u'worker'],
+                                      [(name, base64.b64decode(record), fields) for name, record, fields in data[u'records']],
+                                      data[u'lost'], data[u'error'], data[u'code']))
+                os.remove(path)
+        return results
+
+    def status(self):
+        """
+        :return: Dict[unicode, int]: requests in each state
+        """
+        return dict((state, len(self._names(state))) for state in (PENDING, LEASED, FAILED, RESULTS))
+
+    def finished(self):
+        """
+        :return: bool: requests were queued, and none is pending or leased any more
+        """
+        if not self.is_open():
+            return False
+        status = self.status()
+        return not status[PENDING] and not status[LEASED]